@@ -0,0 +1,176 @@
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from cloudshell.custom_execution_server.custom_execution_server import CustomExecutionServer, CustomExecutionServerCommandHandler, \
+    PassedCommandResult, StoppedCommandResult
+from cloudshell.custom_execution_server.metrics import Metrics
+from cloudshell.custom_execution_server.mock_cloudshell import MockCloudShell
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+usage = '''Drives executions through CustomExecutionServer against a local mock of the CloudShell API
+and reports dispatch latency, throughput, peak memory and report upload bandwidth.
+
+Examples:
+    python %s --executions 200 --capacity 10
+    python %s --executions 50 --capacity 5 --run-command "python -c pass" --report-bytes 50000000
+    python %s --executions 100 --latency 0.02 --error-rate 0.05
+''' % (sys.argv[0], sys.argv[0], sys.argv[0])
+
+
+class BenchmarkCommandHandler(CustomExecutionServerCommandHandler):
+    """
+    Stands in for a real test runner: sleeps or runs a fast command, then returns a canned report file
+    """
+    def __init__(self, run_seconds, run_command, report_path):
+        CustomExecutionServerCommandHandler.__init__(self)
+        self._run_seconds = run_seconds
+        self._run_command = run_command
+        self._report_path = report_path
+        self._lock = threading.Lock()
+        self._processes = {}
+        self.started_at = {}
+
+    def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
+        with self._lock:
+            self.started_at[execution_id] = time.time()
+        if self._run_command:
+            process = subprocess.Popen(self._run_command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            with self._lock:
+                self._processes[execution_id] = process
+            process.communicate()
+            with self._lock:
+                self._processes.pop(execution_id, None)
+            if process.returncode < 0:
+                return StoppedCommandResult()
+        elif self._run_seconds:
+            time.sleep(self._run_seconds)
+        if self._report_path:
+            return PassedCommandResult('report.zip', None, 'application/zip', report_path=self._report_path)
+        return PassedCommandResult('', '')
+
+    def stop_command(self, execution_id, logger):
+        with self._lock:
+            process = self._processes.get(execution_id)
+        if process is not None:
+            process.kill()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return float('nan')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return rss / 1024.0 / 1024.0
+    return rss / 1024.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=usage, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--executions', type=int, default=100, help='number of start commands to send')
+    parser.add_argument('--capacity', type=int, default=5, help='server_capacity of the execution server')
+    parser.add_argument('--run-seconds', type=float, default=0.0, help='time each fake execution sleeps')
+    parser.add_argument('--run-command', default='', help='shell command each fake execution runs instead of sleeping, e.g. "python -c pass"')
+    parser.add_argument('--report-bytes', type=int, default=1000000, help='size of the report uploaded for each execution, 0 for none')
+    parser.add_argument('--reservations', type=int, default=1, help='number of distinct reservation ids the commands are spread over, 0 for none')
+    parser.add_argument('--command-interval', type=float, default=0.0, help='seconds between commands added to the mock, 0 to queue all at once')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the mock adds to every API response')
+    parser.add_argument('--reservation-latency', type=float, default=0.0, help='seconds the mock adds to reservation lookups')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of the mock answering a request with HTTP 500')
+    parser.add_argument('--poll-hold', type=float, default=1.0, help='seconds the mock holds an empty PendingCommand request')
+    parser.add_argument('--timeout', type=float, default=600, help='give up after this many seconds')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the execution server, logged to stderr')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('benchmark')
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.getLevelName(args.log_level.upper()))
+
+    report_path = ''
+    if args.report_bytes:
+        fd, report_path = tempfile.mkstemp(suffix='.zip')
+        with os.fdopen(fd, 'wb') as f:
+            block = os.urandom(min(args.report_bytes, 1 << 20))
+            left = args.report_bytes
+            while left > 0:
+                f.write(block[:left])
+                left -= len(block)
+
+    mock = MockCloudShell(latency=args.latency,
+                          path_latency={'/API/Execution/Reservations': args.reservation_latency},
+                          error_rate=args.error_rate,
+                          error_paths=['/API/Execution/PendingCommand', '/API/Execution/Status', '/API/Execution/Reservations'],
+                          poll_hold=args.poll_hold)
+    mock.start()
+
+    command_handler = BenchmarkCommandHandler(args.run_seconds, args.run_command, report_path)
+    metrics = Metrics()
+    server = CustomExecutionServer(server_name='Benchmark', server_description='Benchmark', server_type='Benchmark',
+                                   server_capacity=args.capacity,
+                                   command_handler=command_handler,
+                                   logger=logger,
+                                   cloudshell_host='127.0.0.1',
+                                   cloudshell_port=mock.port(),
+                                   auto_register=True,
+                                   auto_start=False,
+                                   metrics=metrics)
+
+    t0 = time.time()
+    server.start()
+    for i in range(args.executions):
+        reservation_id = 'res%d' % (i % args.reservations) if args.reservations else ''
+        mock.add_start_command('exec%d' % i, reservation_id=reservation_id)
+        if args.command_interval:
+            time.sleep(args.command_interval)
+
+    completed = mock.wait_for(args.executions, args.executions if report_path else 0, args.timeout)
+    elapsed = time.time() - t0
+    server.stop()
+    mock.stop()
+    if report_path:
+        os.remove(report_path)
+
+    executions = mock.executions()
+    dispatch = [e.dispatched_at - e.queued_at for e in executions if e.dispatched_at]
+    start = [command_handler.started_at[e.execution_id] - e.queued_at for e in executions if e.execution_id in command_handler.started_at]
+    finished = [e for e in executions if e.finished_at]
+    upload_bytes = sum(e.report_bytes for e in executions)
+    upload_seconds = sum(e.report_seconds for e in executions)
+
+    print('Executions:            %d of %d finished%s' % (len(finished), args.executions, '' if completed else ' (timed out)'))
+    print('Results:               %s' % ', '.join('%s=%d' % (r, sum(1 for e in finished if e.result == r)) for r in sorted(set(e.result for e in finished))))
+    print('Elapsed:               %.2f s' % elapsed)
+    print('Throughput:            %.1f executions/minute' % (len(finished) * 60.0 / elapsed if elapsed else 0))
+    print('Dispatch latency:      p50 %.3f s  p95 %.3f s  max %.3f s  (queued in CloudShell -> handed out by PendingCommand)' % (
+        percentile(dispatch, 50), percentile(dispatch, 95), max(dispatch or [0])))
+    print('Start latency:         p50 %.3f s  p95 %.3f s  max %.3f s  (queued in CloudShell -> execute_command() called)' % (
+        percentile(start, 50), percentile(start, 95), max(start or [0])))
+    print('Peak RSS:              %.1f MB' % peak_rss_mb())
+    if upload_seconds:
+        print('Upload bandwidth:      %.1f MB/s  (%.1f MB in %d reports)' % (
+            upload_bytes / 1048576.0 / upload_seconds, upload_bytes / 1048576.0, sum(1 for e in executions if e.reported_at)))
+    print('API requests:          %s' % ', '.join('%s=%d' % kv for kv in sorted(mock.request_counts().items())))
+    return 0 if completed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,224 @@
+import os
+import threading
+import traceback
+from time import time
+
+
+class HostLoadSampler:
+    """
+    Samples CPU usage, memory usage and load average of the local host
+
+    CPU and memory are read from /proc on Linux; a value that can't be read on this platform is None.
+    """
+    def __init__(self):
+        self._last_cpu = self._read_cpu_times()
+
+    def _read_cpu_times(self):
+        try:
+            with open('/proc/stat') as f:
+                fields = [float(x) for x in f.readline().split()[1:]]
+        except (IOError, OSError, ValueError):
+            return None
+        # idle + iowait
+        idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+        return sum(fields), idle
+
+    def cpu(self):
+        """
+        :return: float : fraction of CPU time busy since the previous call, 0..1
+        """
+        now = self._read_cpu_times()
+        last, self._last_cpu = self._last_cpu, now
+        if now is None or last is None or now[0] <= last[0]:
+            return None
+        return 1 - (now[1] - last[1]) / (now[0] - last[0])
+
+    def memory(self):
+        """
+        :return: float : fraction of memory in use, not counting reclaimable caches, 0..1
+        """
+        values = {}
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    k, _, v = line.partition(':')
+                    values[k] = float(v.split()[0])
+        except (IOError, OSError, ValueError, IndexError):
+            return None
+        if not values.get('MemTotal') or 'MemAvailable' not in values:
+            return None
+        return 1 - values['MemAvailable'] / values['MemTotal']
+
+    def load(self):
+        """
+        :return: float : 1 minute load average per CPU core
+        """
+        try:
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        except (AttributeError, OSError):
+            return None
+
+    def sample(self):
+        """
+        :return: dict : 'cpu', 'memory' and 'load', see the methods of the same names
+        """
+        return {'cpu': self.cpu(), 'memory': self.memory(), 'load': self.load()}
+
+
+class CapacityController:
+    """
+    Raises or lowers the capacity a CustomExecutionServer advertises to CloudShell according to the load of the host
+
+    Every interval seconds the host is sampled, see HostLoadSampler. The host counts as overloaded when any of
+    CPU, memory or load per core is above its high threshold, or when runs have become slower than usual:
+    each run duration is compared to the average of earlier runs of the same test with the same arguments, see
+    observe_duration(). It has room when all the values that could be read are below their low thresholds, and at
+    least one could. Between the thresholds nothing changes.
+
+    The capacity is lowered by one after lower_after overloaded samples in a row, and raised by one after
+    raise_after samples in a row with room while the server had as many commands as it has slots -- there
+    is no point in offering capacity nobody uses. After a change, further changes wait cooldown seconds so
+    the effect of the previous one shows in the samples. The capacity stays within min_capacity..max_capacity.
+    """
+    def __init__(self, min_capacity, max_capacity, logger,
+                 interval=30,
+                 cpu_high=0.9, cpu_low=0.6,
+                 memory_high=0.9, memory_low=0.75,
+                 load_high=1.5, load_low=0.8,
+                 slowdown_high=1.5, slowdown_low=1.2,
+                 raise_after=3, lower_after=2,
+                 cooldown=300,
+                 sampler=None):
+        """
+        :param min_capacity: int
+        :param max_capacity: int
+        :param logger: logging.Logger
+        :param interval: float : seconds between samples
+        :param cpu_high: float : fraction of CPU time busy, 0..1
+        :param memory_high: float : fraction of memory in use, 0..1
+        :param load_high: float : 1 minute load average per CPU core
+        :param slowdown_high: float : recent run durations relative to the average duration of the same tests
+        :param raise_after: int : samples in a row with room before raising the capacity
+        :param lower_after: int : overloaded samples in a row before lowering the capacity
+        :param cooldown: float : minimum seconds between two changes
+        :param sampler: HostLoadSampler
+        """
+        self._min_capacity = min_capacity
+        self._max_capacity = max_capacity
+        self._logger = logger
+        self._interval = interval
+        self._thresholds = {
+            'cpu': (cpu_low, cpu_high),
+            'memory': (memory_low, memory_high),
+            'load': (load_low, load_high),
+            'slowdown': (slowdown_low, slowdown_high),
+        }
+        self._raise_after = raise_after
+        self._lower_after = lower_after
+        self._cooldown = cooldown
+        self._sampler = sampler or HostLoadSampler()
+        self._lock = threading.Lock()
+        # key -> average duration of its runs, see observe_duration()
+        self._durations = {}
+        # average of the durations of recent runs relative to the average of their tests, None until there is one
+        self._slowdown = None
+        self._overloaded_count = 0
+        self._room_count = 0
+        self._last_change = 0
+        self._server = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def observe_duration(self, key, seconds):
+        """
+        Records the duration of a run
+
+        :param key: hashable : identifies runs expected to take about as long as each other, e.g. the test path and arguments
+        :param seconds: float
+        """
+        with self._lock:
+            average = self._durations.get(key)
+            if average:
+                ratio = seconds / average
+                self._slowdown = ratio if self._slowdown is None else 0.7 * self._slowdown + 0.3 * ratio
+                self._durations[key] = 0.9 * average + 0.1 * seconds
+            elif seconds > 0:
+                self._durations[key] = seconds
+
+    def evaluate(self, sample, capacity, saturated):
+        """
+        Feeds one sample to the controller
+
+        :param sample: dict : see HostLoadSampler.sample()
+        :param capacity: int : current capacity
+        :param saturated: bool : the server had as many commands as slots
+        :return: int : new capacity, or the current one if it doesn't change
+        """
+        with self._lock:
+            sample = dict(sample, slowdown=self._slowdown)
+        values = dict((k, v) for k, v in sample.items() if v is not None and k in self._thresholds)
+        overloaded = [k for k, v in values.items() if v > self._thresholds[k][1]]
+        # nothing readable, e.g. no /proc and no runs yet, is no evidence of room
+        room = bool(values) and all(v < self._thresholds[k][0] for k, v in values.items())
+        if overloaded:
+            self._overloaded_count += 1
+            self._room_count = 0
+        elif room and saturated:
+            self._room_count += 1
+            self._overloaded_count = 0
+        else:
+            self._overloaded_count = 0
+            self._room_count = 0
+
+        new_capacity = capacity
+        if capacity > self._max_capacity:
+            new_capacity = self._max_capacity
+        elif capacity < self._min_capacity:
+            new_capacity = self._min_capacity
+        elif time() - self._last_change < self._cooldown:
+            pass
+        elif self._overloaded_count >= self._lower_after and capacity > self._min_capacity:
+            new_capacity = capacity - 1
+            self._logger.info('Host overloaded (%s) - lowering capacity from %d to %d' % (
+                ', '.join('%s %.2f' % (k, values[k]) for k in overloaded), capacity, new_capacity))
+        elif self._room_count >= self._raise_after and capacity < self._max_capacity:
+            new_capacity = capacity + 1
+            self._logger.info('Host has room (%s) - raising capacity from %d to %d' % (
+                ', '.join('%s %.2f' % (k, v) for k, v in sorted(values.items())), capacity, new_capacity))
+        if new_capacity != capacity:
+            self._last_change = time()
+            self._overloaded_count = 0
+            self._room_count = 0
+            if new_capacity < capacity:
+                # durations of runs that overlapped the overload would lower the capacity again
+                with self._lock:
+                    self._slowdown = None
+        return new_capacity
+
+    def start(self, server):
+        """
+        :param server: CustomExecutionServer : see CustomExecutionServer.set_capacity()
+        """
+        self._server = server
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._control_thread, name='capacity')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _control_thread(self):
+        while not self._stop_event.wait(self._interval):
+            try:
+                server = self._server
+                capacity = server.capacity()
+                saturated = server.busy_slots() + server.queued_commands() >= capacity
+                new_capacity = self.evaluate(self._sampler.sample(), capacity, saturated)
+                if new_capacity != capacity:
+                    server.set_capacity(new_capacity)
+            except Exception as e:
+                self._logger.error('Capacity controller failed: %s: %s' % (str(e), traceback.format_exc()))
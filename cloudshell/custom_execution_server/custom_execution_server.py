@@ -1,24 +1,35 @@
 import json
+import logging
+import os
+import socket
+from collections import deque, OrderedDict
 import threading
 from abc import abstractmethod
-from time import sleep
+from time import time
 import sys
 import traceback
 
+import heapq
 import itertools
+import random
 
 import re
 
+from cloudshell.custom_execution_server.metrics import Metrics
+from cloudshell.custom_execution_server.outbox import Outbox
+
 if sys.version_info.major == 2:
-    from urllib2 import Request
-    from urllib2 import urlopen
+    from httplib import HTTPConnection, HTTPException
     from urllib import quote
 else:
-    from urllib.request import Request
-    from urllib.request import urlopen
+    from http.client import HTTPConnection, HTTPException
     from urllib.parse import quote
 
 
+PASSWORD_IN_URL_RE = re.compile(r':[^@]*@')
+PASSWORD_IN_JSON_RE = re.compile(r'"Password":\s*"[^"]*"')
+
+
 def bytes23(s):
     if sys.version_info.major == 3:
         if isinstance(s, str):
@@ -53,6 +64,928 @@ def string23ppbinary(s):
             return '(%d bytes binary data)' % len(s)
 
 
+class CloudShellAPIError(Exception):
+    """
+    CloudShell answered an API call with an HTTP error status
+    """
+    def __init__(self, code, message):
+        Exception.__init__(self, 'Error: %d: %s' % (code, message))
+        self.code = code
+
+    def is_permanent(self):
+        """
+        :return: bool : True if repeating the same call can't succeed
+        """
+        return 400 <= self.code < 500 and self.code not in (401, 408, 429)
+
+
+class CircuitOpenError(Exception):
+    """
+    A request was not sent because CloudShell failed too often recently, see CircuitBreaker
+    """
+    def __init__(self, retry_after):
+        Exception.__init__(self, 'CloudShell is unavailable - not calling it for %.1f more seconds' % retry_after)
+        self.retry_after = retry_after
+
+
+class RequestNotSentError(socket.error):
+    """
+    Connecting to the server failed, so the request surely didn't reach it
+    """
+    pass
+
+
+class RetryPolicy:
+    """
+    How often a request is attempted and how long to wait between the attempts
+    """
+    def __init__(self, attempts=3, base_delay=0.5, max_delay=10, resend=True):
+        """
+        :param attempts: int : total number of attempts, 1 for no retries
+        :param base_delay: float : seconds before the first retry, doubled with every further retry
+        :param max_delay: float : maximum seconds between attempts
+        :param resend: bool : False to attempt again only if the request surely didn't reach CloudShell, e.g. the
+            connection was refused -- for requests that must not be processed twice
+        """
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.resend = resend
+
+    def delay(self, attempt):
+        """
+        :param attempt: int : number of the attempt that failed, starting at 1
+        :return: float : seconds to wait, jittered so that servers failing at the same time don't retry in lockstep
+        """
+        return min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+
+# by path prefix, the longest matching prefix applies
+DEFAULT_RETRY_POLICIES = {
+    '': RetryPolicy(),
+    '/API/Auth/login': RetryPolicy(attempts=3, base_delay=1),
+    # CloudShell may have handed out a command already when the connection failed -- the poll loop backs off instead
+    '/API/Execution/PendingCommand': RetryPolicy(attempts=1),
+    '/API/Execution/Status': RetryPolicy(attempts=3, base_delay=1, max_delay=5),
+    '/API/Execution/FinishedExecution': RetryPolicy(attempts=4, base_delay=1),
+    # a POST: sent again after a timeout, CloudShell would attach the report twice -- the outbox retries later instead
+    '/API/Execution/ExecutionReport': RetryPolicy(attempts=3, base_delay=1, resend=False),
+}
+
+
+class CircuitBreaker:
+    """
+    Stops calling CloudShell while it is down, so requests fail right away instead of piling up timeouts
+
+    After failure_threshold connection errors or 5xx responses in a row the circuit opens: requests raise
+    CircuitOpenError without being sent. After reset_timeout seconds, with jitter, the next request is
+    let through as a probe while the others keep failing fast; if it succeeds the circuit closes, if not
+    it opens again for twice as long, up to max_reset_timeout.
+    """
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(self, failure_threshold=5, reset_timeout=5, max_reset_timeout=120):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._max_reset_timeout = max_reset_timeout
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._failures = 0
+        self._timeout = reset_timeout
+        self._open_until = 0
+
+    def before_request(self):
+        """
+        :return: bool : True if the request is the probe of a half-open circuit
+        :raises CircuitOpenError: if the request must not be sent
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return False
+            now = time()
+            if self.state == self.OPEN and now >= self._open_until:
+                self.state = self.HALF_OPEN
+                return True
+            raise CircuitOpenError(max(self._open_until - now, 1))
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._timeout = self._reset_timeout
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN:
+                self._timeout = min(self._max_reset_timeout, self._timeout * 2)
+            elif self.state == self.OPEN or self._failures < self._failure_threshold:
+                return
+            self.state = self.OPEN
+            self._open_until = time() + self._timeout * random.uniform(0.5, 1.0)
+
+    def retry_after(self):
+        """
+        :return: float : seconds until a request may be sent, 0 if the circuit is closed
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0
+            return max(self._open_until - time(), 0)
+
+
+class HTTPConnectionPool:
+    """
+    Thread-safe pool of persistent HTTP/1.1 connections to a single host
+
+    Up to max_idle connections are kept open between requests and closed once they have been idle for idle_timeout seconds.
+    A request that finds no idle connection opens a new one, so concurrent callers never wait for each other;
+    the extra connections are closed after use if the pool is already full.
+    A request that fails on a reused connection because the server closed it in the meantime is retried once on a fresh connection,
+    by default only for the idempotent methods, as the server may have processed the request before the connection failed.
+    """
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT')
+
+    def __init__(self, host, port, max_idle=4, idle_timeout=30, timeout=None):
+        """
+        :param host: str
+        :param port: int
+        :param max_idle: int : maximum number of connections kept open between requests
+        :param idle_timeout: float : seconds after which an unused connection is closed instead of reused
+        :param timeout: float : socket timeout for new connections, None to block indefinitely
+        """
+        self._host = host
+        self._port = port
+        self._max_idle = max_idle
+        self._idle_timeout = idle_timeout
+        self._timeout = timeout
+        self._idle = []
+        # connections with a request in progress
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def _new_connection(self):
+        if self._timeout is None:
+            return HTTPConnection(self._host, self._port)
+        return HTTPConnection(self._host, self._port, timeout=self._timeout)
+
+    def _get(self):
+        now = time()
+        stale = []
+        conn = None
+        with self._lock:
+            while self._idle and now - self._idle[0][1] >= self._idle_timeout:
+                stale.append(self._idle.pop(0)[0])
+            if self._idle:
+                conn = self._idle.pop()[0]
+        for c in stale:
+            c.close()
+        if conn is not None:
+            reused = True
+        else:
+            conn = self._new_connection()
+            reused = False
+        with self._lock:
+            self._active.add(conn)
+        return conn, reused
+
+    def _put(self, conn):
+        with self._lock:
+            self._active.discard(conn)
+            if len(self._idle) < self._max_idle:
+                self._idle.append((conn, time()))
+                return
+        conn.close()
+
+    def request(self, method, path, body=None, headers=None, retry_stale=None):
+        """
+        Sends a request and reads the whole response
+
+        :param method: str : e.g. 'GET'
+        :param path: str : absolute path on the host, e.g. '/API/Auth/login'
+        :param body: bytes or file-like : a file-like body is streamed -- with chunked encoding unless headers include Content-Length
+        :param headers: dict
+        :param retry_stale: bool : send the request again if a reused connection turns out closed, None for the idempotent methods only
+        :return: (int, bytes) : status code and response body
+        :raises RequestNotSentError: if connecting failed
+        """
+        headers = headers or {}
+        if retry_stale is None:
+            retry_stale = method.upper() in self.IDEMPOTENT_METHODS
+        start = None
+        if hasattr(body, 'read'):
+            if sys.version_info.major == 2 and 'Content-Length' not in headers:
+                # httplib in Python 2 can't send chunked requests
+                body = body.read()
+            else:
+                try:
+                    start = body.tell()
+                except Exception:
+                    start = None
+        for attempt in range(2):
+            conn, reused = self._get()
+            if conn.sock is None:
+                try:
+                    conn.connect()
+                except (HTTPException, socket.error) as e:
+                    self._discard(conn)
+                    raise RequestNotSentError('Failed to connect to %s:%d: %s' % (self._host, self._port, str(e)))
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except socket.timeout:
+                self._discard(conn)
+                raise
+            except (HTTPException, socket.error):
+                self._discard(conn)
+                if reused and attempt == 0 and retry_stale:
+                    if not hasattr(body, 'read'):
+                        continue
+                    if start is not None:
+                        body.seek(start)
+                        continue
+                raise
+            except:
+                self._discard(conn)
+                raise
+            if response.will_close:
+                self._discard(conn)
+            else:
+                self._put(conn)
+            return response.status, data
+
+    def _discard(self, conn):
+        with self._lock:
+            self._active.discard(conn)
+        conn.close()
+
+    def close(self, abort=False):
+        """
+        Closes all idle connections
+
+        :param abort: bool : also shut down the connections of requests in progress, so they fail right away instead of waiting for the response
+        """
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+            active = list(self._active) if abort else []
+        for conn, _ in idle:
+            conn.close()
+        for conn in active:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except (AttributeError, socket.error):
+                # not connected yet or already closed
+                pass
+
+
+class CloudShellAPI:
+    """
+    Logged in session with the CloudShell execution server API over a pool of keep-alive connections
+
+    Thread-safe; several CustomExecutionServer objects in one process can share one session, see CustomExecutionServerHost.
+
+    Failed requests are retried with exponential backoff according to the RetryPolicy for their path, a request
+    rejected with 401 because the token expired logs in again and is repeated, and a CircuitBreaker stops
+    calling CloudShell while it is down -- the probe of the half-open circuit is a new login, which also
+    replaces a token CloudShell forgot while it was down.
+    """
+    def __init__(self, host, port, username, password, domain, logger, metrics=None,
+                 connection_pool_size=4, connection_idle_timeout=30, request_timeout=120,
+                 retry_policies=None, circuit_breaker=None):
+        """
+        :param host: str
+        :param port: int
+        :param username: str
+        :param password: str
+        :param domain: str
+        :param logger: logging.Logger
+        :param metrics: Metrics : registry for the request latencies and counts, a private one if not given
+        :param connection_pool_size: int : maximum number of idle keep-alive connections kept open between requests
+        :param connection_idle_timeout: float : seconds after which an idle connection is closed instead of reused
+        :param request_timeout: float : seconds to wait for CloudShell to send data before a request fails, None to wait indefinitely
+        :param retry_policies: dict : path prefix -> RetryPolicy, replacing those of DEFAULT_RETRY_POLICIES with the same prefix
+        :param circuit_breaker: CircuitBreaker : a default one if not given
+        """
+        self._host = host
+        self._port = port
+        self._username = username
+        self._password = password
+        self._domain = domain
+        self._logger = logger
+        self._metrics = metrics or Metrics()
+        self._metrics.define_histogram('ces_request_seconds', 'Latency of CloudShell API calls by path')
+        self._metrics.define_counter('ces_requests_total', 'CloudShell API calls by path and status code')
+        self._metrics.define_counter('ces_request_retries_total', 'CloudShell API calls repeated after a failure by path')
+        self._metrics.define_counter('ces_relogins_total', 'Logins to CloudShell after the token expired')
+        self._counter = itertools.count()
+        self._token = None
+        self._login_lock = threading.Lock()
+        self._retry_policies = dict(DEFAULT_RETRY_POLICIES)
+        self._retry_policies.update(retry_policies or {})
+        self._breaker = circuit_breaker or CircuitBreaker()
+        self._metrics.define_gauge('ces_circuit_state', 'State of the circuit breaker for CloudShell: 0 closed, 1 open, 2 half-open',
+                                   lambda: self._breaker.state)
+        # set by close(abort=True) to cut backoff waits short
+        self._aborted = threading.Event()
+        self._pool = HTTPConnectionPool(host, port,
+                                        max_idle=connection_pool_size,
+                                        idle_timeout=connection_idle_timeout,
+                                        timeout=request_timeout)
+
+    def login(self):
+        self.request('put', '/API/Auth/login', data=self._login_data(), hide_result=True)
+
+    def _login_data(self):
+        return json.dumps({
+            'Username': self._username,
+            'Password': self._password,
+            'Domain': self._domain,
+        })
+
+    def _relogin(self, token):
+        """
+        Logs in again unless another thread already replaced token
+        """
+        with self._login_lock:
+            if self._token == token:
+                self._logger.info('CloudShell token expired - logging in again')
+                self._metrics.inc('ces_relogins_total')
+                self._send('put', '/API/Auth/login', self._login_data(), None, True)
+
+    def _probe(self):
+        """
+        Sends the probe of the half-open circuit
+        """
+        try:
+            with self._login_lock:
+                self._send('put', '/API/Auth/login', self._login_data(), None, True)
+        except Exception as e:
+            if isinstance(e, CloudShellAPIError) and e.code < 500:
+                # CloudShell answered, e.g. rejected the credentials: it is up
+                self._breaker.record_success()
+            else:
+                self._breaker.record_failure()
+            raise
+        self._breaker.record_success()
+        self._logger.info('CloudShell is reachable again')
+
+    def _retry_policy(self, path):
+        return self._retry_policies[max((p for p in self._retry_policies if path.startswith(p)), key=len)]
+
+    def request(self, method, path, data=None, headers=None, hide_result=False):
+        """
+        :param method: str : e.g. 'get', 'put'
+        :param path: str : e.g. '/API/Execution/PendingCommand'
+        :param data: str, bytes or file-like : request body, a file-like body is streamed -- and only retried if it can seek
+        :param headers: dict : default JSON content type and accept headers if not set
+        :param hide_result: bool : don't log the response body, e.g. for the login token
+        :return: (int, str) : status code and response body
+        :raises CloudShellAPIError: for a status code of 400 or above
+        :raises CircuitOpenError: if the request was not sent because CloudShell is down
+        """
+        policy = self._retry_policy(path)
+        attempts = policy.attempts
+        start = None
+        if hasattr(data, 'read'):
+            try:
+                start = data.tell()
+            except Exception:
+                attempts = 1
+        is_login = path == '/API/Auth/login'
+        relogged = False
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                # a login sent as the probe closes or reopens the circuit with its own outcome below
+                probe = self._breaker.before_request()
+                if probe and not is_login:
+                    self._probe()
+                    probe = False
+            except (CircuitOpenError, CloudShellAPIError, HTTPException, socket.error) as e:
+                # _probe() already recorded its outcome
+                if attempt >= attempts or self._aborted.is_set():
+                    raise
+                if isinstance(e, CloudShellAPIError) and e.is_permanent():
+                    raise
+                error = e
+                if isinstance(e, CircuitOpenError):
+                    delay = e.retry_after
+                else:
+                    delay = max(self._breaker.retry_after(), policy.delay(attempt))
+            else:
+                token = self._token
+                try:
+                    # a request that must not be repeated, like taking a PendingCommand, isn't re-sent on a stale connection either
+                    result = self._send(method, path, data, headers, hide_result, attempts > 1 and policy.resend)
+                except CloudShellAPIError as e:
+                    if e.code >= 500:
+                        self._breaker.record_failure()
+                    else:
+                        self._breaker.record_success()
+                    if e.code == 401 and not is_login and not relogged:
+                        # doesn't count as an attempt
+                        self._relogin(token)
+                        relogged = True
+                        attempt -= 1
+                        if start is not None:
+                            data.seek(start)
+                        continue
+                    if e.is_permanent() or attempt >= attempts or self._aborted.is_set():
+                        raise
+                    if not policy.resend and e.code >= 500:
+                        # may have been processed before it failed
+                        raise
+                    error = e
+                except (HTTPException, socket.error) as e:
+                    self._breaker.record_failure()
+                    if attempt >= attempts or self._aborted.is_set():
+                        raise
+                    if not policy.resend and not isinstance(e, RequestNotSentError):
+                        raise
+                    error = e
+                except Exception:
+                    if probe:
+                        # don't leave the circuit half-open
+                        self._breaker.record_failure()
+                    raise
+                else:
+                    self._breaker.record_success()
+                    return result
+                delay = policy.delay(attempt)
+            self._metrics.inc('ces_request_retries_total', path='/' + '/'.join(path.strip('/').split('/')[:3]))
+            self._logger.warning('%s %s failed (attempt %d of %d), retrying in %.1f seconds: %s' % (
+                method.upper(), path, attempt, attempts, delay, str(error)))
+            if self._aborted.wait(delay):
+                raise error
+            if start is not None:
+                data.seek(start)
+
+    def _send(self, method, path, data, headers, hide_result, retry_stale=None):
+        if sys.version_info.major == 3:
+            counter = self._counter.__next__()
+        else:
+            counter = self._counter.next()
+        if not headers:
+            headers = {
+                'Accept': 'application/json',
+                'Content-Type': 'application/json',
+            }
+        else:
+            headers = dict(headers)
+        if self._token:
+            headers['Authorization'] = 'Basic ' + self._token
+
+        if path.startswith('/'):
+            path = path[1:]
+
+        url = 'http://%s:%d/%s' % (self._host, self._port, path)
+
+        if sys.version_info.major == 2:
+            if isinstance(url, unicode):
+                url = url.encode('ascii')
+            if isinstance(path, unicode):
+                path = path.encode('ascii')
+            headers = dict((k.encode('ascii') if isinstance(k, unicode) else k,
+                            v.encode('ascii') if isinstance(v, unicode) else v)
+                           for k, v in headers.items())
+
+        debug = self._logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            if hasattr(data, 'read'):
+                pdata = '(streamed data)'
+            else:
+                pdata = string23ppbinary(data)
+            pdata = PASSWORD_IN_URL_RE.sub(':(password hidden)@', pdata)
+            pdata = PASSWORD_IN_JSON_RE.sub('"Password": "(password hidden)"', pdata)
+            pheaders = dict(headers)
+            if 'Authorization' in pheaders:
+                pheaders['Authorization'] = '(token hidden)'
+
+            self._logger.debug('Request %d: %s %s headers=%s data=<<<%s>>>' % (counter, method, url, pheaders, pdata))
+
+        if not hasattr(data, 'read'):
+            data = bytes23(data)
+        metric_path = '/' + '/'.join(path.split('/')[:3])
+        try:
+            with self._metrics.timer('ces_request_seconds', path=metric_path):
+                code, body = self._pool.request(method.upper(), '/' + path, data, headers, retry_stale)
+        except Exception:
+            self._metrics.inc('ces_requests_total', path=metric_path, code='error')
+            raise
+        self._metrics.inc('ces_requests_total', path=metric_path, code=str(code))
+
+        if debug:
+            if hide_result:
+                self._logger.debug('Result %d: %d: (hidden)' % (counter, code))
+            else:
+                self._logger.debug('Result %d: %d: %s' % (counter, code, string23ppbinary(body)))
+
+        if code >= 400:
+            try:
+                message = string23(body)
+            except UnicodeDecodeError:
+                message = string23ppbinary(body)
+            raise CloudShellAPIError(code, message)
+        body = string23(body)
+        if path == 'API/Auth/login':
+            self._token = body.replace('"', '')
+        return code, body
+
+    def close(self, abort=False):
+        """
+        Closes the idle connections, see HTTPConnectionPool.close()
+        """
+        if abort:
+            self._aborted.set()
+        self._pool.close(abort=abort)
+
+    def reopen(self):
+        """
+        Makes the session usable again after close(abort=True), e.g. to start a stopped server again
+        """
+        self._aborted.clear()
+
+
+class FairShareQueue:
+    """
+    Run queue ordered by priority, then by weighted fair share between users and between their reservations
+
+    Items of a higher priority always come first. Within a priority, users take turns by deficit round robin:
+    a user with weight 2 gets two items for every item of a user with weight 1, however many items each of
+    them queued, and the reservations of a user take turns in the same way with equal weights. Items of the
+    same user and reservation come out in the order they were pushed. With all items at the same priority
+    and from the same user and reservation this is a plain FIFO queue.
+    """
+    class _Flow:
+        def __init__(self, weight):
+            self.weight = weight
+            self.deficit = 0.0
+            # group -> deque of items
+            self.groups = OrderedDict()
+
+    def __init__(self, weights=None, default_weight=1.0):
+        """
+        :param weights: dict : user -> weight, default_weight for the users not in it
+        :param default_weight: float
+        :raises ValueError: if a weight is not positive -- a user with weight 0 would never be served
+        """
+        for user, weight in list((weights or {}).items()) + [('default', default_weight)]:
+            if not weight > 0:
+                raise ValueError('Fair share weight of %s must be positive, not %s' % (user, weight))
+        self._weights = weights or {}
+        self._default_weight = default_weight
+        # priority -> OrderedDict of user -> _Flow, only priorities with items
+        self._levels = {}
+        # negated priorities with items, for the highest one at [0]
+        self._heap = []
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, item, priority=0, user='', group=''):
+        """
+        :param priority: int : higher comes first
+        :param user: str : items are shared fairly between users
+        :param group: str : and between the groups of a user, e.g. reservations
+        """
+        flows = self._levels.get(priority)
+        if flows is None:
+            flows = self._levels[priority] = OrderedDict()
+            heapq.heappush(self._heap, -priority)
+        flow = flows.get(user)
+        if flow is None:
+            flow = flows[user] = self._Flow(self._weights.get(user, self._default_weight))
+        items = flow.groups.get(group)
+        if items is None:
+            items = flow.groups[group] = deque()
+        items.append(item)
+        self._size += 1
+
+    def pop(self):
+        """
+        :return: the next item
+        :raises IndexError: if the queue is empty
+        """
+        if not self._size:
+            raise IndexError('pop from an empty FairShareQueue')
+        priority = -self._heap[0]
+        flows = self._levels[priority]
+        while True:
+            user, flow = next(iter(flows.items()))
+            if flow.deficit < 1:
+                flow.deficit += flow.weight
+                if flow.deficit < 1:
+                    flows[user] = flows.pop(user)
+                    continue
+            group, items = next(iter(flow.groups.items()))
+            item = items.popleft()
+            if items:
+                # to the end of the round
+                flow.groups[group] = flow.groups.pop(group)
+            else:
+                del flow.groups[group]
+            flow.deficit -= 1
+            if not flow.groups:
+                # an idle user doesn't save up a share
+                del flows[user]
+            elif flow.deficit < 1:
+                flows[user] = flows.pop(user)
+            break
+        if not flows:
+            del self._levels[priority]
+            heapq.heappop(self._heap)
+        self._size -= 1
+        return item
+
+    def clear(self):
+        self._levels = {}
+        self._heap = []
+        self._size = 0
+
+
+class WorkerBudget:
+    """
+    Limit on the number of tasks running at once across several WorkerPools
+
+    The pools sharing a budget also share its condition, so a pool can wait for its own and the shared limit at once.
+    """
+    def __init__(self, size):
+        """
+        :param size: int : maximum number of tasks running in all pools together
+        """
+        self.size = size
+        self.cond = threading.Condition()
+        # tasks running or queued in all pools
+        self.busy = 0
+        self.queued = 0
+
+    def busy_count(self):
+        return self.busy
+
+
+class WorkerPool:
+    """
+    Fixed set of worker threads that run submitted tasks
+
+    The threads are created once in start() and reused for every task. Tasks submitted while all
+    workers are busy wait in a FairShareQueue, in FIFO order unless enqueue() gives them a priority
+    or a user. With a WorkerBudget, a task also waits until the budget allows another running task.
+    """
+    def __init__(self, size, logger, name='worker', budget=None, weights=None):
+        """
+        :param size: int : number of worker threads
+        :param logger: logging.Logger
+        :param name: str : prefix for the thread names
+        :param budget: WorkerBudget : limit shared with other pools, None for no limit beyond size
+        :param weights: dict : user -> share of the workers while tasks of several users wait, see FairShareQueue
+        """
+        self._size = size
+        self._logger = logger
+        self._name = name
+        self._budget = budget
+        self._tasks = FairShareQueue(weights)
+        self._busy = 0
+        self._running = False
+        self._cond = budget.cond if budget else threading.Condition()
+        # worker threads alive, more than size for a while after resize() made the pool smaller
+        self._threads = 0
+        self._thread_seq = itertools.count()
+
+    def start(self):
+        with self._cond:
+            self._running = True
+            self._start_threads()
+
+    def _start_threads(self):
+        while self._threads < self._size:
+            th = threading.Thread(target=self._worker_thread, name='%s-%d' % (self._name, next(self._thread_seq)))
+            th.daemon = True
+            th.start()
+            self._threads += 1
+
+    def resize(self, size):
+        """
+        Changes the number of worker threads -- when shrinking, busy workers exit after their current task
+
+        :param size: int
+        """
+        with self._cond:
+            self._size = size
+            if self._running:
+                self._start_threads()
+            self._cond.notify_all()
+
+    def stop(self):
+        """
+        Lets idle workers exit and wakes up callers of wait_for_free_slot() -- running tasks are not interrupted, queued ones are dropped
+        """
+        with self._cond:
+            self._running = False
+            if self._budget:
+                self._budget.queued -= len(self._tasks)
+            self._tasks.clear()
+            self._cond.notify_all()
+
+    def take_queued(self):
+        """
+        Removes the tasks waiting for a free worker without running them
+
+        :return: list of (function, tuple) : the tasks and their arguments, in the order they would have run
+        """
+        with self._cond:
+            tasks = []
+            while self._tasks:
+                tasks.append(self._tasks.pop())
+            if self._budget:
+                self._budget.queued -= len(tasks)
+            self._cond.notify_all()
+            return tasks
+
+    def submit(self, fn, *args):
+        self.enqueue(fn, args)
+
+    def enqueue(self, fn, args, priority=0, user='', group=''):
+        """
+        Submits a task to run in the order of the FairShareQueue
+
+        :param fn: function
+        :param args: tuple
+        :param priority: int : higher runs first
+        :param user: str
+        :param group: str : e.g. the reservation id
+        """
+        with self._cond:
+            self._tasks.push((fn, args), priority, user, group)
+            if self._budget:
+                self._budget.queued += 1
+            self._cond.notify_all()
+
+    def full(self):
+        """
+        :return: bool : True if a task submitted now would have to wait in the queue
+        """
+        with self._cond:
+            return self._full()
+
+    def _full(self):
+        if self._busy + len(self._tasks) >= self._size:
+            return True
+        return self._budget is not None and self._budget.busy + self._budget.queued >= self._budget.size
+
+    def wait_for_free_slot(self, timeout, cancel=None):
+        """
+        Blocks until a worker is idle with nothing queued for it, the pool is stopped, or timeout seconds have passed
+
+        :param timeout: float
+        :param cancel: function with no arguments : checked whenever the pool changes, stops waiting when it returns True
+        :return: bool : True if a worker is free
+        """
+        deadline = time() + timeout
+        with self._cond:
+            while self._running and self._full() and not (cancel and cancel()):
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return not self._full()
+
+    def wait_idle(self, timeout):
+        """
+        Blocks until no task is running or queued, or timeout seconds have passed
+
+        :param timeout: float
+        :return: bool : True if idle
+        """
+        deadline = time() + timeout
+        with self._cond:
+            while self._busy or self._tasks:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return not self._busy and not self._tasks
+
+    def size(self):
+        return self._size
+
+    def busy_count(self):
+        """
+        :return: int : number of workers currently running a task
+        """
+        return self._busy
+
+    def queue_depth(self):
+        """
+        :return: int : number of tasks waiting for a free worker
+        """
+        return len(self._tasks)
+
+    def _worker_thread(self):
+        while True:
+            with self._cond:
+                while self._running and self._threads <= self._size and (not self._tasks or (self._budget and self._budget.busy >= self._budget.size)):
+                    self._cond.wait()
+                if not self._running or self._threads > self._size:
+                    self._threads -= 1
+                    return
+                fn, args = self._tasks.pop()
+                self._busy += 1
+                if self._budget:
+                    self._budget.queued -= 1
+                    self._budget.busy += 1
+            try:
+                fn(*args)
+            except Exception as e:
+                self._logger.error('Unhandled exception in %s thread: %s: %s' % (self._name, str(e), traceback.format_exc()))
+            finally:
+                with self._cond:
+                    self._busy -= 1
+                    if self._budget:
+                        self._budget.busy -= 1
+                    self._cond.notify_all()
+
+
+class ReservationCache:
+    """
+    LRU cache of reservation JSON with a time to live
+
+    Concurrent lookups of a reservation that is not cached share a single call to the loader.
+    Failed lookups are not cached.
+    """
+    class _Flight:
+        def __init__(self):
+            self.event = threading.Event()
+            self.value = None
+            self.error = None
+
+    def __init__(self, ttl=30, max_size=100):
+        """
+        :param ttl: float : seconds a fetched reservation is served from the cache
+        :param max_size: int : maximum number of reservations kept, least recently used are evicted first
+        """
+        self._ttl = ttl
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def peek(self, reservation_id):
+        """
+        :param reservation_id: str
+        :return: str : the cached reservation JSON, None if it is not cached or expired
+        """
+        with self._lock:
+            entry = self._entries.get(reservation_id)
+            if entry is not None and entry[0] > time():
+                return entry[1]
+            return None
+
+    def get(self, reservation_id, loader):
+        """
+        :param reservation_id: str
+        :param loader: function taking reservation_id and returning the reservation JSON, called on a cache miss
+        :return: str
+        :raises: Exception : whatever the loader raised
+        """
+        with self._lock:
+            entry = self._entries.pop(reservation_id, None)
+            if entry is not None and entry[0] > time():
+                self._entries[reservation_id] = entry
+                return entry[1]
+            flight = self._flights.get(reservation_id)
+            leader = flight is None
+            if leader:
+                flight = ReservationCache._Flight()
+                self._flights[reservation_id] = flight
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader(reservation_id)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if flight.error is None:
+                    self._entries[reservation_id] = (time() + self._ttl, flight.value)
+                    while len(self._entries) > self._max_size:
+                        self._entries.popitem(last=False)
+                del self._flights[reservation_id]
+            flight.event.set()
+        return flight.value
+
+
 class CommandResult:
     """
     Base class for command results
@@ -64,14 +997,65 @@ class CommandResult:
         self.report_filename = ''
         self.report_data = ''
         self.report_mime_type = ''
+        self.report_path = ''
+        self.delete_report_after_upload = False
+        # optional details for the handler's own use, not sent to CloudShell, e.g. a dict summarizing the test results
+        self.summary = None
+        # optional dict of the resources the command used, e.g. CPU seconds and peak memory -- logged with the result
+        self.resource_usage = None
+        # optional function with no arguments called once the report source is no longer needed, e.g. to release the directory it is read from
+        self.on_report_discarded = None
+
+    def _set_report(self, report_filename, report_data, report_mime_type, report_path, delete_report_after_upload):
+        self.report_filename = report_filename
+        self.report_data = report_data
+        self.report_mime_type = report_mime_type
+        self.report_path = report_path
+        self.delete_report_after_upload = delete_report_after_upload
+
+    def open_report(self):
+        """
+        Opens the report for uploading without loading it into memory if it comes from a file
+
+        :return: (bytes or file-like, int) : report body and its length in bytes, None if the length is unknown
+        """
+        if self.report_path:
+            return open(self.report_path, 'rb'), os.path.getsize(self.report_path)
+        if hasattr(self.report_data, 'read'):
+            try:
+                length = os.fstat(self.report_data.fileno()).st_size - self.report_data.tell()
+            except Exception:
+                length = None
+            return self.report_data, length
+        data = bytes23(self.report_data)
+        return data, len(data)
+
+    def discard_report(self):
+        """
+        Releases the report source after it was uploaded or could not be -- deletes report_path if delete_report_after_upload was set
+        """
+        if hasattr(self.report_data, 'close'):
+            self.report_data.close()
+        if self.report_path and self.delete_report_after_upload:
+            try:
+                os.remove(self.report_path)
+            except OSError:
+                pass
+        callback, self.on_report_discarded = self.on_report_discarded, None
+        if callback:
+            callback()
 
     def __repr__(self):
         d = self.report_data
         try:
             if isinstance(self.report_data, bytes):
                 d = '(binary data)'
+            elif hasattr(self.report_data, 'read'):
+                d = '(stream)'
         except:
             pass
+        if self.report_path:
+            d = '(file %s)' % self.report_path
         return '%s result=%s error_name=%s error_description=%s report_filename=%s report_data=<<<%s>>> report_mime_type=%s' % (
             self.__class__.__name__,
             self.result,
@@ -95,36 +1079,51 @@ class CompletedCommandResult(CommandResult):
     """
     Result that makes no comment on success or failure -- includes output file
     """
-    def __init__(self, report_filename, report_data, report_mime_type='text/plain'):
+    def __init__(self, report_filename, report_data, report_mime_type='text/plain', report_path='', delete_report_after_upload=False):
+        """
+        :param report_filename: str : name of the report file as shown in CloudShell
+        :param report_data: str, bytes or file-like : report contents -- ignored if report_path is set
+        :param report_mime_type: str
+        :param report_path: str : file to upload as the report -- streamed from disk instead of being held in memory
+        :param delete_report_after_upload: bool : delete report_path once it has been uploaded
+        """
         CommandResult.__init__(self)
         self.result = 'Completed'
-        self.report_filename = report_filename
-        self.report_data = report_data
-        self.report_mime_type = report_mime_type
+        self._set_report(report_filename, report_data, report_mime_type, report_path, delete_report_after_upload)
 
 
 class PassedCommandResult(CommandResult):
     """
     Result of a test considered to have passed -- includes output file
     """
-    def __init__(self, report_filename, report_data, report_mime_type='text/plain'):
+    def __init__(self, report_filename, report_data, report_mime_type='text/plain', report_path='', delete_report_after_upload=False):
+        """
+        :param report_filename: str : name of the report file as shown in CloudShell
+        :param report_data: str, bytes or file-like : report contents -- ignored if report_path is set
+        :param report_mime_type: str
+        :param report_path: str : file to upload as the report -- streamed from disk instead of being held in memory
+        :param delete_report_after_upload: bool : delete report_path once it has been uploaded
+        """
         CommandResult.__init__(self)
         self.result = 'Passed'
-        self.report_filename = report_filename
-        self.report_data = report_data
-        self.report_mime_type = report_mime_type
+        self._set_report(report_filename, report_data, report_mime_type, report_path, delete_report_after_upload)
 
 
 class FailedCommandResult(CommandResult):
     """
     Result of a test considered to have failed -- still includes output file
     """
-    def __init__(self, report_filename, report_data, report_mime_type='text/plain'):
+    def __init__(self, report_filename, report_data, report_mime_type='text/plain', report_path='', delete_report_after_upload=False):
+        """
+        :param report_filename: str : name of the report file as shown in CloudShell
+        :param report_data: str, bytes or file-like : report contents -- ignored if report_path is set
+        :param report_mime_type: str
+        :param report_path: str : file to upload as the report -- streamed from disk instead of being held in memory
+        :param delete_report_after_upload: bool : delete report_path once it has been uploaded
+        """
         CommandResult.__init__(self)
         self.result = 'Failed'
-        self.report_filename = report_filename
-        self.report_data = report_data
-        self.report_mime_type = report_mime_type
+        self._set_report(report_filename, report_data, report_mime_type, report_path, delete_report_after_upload)
 
 
 class ErrorCommandResult(CommandResult):
@@ -186,6 +1185,24 @@ class CustomExecutionServerCommandHandler:
         """
         pass
 
+    def get_priority(self, test_path, test_arguments, username, reservation_id, get_reservation_json):
+        """
+        Returns the priority of a start command while it waits for a free slot, higher runs first
+
+        Called for every start command before it is queued, so it should be quick. Only a command that has to
+        wait gets its reservation; for one that starts right away, get_reservation_json returns '' without a
+        request, as its priority doesn't matter. A reservation that is not cached is fetched in a thread of its
+        own before the command is queued, never in the poll thread.
+
+        :param test_path: str
+        :param test_arguments: str
+        :param username: str
+        :param reservation_id: str
+        :param get_reservation_json: function returning the reservation JSON, '' without a reservation -- fetched on the first call and cached for execute_command()
+        :return: int
+        """
+        return 0
+
 
 class CustomExecutionServer:
     def __init__(self, server_name, server_description, server_type, server_capacity,
@@ -197,13 +1214,29 @@ class CustomExecutionServer:
                  cloudshell_password='admin',
                  cloudshell_domain='Global',
                  auto_register=True,
-                 auto_start=True):
+                 auto_start=True,
+                 connection_pool_size=4,
+                 connection_idle_timeout=30,
+                 saturated_poll_interval=15,
+                 reservation_cache_ttl=30,
+                 reservation_cache_size=100,
+                 metrics=None,
+                 outbox_directory=None,
+                 outbox_uploaders=2,
+                 outbox_max_backoff=300,
+                 request_timeout=120,
+                 api=None,
+                 worker_budget=None,
+                 status_scheduler=None,
+                 capacity_controller=None,
+                 retry_policies=None,
+                 fair_share_weights=None):
         """
 
         :param server_name: str : unique name for registering execution server in CloudShell
         :param server_description: str : description to use when registering the execution server
         :param server_type: str : an execution server type registered manually in CloudShell beforehand
-        :param server_capacity: int : number of concurrent commands CloudShell should send us
+        :param server_capacity: int : number of concurrent commands CloudShell should send us -- also the number of local worker threads, so no more than this many commands ever run at once
 
         :param command_handler: CustomExecutionServerCommandHandler : your custom implementation of CustomExecutionServerCommandHandler
 
@@ -217,6 +1250,29 @@ class CustomExecutionServer:
 
         :param auto_register: bool : automatically register this execution server in CloudShell from the constructor, ignoring 'already registered' error
         :param auto_start: bool : automatically start the server threads from in the constructor - what to do next, including keeping the process alive, is up to you
+
+        :param connection_pool_size: int : maximum number of idle keep-alive connections to CloudShell kept open between requests
+        :param connection_idle_timeout: float : seconds after which an idle connection to CloudShell is closed instead of reused
+        :param saturated_poll_interval: float : while all worker slots are busy, seconds between polls -- the poll is still needed to receive stop commands; a start command received then is queued until a slot frees up
+        :param reservation_cache_ttl: float : seconds the JSON of a reservation is reused for further commands in the same reservation
+        :param reservation_cache_size: int : maximum number of reservations kept in the cache
+
+        :param metrics: Metrics : registry to record API latencies, execution phases and slot usage in -- share it with your command handler to add its own phases; a private one is created if not given
+
+        :param outbox_directory: str : if set, results are stored in a durable outbox in this directory and delivered to CloudShell by background uploader threads with retries, freeing the worker slot as soon as the command returns; results not yet delivered are sent after a restart
+        :param outbox_uploaders: int : number of uploader threads delivering results from the outbox in parallel
+        :param outbox_max_backoff: float : maximum seconds between delivery attempts of a result while CloudShell is failing
+
+        :param request_timeout: float : seconds to wait for CloudShell to accept a connection or send data before a request fails, None to wait indefinitely
+
+        :param api: CloudShellAPI : logged in session shared with other servers in this process -- the cloudshell_* and connection parameters are ignored then; the server logs in with its own session if not given
+        :param worker_budget: WorkerBudget : limit on the commands running at once shared with other servers in this process, in addition to server_capacity
+        :param status_scheduler: StatusScheduler : sends the Status heartbeat of this server along with those of other servers instead of a thread of its own
+        :param capacity_controller: CapacityController : raises and lowers server_capacity while the server runs according to the load of the host
+        :param retry_policies: dict : path prefix -> RetryPolicy for the requests to CloudShell, see CloudShellAPI
+        :param fair_share_weights: dict : UserName -> weight: start commands waiting for a slot are run by priority, see
+        CustomExecutionServerCommandHandler.get_priority(), then shared between users by these weights (default 1)
+        and between the reservations of a user equally, see FairShareQueue
         """
         self._cloudshell_host = cloudshell_host
         self._cloudshell_port = cloudshell_port
@@ -233,22 +1289,60 @@ class CustomExecutionServer:
         self._command_handler = command_handler
 
         self._execution_ids = set()
+        # start commands received and not running yet, see _command_worker_thread()
+        self._queued_ids = set()
+        # only executions queued or running here, so the ids of unknown executions don't pile up
         self._stopped_ids = set()
 
         self._running = False
+        # set by stop() to interrupt the waits of the server threads
+        self._stop_event = threading.Event()
+        # no new commands are taken, see drain()
+        self._draining = False
+        # executions stopped by drain() because they didn't finish in time
+        self._abandoned_ids = set()
         self._threads = []
-
-        self._counter = itertools.count()
-
-        self._token = None
-        _, body = self._request('put', '/API/Auth/login',
-                                data=json.dumps({
-                                    'Username': cloudshell_username,
-                                    'Password': cloudshell_password,
-                                    'Domain': cloudshell_domain,
-                                }),
-                                hide_result=True)
-        self._token = body.replace('"', '')
+        self._saturated_poll_interval = saturated_poll_interval
+        # backoff between failed polls, the first retry is almost immediate so a single failure costs little
+        self._poll_retry_policy = RetryPolicy(base_delay=1, max_delay=30)
+        self._worker_budget = worker_budget
+        self._status_scheduler = status_scheduler
+        self._capacity_controller = capacity_controller
+        self._fair_share_weights = fair_share_weights
+        self._worker_pool = WorkerPool(server_capacity, logger, name='%s-worker' % server_name, budget=worker_budget, weights=fair_share_weights)
+        self._reservation_cache = ReservationCache(ttl=reservation_cache_ttl, max_size=reservation_cache_size)
+
+        self._metrics = metrics or Metrics()
+        self._metrics.define_histogram('ces_poll_slot_wait_seconds', 'Time the poll loop waited for a free worker slot')
+        self._metrics.define_histogram('ces_execution_phase_seconds', 'Duration of execution phases')
+        self._metrics.define_histogram('ces_queue_wait_seconds', 'Time start commands waited for a free worker slot by priority')
+        self._metrics.define_counter('ces_executions_total', 'Finished executions by result')
+        self._metrics.define_counter('ces_capacity_changes_total', 'Capacity changes by the capacity controller by direction')
+        self._metrics.define_gauge('ces_executions_in_flight', 'Executions started and not yet reported', lambda: len(self._execution_ids), server=server_name)
+        self._metrics.define_gauge('ces_worker_slots', 'Number of worker slots', lambda: self._worker_pool.size(), server=server_name)
+        self._metrics.define_gauge('ces_worker_slots_busy', 'Number of busy worker slots', lambda: self._worker_pool.busy_count(), server=server_name)
+        self._metrics.define_gauge('ces_queued_commands', 'Start commands waiting for a free worker slot', lambda: self._worker_pool.queue_depth(), server=server_name)
+
+        if outbox_directory:
+            self._outbox = Outbox(outbox_directory, logger, max_backoff=outbox_max_backoff)
+            self._metrics.define_gauge('ces_outbox_pending', 'Results waiting in the outbox to be delivered to CloudShell', lambda: self._outbox.size(), server=server_name)
+            self._metrics.define_counter('ces_outbox_deliveries_total', 'Result delivery attempts from the outbox by outcome')
+        else:
+            self._outbox = None
+        self._outbox_uploaders = outbox_uploaders
+
+        if api is None:
+            api = CloudShellAPI(cloudshell_host, cloudshell_port, cloudshell_username, cloudshell_password, cloudshell_domain,
+                                logger, self._metrics,
+                                connection_pool_size=connection_pool_size,
+                                connection_idle_timeout=connection_idle_timeout,
+                                request_timeout=request_timeout,
+                                retry_policies=retry_policies)
+            api.login()
+            self._owns_api = True
+        else:
+            self._owns_api = False
+        self._api = api
 
         if auto_register:
             try:
@@ -287,42 +1381,173 @@ class CustomExecutionServer:
                           'Capacity': self._server_capacity,
                       }))
 
+    def capacity(self):
+        """
+        :return: int : capacity currently advertised to CloudShell
+        """
+        return self._server_capacity
+
+    def set_capacity(self, capacity):
+        """
+        Advertises a new capacity to CloudShell and resizes the worker pool to match
+
+        :param capacity: int
+        """
+        old_capacity = self._server_capacity
+        self._server_capacity = capacity
+        try:
+            self.update()
+        except Exception:
+            self._server_capacity = old_capacity
+            raise
+        self._worker_pool.resize(capacity)
+        self._metrics.inc('ces_capacity_changes_total', server=self._server_name, direction='up' if capacity > old_capacity else 'down')
+
     def start(self):
+        if self._owns_api:
+            # stop() aborted it
+            self._api.reopen()
         self._threads = []
         self._running = True
-        th = threading.Thread(target=self._status_update_thread)
-        # th.daemon = True
-        th.start()
-        self._threads.append(th)
+        self._draining = False
+        self._stop_event.clear()
+        self._worker_pool = WorkerPool(self._server_capacity, self._logger, name='%s-worker' % self._server_name, budget=self._worker_budget,
+                                       weights=self._fair_share_weights)
+        self._worker_pool.start()
+        if self._status_scheduler:
+            self._status_scheduler.add(self)
+        else:
+            th = threading.Thread(target=self._status_update_thread)
+            # th.daemon = True
+            th.start()
+            self._threads.append(th)
         th = threading.Thread(target=self._command_poll_thread)
         # th.daemon = True
         th.start()
         self._threads.append(th)
+        if self._outbox:
+            for i in range(self._outbox_uploaders):
+                th = threading.Thread(target=self._outbox_upload_thread, name='%s-uploader-%d' % (self._server_name, i))
+                th.start()
+                self._threads.append(th)
+        if self._capacity_controller:
+            self._capacity_controller.start(self)
 
     def stop(self):
+        """
+        Stops the server threads, cutting off requests to CloudShell in progress -- running executions are not
+        interrupted, see drain()
+        """
+        self._signal_stop()
+        if self._owns_api:
+            self._api.close(abort=True)
+        self._join()
+
+    def _signal_stop(self):
         self._running = False
+        self._stop_event.set()
+        self._worker_pool.stop()
+        if self._status_scheduler:
+            self._status_scheduler.remove(self)
+        if self._capacity_controller:
+            self._capacity_controller.stop()
+
+    def _join(self):
         for th in self._threads:
             th.join()
         self._threads = []
+        if self._owns_api:
+            self._api.close()
 
-    def _status_update_thread(self):
-        while self._running:
+    def drain(self, timeout, grace=30):
+        """
+        Stops starting new commands and waits for the running executions to finish, for a restart without losing them
+
+        Start commands already received but waiting for a slot are taken out of the queue and finished as errors
+        right away. Polling goes on so stop commands for the running executions are still received; start commands
+        received meanwhile are finished as errors too. Executions still running after timeout seconds are stopped
+        with CustomExecutionServerCommandHandler.stop_command() and finished as errors, waiting up to grace more
+        seconds for their results to be sent. Call stop() afterwards.
+
+        :param timeout: float : seconds
+        :param grace: float : seconds
+        :return: bool : True if all executions finished in time
+        """
+        self._draining = True
+        for _, args in self._worker_pool.take_queued():
+            execution_id = args[2]
+            self._queued_ids.discard(execution_id)
+            if execution_id in self._stopped_ids:
+                # the Stopped result was already sent
+                self._stopped_ids.remove(execution_id)
+                continue
             try:
-                self._request('post', '/API/Execution/Status',
-                              data=json.dumps({
-                                  'Name': self._server_name,
-                                  'ExecutionIds': list(self._execution_ids),
-                              }))
+                self._finish_not_started(execution_id)
+            except Exception as e:
+                self._logger.error('Failed to finish queued execution %s: %s' % (execution_id, str(e)))
+        self._logger.info('Draining: waiting up to %d seconds for %d running executions' % (timeout, self._worker_pool.busy_count()))
+        if self._worker_pool.wait_idle(timeout):
+            self._logger.info('Drained')
+            return True
+        for execution_id in list(self._execution_ids):
+            self._logger.warning('Execution %s did not finish within %d seconds - stopping it' % (execution_id, timeout))
+            self._abandoned_ids.add(execution_id)
+            try:
+                self._command_handler.stop_command(execution_id, self._logger)
             except Exception as e:
-                self._logger.warn(str(e))
+                self._logger.error('Failed to stop execution %s: %s' % (execution_id, str(e)))
+        if not self._worker_pool.wait_idle(grace):
+            self._logger.error('Executions still running after draining: %s' % ', '.join(self._execution_ids))
+        return False
 
-            for _ in range(60):
-                sleep(1)
-                if not self._running:
-                    break
+    def busy_slots(self):
+        """
+        :return: int : number of commands currently executing
+        """
+        return self._worker_pool.busy_count()
+
+    def queued_commands(self):
+        """
+        :return: int : number of start commands received but waiting for a free slot
+        """
+        return self._worker_pool.queue_depth()
+
+    def send_status(self):
+        """
+        Sends the Status heartbeat with the ids of the executions in progress
+        """
+        try:
+            execution_ids = set(self._execution_ids)
+            if self._outbox:
+                # not finished as far as CloudShell knows until the result is delivered
+                execution_ids.update(self._outbox.pending_execution_ids())
+            self._request('post', '/API/Execution/Status',
+                          data=json.dumps({
+                              'Name': self._server_name,
+                              'ExecutionIds': list(execution_ids),
+                          }))
+        except Exception as e:
+            self._logger.warn(str(e))
+
+    def _status_update_thread(self):
+        while self._running:
+            self.send_status()
+            self._stop_event.wait(60)
 
     def _command_poll_thread(self):
+        # consecutive failed polls
+        failures = 0
         while self._running:
+            # while draining nothing is started, only stop commands matter
+            if not self._draining:
+                with self._metrics.timer('ces_poll_slot_wait_seconds'):
+                    # drain() wakes this up with take_queued() to receive stop commands right away
+                    free = self._worker_pool.wait_for_free_slot(self._saturated_poll_interval, lambda: self._draining)
+                if not free and not self._draining:
+                    if not self._running:
+                        break
+                    self._logger.info('All %d slots busy with %d commands queued - polling anyway to receive stop commands' % (
+                        self._worker_pool.size(), self._worker_pool.queue_depth()))
             try:
                 self._logger.info('Poll...')
 
@@ -332,9 +1557,17 @@ class CustomExecutionServer:
                                   }))
                 self._logger.info('Poll returned')
             except Exception as e:
-                self._logger.warn('%s: Sleeping 30 seconds to wait for CloudShell to recover...' % str(e))
-                sleep(30)
+                if not self._running:
+                    break
+                failures += 1
+                if isinstance(e, CircuitOpenError):
+                    delay = e.retry_after
+                else:
+                    delay = self._poll_retry_policy.delay(failures)
+                self._logger.warn('%s: Sleeping %.1f seconds to wait for CloudShell to recover...' % (str(e), delay))
+                self._stop_event.wait(delay)
                 continue
+            failures = 0
 
             if code == 204:
                 continue
@@ -346,32 +1579,32 @@ class CustomExecutionServer:
             self._logger.debug('command request %s' % o)
             command_type = o['Type']
             execution_id = o['ExecutionId']
-            if command_type == 'startExecution':
-                resid = o.get('ReservationId', '')
-                if resid:
-                    _, reservation_json = self._request('get', '/API/Execution/Reservations/%s' % resid)
+            if command_type == 'startExecution' and self._draining:
+                # already taken from CloudShell, too late to leave it for the next server
+                self._finish_not_started(execution_id)
+            elif command_type == 'startExecution':
+                test_path = o.get('TestPath', '')
+                test_arguments = o.get('TestArguments', '')
+                username = o.get('UserName', '')
+                reservation_id = o.get('ReservationId', '')
+                args = (test_path, test_arguments, execution_id, username, reservation_id, time())
+                self._queued_ids.add(execution_id)
+                if reservation_id and self._worker_pool.full() and self._reservation_cache.peek(reservation_id) is None:
+                    # the priority may depend on the reservation: fetched off the poll thread so stop commands
+                    # keep coming in -- the command has to wait for a slot anyway
+                    th = threading.Thread(target=self._enqueue_start, args=args + (True,), name='%s-priority' % self._server_name)
+                    th.daemon = True
+                    th.start()
                 else:
-                    reservation_json = ''
-
-                th = threading.Thread(target=self._command_worker_thread, args=(
-                    o.get('TestPath', ''),
-                    o.get('TestArguments', ''),
-                    execution_id,
-                    o.get('UserName', ''),
-                    resid,
-                    reservation_json
-                ))
-                th.daemon = True
-                th.start()
+                    self._enqueue_start(*(args + (False,)))
             elif command_type == 'stopExecution':
-                self._stopped_ids.add(execution_id)
-                self._command_handler.stop_command(execution_id, self._logger)
-                self._request('put', '/API/Execution/FinishedExecution',
-                              data=json.dumps({
-                                  'Name': self._server_name,
-                                  'ExecutionId': execution_id,
-                                  'Result': 'Stopped',
-                              }))
+                if execution_id in self._queued_ids or execution_id in self._execution_ids:
+                    self._stopped_ids.add(execution_id)
+                    self._command_handler.stop_command(execution_id, self._logger)
+                if self._outbox:
+                    self._outbox.add(execution_id, StoppedCommandResult())
+                else:
+                    self._send_finished(execution_id, 'Stopped')
             elif command_type == 'updateFiles':
                 # Must send this response or the execution server will be disabled
                 self._request('post', '/API/Execution/UpdateFilesEnded',
@@ -380,91 +1613,339 @@ class CustomExecutionServer:
                                   'ErrorMessage': ''
                               }))
 
-    def _command_worker_thread(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json):
+    def _fetch_reservation(self, reservation_id):
+        _, reservation_json = self._request('get', '/API/Execution/Reservations/%s' % reservation_id)
+        return reservation_json
+
+    def _enqueue_start(self, test_path, test_arguments, execution_id, username, reservation_id, received_at, fetch):
+        """
+        :param fetch: bool : fetch the reservation for the priority if it is not cached -- not in the poll thread
+        """
+        priority = self._get_priority(test_path, test_arguments, username, reservation_id, fetch)
+        self._worker_pool.enqueue(self._command_worker_thread,
+                                  (test_path, test_arguments, execution_id, username, reservation_id, priority, received_at),
+                                  priority=priority,
+                                  user=username,
+                                  group=reservation_id)
+
+    def _get_priority(self, test_path, test_arguments, username, reservation_id, fetch=False):
+        def get_reservation_json():
+            # only worth a request if this command has to wait
+            if not reservation_id or not self._worker_pool.full():
+                return ''
+            if fetch:
+                return self._reservation_cache.get(reservation_id, self._fetch_reservation)
+            return self._reservation_cache.peek(reservation_id) or ''
+        try:
+            return int(self._command_handler.get_priority(test_path, test_arguments, username, reservation_id, get_reservation_json))
+        except Exception as e:
+            self._logger.warning('Failed to get the priority of test %s of %s, using 0: %s' % (test_path, username, str(e)))
+            return 0
+
+    def _finish_not_started(self, execution_id):
+        self._logger.info('Not starting execution %s: the execution server is shutting down' % execution_id)
+        result = ErrorCommandResult('Execution server shutdown', 'Execution server %s shut down before the execution started' % self._server_name)
+        if self._outbox:
+            self._outbox.add(execution_id, result)
+        else:
+            self._send_finished(execution_id, result.result, result.error_name, result.error_description)
+
+    def _command_worker_thread(self, test_path, test_arguments, execution_id, username, reservation_id, priority=0, queued_at=None):
+        if execution_id in self._stopped_ids:
+            # stopped while waiting in the queue -- the Stopped result was already sent
+            self._stopped_ids.remove(execution_id)
+            self._queued_ids.discard(execution_id)
+            return
+        if self._draining:
+            self._queued_ids.discard(execution_id)
+            self._finish_not_started(execution_id)
+            return
+        if queued_at is not None:
+            wait = time() - queued_at
+            self._metrics.observe('ces_queue_wait_seconds', wait, priority=str(priority))
+            self._metrics.record_phase(execution_id, 'queue', wait)
+        # added before it leaves _queued_ids so a stop command in between is not missed
         self._execution_ids.add(execution_id)
+        self._queued_ids.discard(execution_id)
         try:
+            if reservation_id:
+                with self._metrics.phase(execution_id, 'reservation'):
+                    reservation_json = self._reservation_cache.get(reservation_id, self._fetch_reservation)
+            else:
+                reservation_json = ''
+            if execution_id in self._stopped_ids:
+                self._stopped_ids.remove(execution_id)
+                self._execution_ids.remove(execution_id)
+                self._metrics.pop_phases(execution_id)
+                return
             self._logger.info(
                 'Executing test_path=%s test_arguments=%s execution_id=%s username=%s reservation_id=%s reservation_json=%s' % (
                     test_path, test_arguments, execution_id, username, reservation_id, reservation_json))
-            result = self._command_handler.execute_command(test_path, test_arguments, execution_id, username, reservation_id, reservation_json, self._logger)
+            t0 = time()
+            with self._metrics.phase(execution_id, 'execute'):
+                result = self._command_handler.execute_command(test_path, test_arguments, execution_id, username, reservation_id, reservation_json, self._logger)
+            # a stopped or failed to start run says nothing about how long the test takes
+            if self._capacity_controller and result and result.result in ('Passed', 'Failed'):
+                self._capacity_controller.observe_duration((test_path, test_arguments), time() - t0)
         except Exception as ek:
             if execution_id in self._stopped_ids:
                 self._stopped_ids.remove(execution_id)
+                self._execution_ids.remove(execution_id)
+                self._metrics.pop_phases(execution_id)
                 return
             else:
                 result = ErrorCommandResult('Unhandled Python exception', '%s: %s' % (str(ek), traceback.format_exc()))
 
         if not result:
             result = ErrorCommandResult('Internal error', 'CustomExecutionServerCommandHandler.execute_command() should return a CommandResult object or throw an exception')
+        if execution_id in self._abandoned_ids:
+            self._abandoned_ids.remove(execution_id)
+            result.discard_report()
+            result = ErrorCommandResult('Execution server shutdown', 'Execution server %s shut down before the execution finished' % self._server_name)
 
         self._logger.info('Result for execution %s: %s' % (execution_id, result))
+        if result.resource_usage:
+            self._logger.info('Execution %s resource usage: %s' % (execution_id, json.dumps(result.resource_usage, sort_keys=True)))
+        self._metrics.inc('ces_executions_total', result=result.result)
         try:
-            self._request('put', '/API/Execution/FinishedExecution',
-                          data=json.dumps({
-                              'Name': self._server_name,
-                              'ExecutionId': execution_id,
-                              'Result': result.result,
-                              'ErrorDescription': result.error_description,
-                              'ErrorName': result.error_name,
-                          }))
+            if self._outbox:
+                with self._metrics.phase(execution_id, 'outbox'):
+                    try:
+                        self._outbox.add(execution_id, result)
+                    except Exception as e:
+                        # e.g. a streamed report failed while it was copied -- the result must not get lost
+                        self._logger.error('Failed to store the report of execution %s: %s: %s' % (execution_id, str(e), traceback.format_exc()))
+                        result.discard_report()
+                        result = ErrorCommandResult('Report failure', 'Failed to create the report: %s' % str(e))
+                        self._outbox.add(execution_id, result)
+                return
+            with self._metrics.phase(execution_id, 'finished_execution'):
+                self._send_finished(execution_id, result.result, result.error_name, result.error_description)
             if result.report_filename:
-                self._request('post', '/API/Execution/ExecutionReport/%s/%s/%s' % (quote(self._server_name),
-                                                                                   execution_id,
-                                                                                   quote(result.report_filename)),
-                              headers={
-                                  'Accept': 'application/json',
-                                  'Content-Type': result.report_mime_type,
-                              },
-                              data=bytes23(result.report_data))
+                report, length = result.open_report()
+                try:
+                    with self._metrics.phase(execution_id, 'report_upload'):
+                        self._send_report(execution_id, result.report_filename, result.report_mime_type, report, length)
+                finally:
+                    if hasattr(report, 'close'):
+                        report.close()
         finally:
+            result.discard_report()
+            # stopped after it finished executing
+            self._stopped_ids.discard(execution_id)
             self._execution_ids.remove(execution_id)
+            self._logger.info('Execution %s timings: %s' % (execution_id, self._metrics.phase_summary(execution_id)))
+
+    def _send_finished(self, execution_id, result, error_name=None, error_description=None):
+        data = {
+            'Name': self._server_name,
+            'ExecutionId': execution_id,
+            'Result': result,
+        }
+        if error_name is not None:
+            data['ErrorDescription'] = error_description
+            data['ErrorName'] = error_name
+        self._request('put', '/API/Execution/FinishedExecution', data=json.dumps(data))
+
+    def _send_report(self, execution_id, report_filename, report_mime_type, report, length):
+        headers = {
+            'Accept': 'application/json',
+            'Content-Type': report_mime_type,
+        }
+        if length is not None:
+            headers['Content-Length'] = str(length)
+        self._request('post', '/API/Execution/ExecutionReport/%s/%s/%s' % (quote(self._server_name),
+                                                                           execution_id,
+                                                                           quote(report_filename)),
+                      headers=headers,
+                      data=report)
+
+    def _outbox_upload_thread(self):
+        while self._running:
+            entry = self._outbox.take(1)
+            if entry is None:
+                continue
+            try:
+                if not entry.finished:
+                    with self._metrics.timer('ces_execution_phase_seconds', phase='finished_execution'):
+                        self._send_finished(entry.execution_id, entry.result, entry.error_name, entry.error_description)
+                    self._outbox.mark_finished(entry)
+                if entry.report_filename:
+                    if not os.path.exists(entry.report_path):
+                        self._logger.error('Report %s of execution %s no longer exists - not uploading it' % (entry.report_path, entry.execution_id))
+                    else:
+                        with open(entry.report_path, 'rb') as report:
+                            with self._metrics.timer('ces_execution_phase_seconds', phase='report_upload'):
+                                self._send_report(entry.execution_id, entry.report_filename, entry.report_mime_type,
+                                                  report, os.path.getsize(entry.report_path))
+                self._outbox.complete(entry)
+                self._metrics.inc('ces_outbox_deliveries_total', outcome='delivered')
+                self._logger.info('Delivered result of execution %s' % entry.execution_id)
+            except CloudShellAPIError as e:
+                if e.is_permanent():
+                    self._logger.error('CloudShell rejected the result of execution %s - dropping it: %s' % (entry.execution_id, str(e)))
+                    self._outbox.complete(entry)
+                    self._metrics.inc('ces_outbox_deliveries_total', outcome='dropped')
+                else:
+                    self._retry_outbox_entry(entry, e)
+            except Exception as e:
+                self._retry_outbox_entry(entry, e)
+
+    def _retry_outbox_entry(self, entry, error):
+        delay = self._outbox.retry_later(entry)
+        self._metrics.inc('ces_outbox_deliveries_total', outcome='retry')
+        self._logger.warn('Delivering result of execution %s failed (attempt %d), retrying in %.1f seconds: %s' % (
+            entry.execution_id, entry.attempts, delay, str(error)))
 
     def _request(self, method, path, data=None, headers=None, hide_result=False, **kwargs):
-        if sys.version_info.major == 3:
-            counter = self._counter.__next__()
-        else:
-            counter = self._counter.next()
-        if not headers:
-            headers = {
-                'Accept': 'application/json',
-                'Content-Type': 'application/json',
-            }
-        if self._token:
-            headers['Authorization'] = 'Basic ' + self._token
+        return self._api.request(method, path, data=data, headers=headers, hide_result=hide_result)
 
-        if path.startswith('/'):
-            path = path[1:]
 
-        url = 'http://%s:%d/%s' % (self._cloudshell_host, self._cloudshell_port, path)
+class StatusScheduler:
+    """
+    One thread sending the Status heartbeats of several servers, one after the other, every interval seconds
+    """
+    def __init__(self, logger, interval=60):
+        self._logger = logger
+        self._interval = interval
+        self._servers = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
 
-        if sys.version_info.major == 2:
-            if isinstance(url, unicode):
-                url = url.encode('ascii')
-            headers = dict((k.encode('ascii') if isinstance(k, unicode) else k,
-                            v.encode('ascii') if isinstance(v, unicode) else v)
-                           for k, v in headers.items())
+    def add(self, server):
+        """
+        :param server: CustomExecutionServer : its heartbeat is sent right away and then with the others
+        """
+        with self._lock:
+            self._servers.append(server)
+        server.send_status()
+
+    def remove(self, server):
+        with self._lock:
+            if server in self._servers:
+                self._servers.remove(server)
 
-        pdata = string23ppbinary(data)
-        pdata = re.sub(r':[^@]*@', ':(password hidden)@', pdata)
-        pdata = re.sub(r'"Password":\s*"[^"]*"', '"Password": "(password hidden)"', pdata)
-        pheaders = dict(headers)
-        if 'Authorization' in pheaders:
-            pheaders['Authorization'] = '(token hidden)'
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._status_thread, name='status')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
 
-        self._logger.debug('Request %d: %s %s headers=%s data=<<<%s>>>' % (counter, method, url, pheaders, pdata))
+    def _status_thread(self):
+        while not self._stop_event.wait(self._interval):
+            with self._lock:
+                servers = list(self._servers)
+            for server in servers:
+                server.send_status()
+
+
+class CustomExecutionServerHost:
+    """
+    Several execution servers, e.g. of different server types, in one process
 
-        request = Request(url, bytes23(data), headers)
-        request.get_method = lambda: method.upper()
-        response = urlopen(request)
-        body = response.read()
-        code = response.getcode()
-        response.close()
+    The servers share one logged in CloudShellAPI session with its connection pool, one StatusScheduler thread
+    for their heartbeats and, if max_workers is set, a WorkerBudget limiting the commands running in all of
+    them together; each server is still limited to its own capacity. Each server polls for its commands in a
+    thread of its own.
+    """
+    def __init__(self, logger,
+                 cloudshell_host='localhost',
+                 cloudshell_port=9000,
+                 cloudshell_username='admin',
+                 cloudshell_password='admin',
+                 cloudshell_domain='Global',
+                 max_workers=0,
+                 connection_pool_size=4,
+                 connection_idle_timeout=30,
+                 request_timeout=120,
+                 status_interval=60,
+                 metrics=None,
+                 retry_policies=None):
+        """
+        :param logger: logging.Logger
+        :param max_workers: int : maximum number of commands running in all servers together, 0 for only the capacity of each server
+        :param status_interval: float : seconds between Status heartbeats
+        :param metrics: Metrics : registry shared by all servers, a private one if not given
+        :param retry_policies: dict : path prefix -> RetryPolicy for the requests to CloudShell, see CloudShellAPI
 
-        if hide_result:
-            self._logger.debug('Result %d: %d: (hidden)' % (counter, code))
+        See CustomExecutionServer for the other parameters.
+        """
+        self._logger = logger
+        self._cloudshell_host = cloudshell_host
+        self._metrics = metrics or Metrics()
+        self._servers = []
+        self.api = CloudShellAPI(cloudshell_host, cloudshell_port, cloudshell_username, cloudshell_password, cloudshell_domain,
+                                 logger, self._metrics,
+                                 connection_pool_size=connection_pool_size,
+                                 connection_idle_timeout=connection_idle_timeout,
+                                 request_timeout=request_timeout,
+                                 retry_policies=retry_policies)
+        self.api.login()
+        self._status_scheduler = StatusScheduler(logger, interval=status_interval)
+        if max_workers:
+            self._worker_budget = WorkerBudget(max_workers)
+            self._metrics.define_gauge('ces_worker_budget', 'Maximum number of commands running in all servers of the process', lambda: max_workers)
+            self._metrics.define_gauge('ces_worker_budget_busy', 'Commands running in all servers of the process', self._worker_budget.busy_count)
         else:
-            self._logger.debug('Result %d: %d: %s' % (counter, code, string23ppbinary(body)))
+            self._worker_budget = None
 
-        if code >= 400:
-            raise Exception('Error: %d: %s' % (code, string23ppbinary(body)))
-        return code, string23(body)
+    def add_server(self, server_name, server_description, server_type, server_capacity, command_handler, auto_register=True, **kwargs):
+        """
+        Creates and registers a server sharing the session, heartbeat thread and worker budget of the host
+
+        :param kwargs: further parameters of CustomExecutionServer, e.g. outbox_directory -- each server needs its own outbox directory
+        :return: CustomExecutionServer : not started yet, see start()
+        """
+        server = CustomExecutionServer(server_name, server_description, server_type, server_capacity,
+                                       command_handler, self._logger,
+                                       cloudshell_host=self._cloudshell_host,
+                                       auto_register=auto_register,
+                                       auto_start=False,
+                                       metrics=self._metrics,
+                                       api=self.api,
+                                       worker_budget=self._worker_budget,
+                                       status_scheduler=self._status_scheduler,
+                                       **kwargs)
+        self._servers.append(server)
+        return server
+
+    def servers(self):
+        return list(self._servers)
+
+    def start(self):
+        # stop() aborted it
+        self.api.reopen()
+        self._status_scheduler.start()
+        for server in self._servers:
+            server.start()
+
+    def drain(self, timeout, grace=30):
+        """
+        Drains all servers at the same time, see CustomExecutionServer.drain()
+
+        :return: bool : True if all executions finished in time
+        """
+        results = {}
+        threads = [threading.Thread(target=lambda s=s: results.__setitem__(s, s.drain(timeout, grace))) for s in self._servers]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        return all(results.values())
+
+    def stop(self):
+        for server in self._servers:
+            server._signal_stop()
+        # wakes up polls waiting in CloudShell
+        self.api.close(abort=True)
+        for server in self._servers:
+            server._join()
+        self._status_scheduler.stop()
+        self.api.close()
@@ -13,6 +13,8 @@ def become_daemon_and_wait(on_start, on_exit, exit_signal=signal.SIGTERM):
     :return:
     """
     def handler0(signum, frame):
+        # a second signal while shutting down would run on_exit again from inside it
+        signal.signal(exit_signal, signal.SIG_IGN)
         on_exit()
         os._exit(0)
 
@@ -0,0 +1,146 @@
+import json
+import threading
+from collections import deque
+from time import time
+
+
+class LiveOutputChannel:
+    """
+    Recent events of one execution, bounded by total size
+
+    Publishing never blocks on readers: when the buffer is full the oldest events are dropped, and a
+    reader that falls behind skips them.
+    """
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._cond = threading.Condition()
+        # (seq, event, data)
+        self._events = deque()
+        self._bytes = 0
+        self._seq = 0
+        self.closed = False
+        self.closed_at = None
+
+    def publish(self, event, data):
+        with self._cond:
+            self._seq += 1
+            self._events.append((self._seq, event, data))
+            self._bytes += len(data)
+            while self._bytes > self._max_bytes and len(self._events) > 1:
+                self._bytes -= len(self._events.popleft()[2])
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self.closed_at = time()
+            self._cond.notify_all()
+
+    def read(self, after_seq, timeout):
+        """
+        Waits for events newer than after_seq
+
+        :param after_seq: int : seq of the last event the reader has seen, 0 for none
+        :param timeout: float : seconds
+        :return: (list of (int, str, str), int) : events (seq, event, data) and the number of events the reader missed because they were dropped -- no events on timeout or if the channel is closed
+        """
+        deadline = time() + timeout
+        with self._cond:
+            while self._seq <= after_seq and not self.closed:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return [], 0
+                self._cond.wait(remaining)
+            events = [e for e in self._events if e[0] > after_seq]
+            missed = events[0][0] - after_seq - 1 if events else 0
+            return events, missed
+
+
+class LiveOutputHub:
+    """
+    Channels of live events per execution id, served as Server-Sent Events
+
+    The command handler publishes console output and test progress with publish() while an execution runs.
+    Clients connect to GET /executions/<execution id> on a LocalHTTPServer, see add_routes(), and receive
+    the buffered events followed by new ones as they happen. GET /executions lists the execution ids.
+    """
+    def __init__(self, max_bytes=1000000, linger=60):
+        """
+        :param max_bytes: int : maximum size of the events buffered per execution
+        :param linger: float : seconds a closed channel can still be read, so clients can fetch the end of the output
+        """
+        self._max_bytes = max_bytes
+        self._linger = linger
+        self._lock = threading.Lock()
+        self._channels = {}
+
+    def open(self, execution_id):
+        with self._lock:
+            now = time()
+            for k in [k for k, c in self._channels.items() if c.closed and now - c.closed_at > self._linger]:
+                del self._channels[k]
+            self._channels[execution_id] = LiveOutputChannel(self._max_bytes)
+
+    def publish(self, execution_id, event, data):
+        """
+        :param execution_id: str
+        :param event: str : SSE event type, e.g. 'output' or 'robot'
+        :param data: str
+        """
+        channel = self._channels.get(execution_id)
+        if channel is not None:
+            channel.publish(event, data)
+
+    def close(self, execution_id):
+        channel = self._channels.get(execution_id)
+        if channel is not None:
+            channel.close()
+
+    def execution_ids(self):
+        with self._lock:
+            return sorted(self._channels.keys())
+
+    def add_routes(self, local_http_server, keepalive_interval=15):
+        """
+        :param local_http_server: LocalHTTPServer
+        :param keepalive_interval: float : seconds between SSE comments sent while there are no events, so idle connections are not dropped
+        """
+        def handle(request):
+            path = request.path.split('?')[0].rstrip('/')
+            if path == '/executions':
+                body = json.dumps(self.execution_ids()).encode('utf-8')
+                request.send_response(200)
+                request.send_header('Content-Type', 'application/json')
+                request.send_header('Content-Length', str(len(body)))
+                request.end_headers()
+                request.wfile.write(body)
+                return
+            channel = self._channels.get(path[len('/executions/'):])
+            if channel is None:
+                request.send_error(404)
+                return
+            try:
+                seq = int(request.headers.get('Last-Event-ID') or 0)
+            except ValueError:
+                seq = 0
+            request.send_response(200)
+            request.send_header('Content-Type', 'text/event-stream')
+            request.send_header('Cache-Control', 'no-cache')
+            request.end_headers()
+            while True:
+                events, missed = channel.read(seq, keepalive_interval)
+                lines = []
+                if missed:
+                    lines.append('event: dropped\ndata: %d\n\n' % missed)
+                for seq, event, data in events:
+                    lines.append('id: %d\nevent: %s\n%s\n\n' % (seq, event, '\n'.join('data: ' + line for line in data.split('\n'))))
+                if not events:
+                    if channel.closed:
+                        lines.append('event: end\ndata: \n\n')
+                    else:
+                        lines.append(': keepalive\n\n')
+                request.wfile.write(''.join(lines).encode('utf-8'))
+                request.wfile.flush()
+                if not events and channel.closed:
+                    return
+        local_http_server.add_route('/executions', handle)
@@ -0,0 +1,88 @@
+import sys
+import threading
+
+if sys.version_info.major == 2:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class LocalHTTPServer:
+    """
+    Small HTTP server for local monitoring endpoints, served from a background thread
+
+    Routes map a path prefix to a function taking the BaseHTTPRequestHandler of the request.
+    The function writes the whole response itself, so it can also stream.
+    """
+    def __init__(self, port, logger, bind_address='127.0.0.1'):
+        """
+        :param port: int
+        :param logger: logging.Logger
+        :param bind_address: str : interface to listen on -- the default only accepts connections from this host
+        """
+        self._port = port
+        self._bind_address = bind_address
+        self._logger = logger
+        self._routes = []
+        self._server = None
+
+    def add_route(self, prefix, function):
+        """
+        :param prefix: str : e.g. '/metrics'
+        :param function: function taking a BaseHTTPRequestHandler -- called in the thread serving the request
+        """
+        self._routes.append((prefix, function))
+        # longest prefix wins
+        self._routes.sort(key=lambda r: -len(r[0]))
+
+    def add_text_route(self, prefix, function, content_type='text/plain; version=0.0.4; charset=utf-8'):
+        """
+        :param prefix: str
+        :param function: function with no arguments returning the response body as a str
+        :param content_type: str
+        """
+        def handle(request):
+            body = function().encode('utf-8')
+            request.send_response(200)
+            request.send_header('Content-Type', content_type)
+            request.send_header('Content-Length', str(len(body)))
+            request.end_headers()
+            request.wfile.write(body)
+        self.add_route(prefix, handle)
+
+    def start(self):
+        routes = self._routes
+        logger = self._logger
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                for prefix, function in routes:
+                    if self.path == prefix or self.path.startswith(prefix.rstrip('/') + '/') or self.path.startswith(prefix + '?'):
+                        try:
+                            function(self)
+                        except Exception as e:
+                            logger.debug('Local HTTP request %s failed: %s' % (self.path, str(e)))
+                        return
+                self.send_error(404)
+
+            def log_message(self, fmt, *args):
+                logger.debug('Local HTTP: ' + fmt % args)
+
+        self._server = _ThreadingHTTPServer((self._bind_address, self._port), Handler)
+        th = threading.Thread(target=self._server.serve_forever)
+        th.daemon = True
+        th.start()
+        self._logger.info('Serving %s on http://%s:%d' % (', '.join(p for p, _ in self._routes), self._bind_address, self._port))
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,179 @@
+import threading
+from contextlib import contextmanager
+from time import time
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _escape(v):
+    return str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + list(extra or [])
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in items)
+
+
+class _Metric:
+    def __init__(self, name, kind, help_text, buckets=None):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.buckets = buckets
+        # sorted label tuple -> float for counters and gauges, [bucket counts, sum, count] for histograms
+        self.values = {}
+        # sorted label tuple -> function returning the value of a gauge
+        self.functions = {}
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters, gauges and histograms, rendered in the Prometheus text format
+
+    Also records how long each phase of an execution took, for a per-execution summary in the log.
+    Updating a metric that was not defined first defines it without help text.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._order = []
+        self._phases = {}
+
+    def _get(self, name, kind, help_text='', buckets=None):
+        m = self._metrics.get(name)
+        if m is None:
+            m = _Metric(name, kind, help_text, buckets)
+            self._metrics[name] = m
+            self._order.append(name)
+        return m
+
+    def define_counter(self, name, help_text):
+        with self._lock:
+            self._get(name, 'counter', help_text)
+
+    def define_gauge(self, name, help_text, function=None, **labels):
+        """
+        :param function: function with no arguments returning the current value -- called on every render() instead of storing a value;
+        defining the gauge again with other labels adds another function
+        """
+        with self._lock:
+            m = self._get(name, 'gauge', help_text)
+            if function is not None:
+                m.functions[tuple(sorted(labels.items()))] = function
+
+    def define_histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        with self._lock:
+            self._get(name, 'histogram', help_text, tuple(sorted(buckets)))
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            m = self._get(name, 'counter')
+            m.values[key] = m.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._get(name, 'gauge').values[key] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            m = self._get(name, 'histogram', buckets=DEFAULT_BUCKETS)
+            v = m.values.get(key)
+            if v is None:
+                v = [[0] * len(m.buckets), 0.0, 0]
+                m.values[key] = v
+            for i, b in enumerate(m.buckets):
+                if value <= b:
+                    v[0][i] += 1
+            v[1] += value
+            v[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observes the duration of the with block in histogram name
+        """
+        t0 = time()
+        try:
+            yield
+        finally:
+            self.observe(name, time() - t0, **labels)
+
+    @contextmanager
+    def phase(self, execution_id, phase):
+        """
+        Times a phase of an execution: observed in histogram ces_execution_phase_seconds and remembered for phase_summary()
+
+        :param execution_id: str
+        :param phase: str : e.g. 'checkout', 'robot'
+        """
+        t0 = time()
+        try:
+            yield
+        finally:
+            self.record_phase(execution_id, phase, time() - t0)
+
+    def record_phase(self, execution_id, phase, seconds):
+        """
+        Records a phase timed elsewhere, see phase()
+        """
+        self.observe('ces_execution_phase_seconds', seconds, phase=phase)
+        with self._lock:
+            self._phases.setdefault(execution_id, []).append((phase, seconds))
+
+    def pop_phases(self, execution_id):
+        """
+        :param execution_id: str
+        :return: list of (str, float) : phases recorded for execution_id and their durations in seconds, forgotten afterwards
+        """
+        with self._lock:
+            return self._phases.pop(execution_id, [])
+
+    def phase_summary(self, execution_id):
+        """
+        :param execution_id: str
+        :return: str : e.g. 'checkout=1.20s robot=35.02s', forgets the phases of execution_id
+        """
+        return ' '.join('%s=%.2fs' % (p, dt) for p, dt in self.pop_phases(execution_id))
+
+    def render(self):
+        """
+        :return: str : all metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = [self._metrics[n] for n in self._order]
+            snapshot = []
+            for m in metrics:
+                if m.kind == 'histogram':
+                    values = [(k, ([c for c in v[0]], v[1], v[2])) for k, v in m.values.items()]
+                else:
+                    values = list(m.values.items())
+                snapshot.append((m, sorted(values)))
+        lines = []
+        for m, values in snapshot:
+            if m.functions:
+                values = []
+                for labels, function in sorted(m.functions.items()):
+                    try:
+                        values.append((labels, function()))
+                    except Exception:
+                        pass
+            if m.help_text:
+                lines.append('# HELP %s %s' % (m.name, m.help_text))
+            lines.append('# TYPE %s %s' % (m.name, m.kind))
+            for labels, v in values:
+                if m.kind == 'histogram':
+                    counts, total, count = v
+                    for b, c in zip(m.buckets, counts):
+                        lines.append('%s_bucket%s %d' % (m.name, _format_labels(labels, [('le', repr(float(b)))]), c))
+                    lines.append('%s_bucket%s %d' % (m.name, _format_labels(labels, [('le', '+Inf')]), count))
+                    lines.append('%s_sum%s %r' % (m.name, _format_labels(labels), float(total)))
+                    lines.append('%s_count%s %d' % (m.name, _format_labels(labels), count))
+                else:
+                    lines.append('%s%s %r' % (m.name, _format_labels(labels), float(v)))
+        return '\n'.join(lines) + '\n'
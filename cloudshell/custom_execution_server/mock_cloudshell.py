@@ -0,0 +1,308 @@
+import errno
+import json
+import random
+import socket
+import sys
+import threading
+from collections import deque
+from time import sleep, time
+
+if sys.version_info.major == 2:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # the client gave up on a request, e.g. a poll held open while it stopped -- not worth a traceback
+        e = sys.exc_info()[1]
+        if isinstance(e, socket.error) and e.errno in (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED):
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+
+class MockExecution:
+    """
+    What the mock saw of one execution
+    """
+    def __init__(self, execution_id):
+        self.execution_id = execution_id
+        self.queued_at = None
+        self.dispatched_at = None
+        self.finished_at = None
+        self.result = None
+        self.error_name = None
+        self.error_description = None
+        self.report_filename = None
+        self.report_bytes = 0
+        self.report_seconds = 0.0
+        self.reported_at = None
+
+
+class MockCloudShell:
+    """
+    In-process stand-in for the CloudShell Quali API endpoints used by CustomExecutionServer
+
+    Serves Auth/login, ExecutionServers, PendingCommand, Status, Reservations, FinishedExecution,
+    ExecutionReport and UpdateFilesEnded on 127.0.0.1, with optional injected latency and errors.
+    Commands added with add_start_command() and add_stop_command() are handed out by PendingCommand in order;
+    while none is queued, PendingCommand holds the request for up to poll_hold seconds like the real server.
+    Requests with a token other than the one of the last login are answered with 401, see expire_token(), and
+    while unavailable is set every request is answered with 503.
+    """
+    def __init__(self, port=0, latency=0.0, path_latency=None, error_rate=0.0, error_paths=None, poll_hold=1.0, reservation_json=None):
+        """
+        :param port: int : 0 to pick a free port, see port()
+        :param latency: float : seconds added to every response
+        :param path_latency: dict : str -> float : seconds added to responses for paths starting with the key, e.g. {'/API/Execution/Reservations': 0.5}
+        :param error_rate: float : probability of answering a request with HTTP 500 instead of handling it
+        :param error_paths: list of str : only inject errors on paths starting with one of these, default all paths
+        :param poll_hold: float : maximum seconds a PendingCommand request waits for a command before returning 204
+        :param reservation_json: dict : returned for every reservation, default no topology inputs
+        """
+        self._requested_port = port
+        self.latency = latency
+        self.path_latency = path_latency or {}
+        self.error_rate = error_rate
+        self.error_paths = error_paths
+        self.poll_hold = poll_hold
+        self.reservation_json = reservation_json or {'TopologyInputs': [], 'Resources': []}
+
+        self._lock = threading.Condition()
+        self._commands = deque()
+        self._executions = {}
+        self._finished = 0
+        self._reported = 0
+        self._servers = {}
+        self._status_updates = 0
+        self._request_counts = {}
+        self._server = None
+        self._token_seq = 0
+        self.unavailable = False
+
+    def start(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _read_body(self):
+                if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                    n = 0
+                    while True:
+                        size = int(self.rfile.readline().strip().split(b';')[0], 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            return n, None
+                        left = size
+                        while left:
+                            left -= len(self.rfile.read(min(left, 65536)))
+                        self.rfile.readline()
+                        n += size
+                length = int(self.headers.get('Content-Length') or 0)
+                data = self.rfile.read(length)
+                return length, data
+
+            def _respond(self, code, body=b''):
+                if not isinstance(body, bytes):
+                    body = body.encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self, method):
+                t0 = time()
+                nbytes, data = self._read_body()
+                path = self.path.split('?')[0]
+                code, body = mock._dispatch(method, path, data, nbytes, t0, self.headers.get('Authorization', ''))
+                self._respond(code, body)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_PUT(self):
+                self._handle('PUT')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def do_DELETE(self):
+                self._handle('DELETE')
+
+            def log_message(self, fmt, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', self._requested_port), Handler)
+        th = threading.Thread(target=self._server.serve_forever)
+        th.daemon = True
+        th.start()
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        with self._lock:
+            self._lock.notify_all()
+
+    def port(self):
+        return self._server.server_address[1]
+
+    def add_start_command(self, execution_id, test_path='suite.robot', test_arguments='', username='admin', reservation_id=''):
+        with self._lock:
+            e = MockExecution(execution_id)
+            e.queued_at = time()
+            self._executions[execution_id] = e
+            self._commands.append({
+                'Type': 'startExecution',
+                'ExecutionId': execution_id,
+                'TestPath': test_path,
+                'TestArguments': test_arguments,
+                'UserName': username,
+                'ReservationId': reservation_id,
+            })
+            self._lock.notify_all()
+
+    def add_stop_command(self, execution_id):
+        with self._lock:
+            self._commands.append({'Type': 'stopExecution', 'ExecutionId': execution_id})
+            self._lock.notify_all()
+
+    def executions(self):
+        """
+        :return: list of MockExecution
+        """
+        with self._lock:
+            return list(self._executions.values())
+
+    def request_counts(self):
+        """
+        :return: dict : str -> int : number of requests received per 'METHOD /API/x/y' endpoint
+        """
+        with self._lock:
+            return dict(self._request_counts)
+
+    def wait_for(self, finished, reported, timeout):
+        """
+        Blocks until at least finished FinishedExecution calls and reported ExecutionReport uploads were received
+
+        :return: bool : False on timeout
+        """
+        deadline = time() + timeout
+        with self._lock:
+            while self._finished < finished or self._reported < reported:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+            return True
+
+    def _inject(self, path):
+        delay = self.latency
+        for prefix, d in self.path_latency.items():
+            if path.startswith(prefix):
+                delay += d
+        if delay:
+            sleep(delay)
+        if self.error_rate and (self.error_paths is None or any(path.startswith(p) for p in self.error_paths)):
+            if random.random() < self.error_rate:
+                return True
+        return False
+
+    def expire_token(self):
+        """
+        Makes CloudShell forget the token of the last login, like after a restart
+        """
+        with self._lock:
+            self._token_seq += 1
+
+    def _dispatch(self, method, path, data, nbytes, t0, authorization=''):
+        parts = path.strip('/').split('/')
+        endpoint = '/'.join(parts[:3])
+        with self._lock:
+            key = '%s /%s' % (method, endpoint)
+            self._request_counts[key] = self._request_counts.get(key, 0) + 1
+
+        if self.unavailable:
+            return 503, '"Service unavailable"'
+
+        if self._inject(path):
+            return 500, '"Injected error"'
+
+        if endpoint == 'API/Auth/login':
+            with self._lock:
+                self._token_seq += 1
+                return 200, '"mocktoken%d"' % self._token_seq
+
+        if authorization != 'Basic mocktoken%d' % self._token_seq:
+            return 401, json.dumps({'Message': 'Invalid token'})
+
+        if endpoint == 'API/Execution/ExecutionServers':
+            o = json.loads(data.decode('utf-8'))
+            with self._lock:
+                if method == 'PUT' and o['Name'] in self._servers:
+                    return 400, json.dumps({'Message': 'Execution server %s already exists' % o['Name']})
+                self._servers[o['Name']] = o
+            return 200, ''
+
+        if endpoint == 'API/Execution/PendingCommand':
+            deadline = time() + self.poll_hold
+            with self._lock:
+                while not self._commands:
+                    remaining = deadline - time()
+                    if remaining <= 0 or self._server is None:
+                        return 204, ''
+                    self._lock.wait(remaining)
+                command = self._commands.popleft()
+                e = self._executions.get(command['ExecutionId'])
+                if e is not None and command['Type'] == 'startExecution':
+                    e.dispatched_at = time()
+            return 200, json.dumps(command)
+
+        if endpoint == 'API/Execution/Status':
+            with self._lock:
+                self._status_updates += 1
+            return 200, ''
+
+        if endpoint == 'API/Execution/Reservations':
+            return 200, json.dumps(self.reservation_json)
+
+        if endpoint == 'API/Execution/FinishedExecution':
+            o = json.loads(data.decode('utf-8'))
+            with self._lock:
+                e = self._executions.setdefault(o['ExecutionId'], MockExecution(o['ExecutionId']))
+                if e.finished_at is None:
+                    e.finished_at = time()
+                    e.result = o.get('Result')
+                    e.error_name = o.get('ErrorName')
+                    e.error_description = o.get('ErrorDescription')
+                    self._finished += 1
+                self._lock.notify_all()
+            return 200, ''
+
+        if endpoint == 'API/Execution/ExecutionReport':
+            execution_id = parts[4] if len(parts) > 4 else ''
+            with self._lock:
+                e = self._executions.setdefault(execution_id, MockExecution(execution_id))
+                e.report_filename = unquote(parts[5]) if len(parts) > 5 else ''
+                e.report_bytes = nbytes
+                e.report_seconds = time() - t0
+                e.reported_at = time()
+                self._reported += 1
+                self._lock.notify_all()
+            return 200, ''
+
+        if endpoint == 'API/Execution/UpdateFilesEnded':
+            return 200, ''
+
+        return 404, json.dumps({'Message': 'Unknown path %s' % path})
@@ -0,0 +1,257 @@
+import json
+import os
+import random
+import shutil
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class OutboxEntry:
+    """
+    Result of one execution waiting to be delivered to CloudShell
+    """
+    def __init__(self, seq, execution_id, result, error_name, error_description, report_filename, report_mime_type, report_path, owns_report):
+        self.seq = seq
+        self.execution_id = execution_id
+        self.result = result
+        self.error_name = error_name
+        self.error_description = error_description
+        self.report_filename = report_filename
+        self.report_mime_type = report_mime_type
+        # file to upload as the report, '' if there is none
+        self.report_path = report_path
+        # report_path was written or moved into the outbox and is deleted with the entry
+        self.owns_report = owns_report
+        # FinishedExecution was delivered, only the report is left
+        self.finished = False
+        self.attempts = 0
+        self.next_attempt = 0
+        self.in_flight = False
+        # CommandResult.on_report_discarded of a report_path the outbox doesn't own, not kept over a restart
+        self.on_report_discarded = None
+
+    def to_json(self):
+        return {
+            'op': 'add',
+            'seq': self.seq,
+            'id': self.execution_id,
+            'result': self.result,
+            'error_name': self.error_name,
+            'error_description': self.error_description,
+            'report_filename': self.report_filename,
+            'report_mime_type': self.report_mime_type,
+            'report_path': self.report_path,
+            'owns_report': self.owns_report,
+        }
+
+    @staticmethod
+    def from_json(o):
+        return OutboxEntry(o['seq'], o['id'], o['result'], o.get('error_name', ''), o.get('error_description', ''),
+                           o.get('report_filename', ''), o.get('report_mime_type', ''), o.get('report_path', ''), o.get('owns_report', False))
+
+
+class Outbox:
+    """
+    Durable queue of execution results waiting to be delivered to CloudShell
+
+    Results are recorded in an append-only journal, <directory>/journal.jsonl, and their reports are kept
+    as files in <directory>/reports until delivered. Every delivery step is journaled as soon as CloudShell
+    accepted it and the journal is synced to disk, so after a restart only the steps that were not yet
+    confirmed are sent again. The journal is compacted when the outbox is opened.
+
+    One directory must only be used by one execution server process at a time.
+    """
+    JOURNAL_FILENAME = 'journal.jsonl'
+
+    def __init__(self, directory, logger, base_backoff=2, max_backoff=300):
+        """
+        :param directory: str : created if missing
+        :param logger: logging.Logger
+        :param base_backoff: float : seconds before the first retry of a failed delivery, doubled with every further failure
+        :param max_backoff: float : maximum seconds between retries
+        """
+        # absolute, the daemon changes its working directory after the server was created
+        directory = os.path.abspath(directory)
+        self._directory = directory
+        self._reports_directory = os.path.join(directory, 'reports')
+        self._journal_path = os.path.join(directory, self.JOURNAL_FILENAME)
+        self._logger = logger
+        self._base_backoff = base_backoff
+        self._max_backoff = max_backoff
+        self._cond = threading.Condition()
+        # seq -> OutboxEntry, oldest first
+        self._entries = OrderedDict()
+        self._seq = 0
+        if not os.path.isdir(self._reports_directory):
+            os.makedirs(self._reports_directory)
+        self._load()
+        self._journal = open(self._journal_path, 'a')
+
+    def _load(self):
+        if os.path.exists(self._journal_path):
+            with open(self._journal_path) as f:
+                for line in f:
+                    try:
+                        o = json.loads(line)
+                    except ValueError:
+                        # torn write of the last record before a crash
+                        continue
+                    seq = o.get('seq', 0)
+                    self._seq = max(self._seq, seq)
+                    if o['op'] == 'add':
+                        self._entries[seq] = OutboxEntry.from_json(o)
+                    elif o['op'] == 'finished' and seq in self._entries:
+                        self._entries[seq].finished = True
+                    elif o['op'] == 'done':
+                        self._entries.pop(seq, None)
+
+        tmp = self._journal_path + '.tmp'
+        with open(tmp, 'w') as f:
+            for entry in self._entries.values():
+                f.write(json.dumps(entry.to_json()) + '\n')
+                if entry.finished:
+                    f.write(json.dumps({'op': 'finished', 'seq': entry.seq}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self._journal_path)
+
+        # reports written by add() just before a crash, never journaled
+        owned = set(os.path.basename(e.report_path) for e in self._entries.values() if e.owns_report)
+        for fn in os.listdir(self._reports_directory):
+            if fn not in owned:
+                os.remove(os.path.join(self._reports_directory, fn))
+
+        if self._entries:
+            self._logger.info('Outbox %s: %d results from before the restart still to be delivered: %s' % (
+                self._directory, len(self._entries), ', '.join(e.execution_id for e in self._entries.values())))
+
+    def _append(self, record):
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def add(self, execution_id, result):
+        """
+        Stores the result of an execution for delivery, taking over its report
+
+        :param execution_id: str
+        :param result: CommandResult : its report is moved or copied into the outbox unless it is a file that is not deleted after upload,
+            then the outbox takes over result.on_report_discarded and calls it once the entry is complete
+        :return: None
+        """
+        with self._cond:
+            self._seq += 1
+            seq = self._seq
+        report_path = ''
+        owns_report = False
+        if result.report_filename:
+            dest = os.path.join(self._reports_directory, '%d.report' % seq)
+            if result.report_path and not result.delete_report_after_upload:
+                report_path = result.report_path
+            elif result.report_path:
+                shutil.move(result.report_path, dest)
+                report_path = dest
+                owns_report = True
+            else:
+                body, _ = result.open_report()
+                try:
+                    with open(dest, 'wb') as f:
+                        if hasattr(body, 'read'):
+                            shutil.copyfileobj(body, f, 1 << 20)
+                        else:
+                            f.write(body)
+                        f.flush()
+                        os.fsync(f.fileno())
+                except Exception:
+                    os.remove(dest)
+                    raise
+                report_path = dest
+                owns_report = True
+        entry = OutboxEntry(seq, execution_id, result.result, result.error_name, result.error_description,
+                            result.report_filename, result.report_mime_type, report_path, owns_report)
+        with self._cond:
+            self._append(entry.to_json())
+            if report_path and not owns_report:
+                entry.on_report_discarded, result.on_report_discarded = result.on_report_discarded, None
+            self._entries[seq] = entry
+            self._cond.notify()
+
+    def take(self, timeout):
+        """
+        Waits for an entry that is due for a delivery attempt and reserves it for the caller
+
+        :param timeout: float : seconds
+        :return: OutboxEntry : pass it to mark_finished(), complete() or retry_later() -- None on timeout
+        """
+        deadline = time() + timeout
+        with self._cond:
+            while True:
+                now = time()
+                wait = deadline - now
+                for entry in self._entries.values():
+                    if not entry.in_flight:
+                        if entry.next_attempt <= now:
+                            entry.in_flight = True
+                            return entry
+                        wait = min(wait, entry.next_attempt - now)
+                if deadline <= now:
+                    return None
+                self._cond.wait(wait)
+
+    def mark_finished(self, entry):
+        """
+        Records that FinishedExecution of entry was delivered
+        """
+        with self._cond:
+            self._append({'op': 'finished', 'seq': entry.seq})
+            entry.finished = True
+            entry.attempts = 0
+
+    def complete(self, entry):
+        """
+        Records that entry was delivered, or dropped for good, and deletes its report if the outbox owns it
+        """
+        with self._cond:
+            self._append({'op': 'done', 'seq': entry.seq})
+            self._entries.pop(entry.seq, None)
+            if not self._entries:
+                # nothing pending: the journal can start over
+                self._journal.truncate(0)
+            self._cond.notify_all()
+        if entry.owns_report:
+            try:
+                os.remove(entry.report_path)
+            except OSError:
+                pass
+        if entry.on_report_discarded:
+            entry.on_report_discarded()
+
+    def retry_later(self, entry):
+        """
+        Makes entry due again after an exponential, jittered backoff
+
+        :return: float : seconds until the next attempt
+        """
+        with self._cond:
+            entry.attempts += 1
+            delay = min(self._max_backoff, self._base_backoff * 2 ** (entry.attempts - 1)) * random.uniform(0.5, 1.0)
+            entry.next_attempt = time() + delay
+            entry.in_flight = False
+            self._cond.notify_all()
+        return delay
+
+    def pending_execution_ids(self):
+        """
+        :return: list of str : ids of the executions whose results are not delivered yet
+        """
+        with self._cond:
+            return [e.execution_id for e in self._entries.values()]
+
+    def size(self):
+        with self._cond:
+            return len(self._entries)
+
+    def close(self):
+        with self._cond:
+            self._journal.close()
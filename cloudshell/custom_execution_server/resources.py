@@ -0,0 +1,173 @@
+import ctypes
+import os
+import platform
+import threading
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+# ioprio_set system call numbers, there is no Python API for it
+IOPRIO_SET_SYSCALLS = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+
+# loaded once here, apply_limits() runs in a forked child where loading a library isn't safe
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+except (OSError, TypeError):
+    # Windows
+    _libc = None
+
+RLIMITS = {
+    'memory': 'RLIMIT_AS',
+    'open_files': 'RLIMIT_NOFILE',
+    'cpu_seconds': 'RLIMIT_CPU',
+}
+
+
+def apply_limits(limits):
+    """
+    Applies resource limits to the current process -- called in a child before it runs robot
+
+    :param limits: dict : see RunResources.allocate()
+    :raises OSError: if a limit can't be applied
+    """
+    if limits.get('cores'):
+        os.sched_setaffinity(0, limits['cores'])
+    for name, value in (limits.get('rlimits') or {}).items():
+        r = getattr(resource, RLIMITS[name])
+        soft, hard = resource.getrlimit(r)
+        # only lower the hard limit, raising it needs privileges
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(r, (value, hard))
+    if limits.get('nice'):
+        os.nice(limits['nice'])
+    if limits.get('ionice'):
+        io_class, io_level = limits['ionice']
+        number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+        if number is not None and _libc is not None:
+            if _libc.syscall(number, IOPRIO_WHO_PROCESS, 0, (io_class << IOPRIO_CLASS_SHIFT) | io_level) == -1:
+                errno = ctypes.get_errno()
+                raise OSError(errno, 'ioprio_set failed: %s' % os.strerror(errno))
+
+
+def rusage_to_dict(ru):
+    """
+    :param ru: resource.struct_rusage : of an exited process, including the children it waited for
+    :return: dict : JSON serializable
+    """
+    return {
+        'user_cpu_seconds': ru.ru_utime,
+        'system_cpu_seconds': ru.ru_stime,
+        # kilobytes on Linux, bytes on macOS
+        'max_rss_bytes': ru.ru_maxrss * (1 if platform.system() == 'Darwin' else 1024),
+        'block_input_ops': ru.ru_inblock,
+        'block_output_ops': ru.ru_oublock,
+        'voluntary_context_switches': ru.ru_nvcsw,
+        'involuntary_context_switches': ru.ru_nivcsw,
+    }
+
+
+class ResourceUsage:
+    """
+    Resource usage of the processes of one execution, e.g. the shards of a parallel run, added up as they exit
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.processes = 0
+        self.usage = {}
+
+    def add(self, usage):
+        """
+        :param usage: dict : see rusage_to_dict()
+        """
+        with self._lock:
+            self.processes += 1
+            for k, v in usage.items():
+                if k == 'max_rss_bytes':
+                    # the processes didn't necessarily run at the same time
+                    self.usage[k] = max(self.usage.get(k, 0), v)
+                else:
+                    self.usage[k] = self.usage.get(k, 0) + v
+
+    def to_dict(self):
+        """
+        :return: dict : the usage added up, None if no process exited yet
+        """
+        with self._lock:
+            if not self.processes:
+                return None
+            return dict(self.usage, processes=self.processes)
+
+
+class RunResources:
+    """
+    Resource controls applied to each robot process when it is started
+
+    Each process gets cores_per_run CPU cores from the core pool, the ones used by the fewest running
+    processes, so concurrent runs spread over the host instead of competing for the same cores. Memory
+    (address space), open files and CPU time are limited with rlimits, which apply to each process the run
+    starts, e.g. each browser, not to all of them together. nice and ionice lower the scheduling priority.
+    """
+    def __init__(self, logger, cores_per_run=0, core_pool=None, max_memory_bytes=0, max_open_files=0, max_cpu_seconds=0,
+                 nice=0, ionice_class=0, ionice_level=0):
+        """
+        :param logger: logging.Logger
+        :param cores_per_run: int : 0 to not pin processes to cores
+        :param core_pool: list of int : cores to allocate from, default all the cores this process may use
+        :param max_memory_bytes: int : 0 for no limit
+        :param max_open_files: int : 0 for no limit
+        :param max_cpu_seconds: int : 0 for no limit
+        :param nice: int : added to the nice value, 0 to leave it
+        :param ionice_class: int : 1 realtime, 2 best effort, 3 idle, 0 to leave the I/O priority
+        :param ionice_level: int : 0 highest to 7 lowest, for classes 1 and 2
+        """
+        self._logger = logger
+        self._cores_per_run = cores_per_run
+        if cores_per_run and core_pool is None:
+            core_pool = sorted(os.sched_getaffinity(0))
+        self._core_pool = core_pool or []
+        self._rlimits = dict((k, v) for k, v in (('memory', max_memory_bytes), ('open_files', max_open_files), ('cpu_seconds', max_cpu_seconds)) if v)
+        self._nice = nice
+        self._ionice = (ionice_class, ionice_level) if ionice_class else None
+        if self._ionice and (platform.machine() not in IOPRIO_SET_SYSCALLS or _libc is None):
+            self._logger.warning('Setting the I/O priority is not supported on %s - ignoring ionice' % platform.machine())
+            self._ionice = None
+        self._lock = threading.Lock()
+        # core -> number of processes using it
+        self._core_users = dict((c, 0) for c in self._core_pool)
+        # identifier -> cores
+        self._allocations = {}
+
+    def allocate(self, identifier):
+        """
+        :param identifier: str : of the process, see release()
+        :return: dict : limits to pass to apply_limits() in the process
+        """
+        limits = {'rlimits': self._rlimits, 'nice': self._nice, 'ionice': self._ionice}
+        if self._cores_per_run:
+            with self._lock:
+                cores = sorted(self._core_pool, key=lambda c: self._core_users[c])[:self._cores_per_run]
+                for c in cores:
+                    self._core_users[c] += 1
+                self._allocations[identifier] = cores
+            limits['cores'] = cores
+        return limits
+
+    def release(self, identifier):
+        with self._lock:
+            for c in self._allocations.pop(identifier, []):
+                self._core_users[c] -= 1
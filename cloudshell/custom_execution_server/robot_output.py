@@ -0,0 +1,91 @@
+from datetime import datetime
+from xml.etree import ElementTree
+
+
+def robot_elapsed(status):
+    """
+    :param status: Element : <status> of a test or suite
+    :return: float : seconds, None if unknown
+    """
+    if status.get('elapsed') is not None:
+        # Robot 7
+        return float(status.get('elapsed'))
+    try:
+        start = datetime.strptime(status.get('starttime'), '%Y%m%d %H:%M:%S.%f')
+        end = datetime.strptime(status.get('endtime'), '%Y%m%d %H:%M:%S.%f')
+    except (TypeError, ValueError):
+        return None
+    return (end - start).total_seconds()
+
+
+def summarize_robot_output(path, max_message_length=500):
+    """
+    Reads a Robot output.xml in one streaming pass, dropping each element once it has ended, so memory
+    does not grow with the size of the file
+
+    :param path: str
+    :param max_message_length: int : failure messages are cut to this length
+    :return: dict : JSON-serializable summary with the overall statistics, the first failure, and per suite and
+    per test the status and duration -- per test also the tags and the failure message
+    """
+    summary = {
+        'status': None,
+        'statistics': {'total': 0, 'passed': 0, 'failed': 0, 'skipped': 0},
+        'first_failure': None,
+        'errors': 0,
+        'suites': [],
+        'tests': [],
+    }
+    # elements from the root to the current one, with the long names of the open suites
+    stack = []
+    suites = []
+    test = None
+    for event, elem in ElementTree.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'robot':
+                summary['generator'] = elem.get('generator')
+                summary['generated'] = elem.get('generated')
+            elif elem.tag == 'suite':
+                suites.append('%s.%s' % (suites[-1], elem.get('name')) if suites else elem.get('name'))
+            elif elem.tag == 'test':
+                test = {'name': '%s.%s' % (suites[-1], elem.get('name')), 'status': None, 'elapsed': None, 'tags': []}
+            stack.append(elem)
+            continue
+
+        stack.pop()
+        parent = stack[-1] if stack else None
+        if elem.tag == 'tag' and test is not None and parent is not None and \
+                (parent.tag == 'test' or (parent.tag == 'tags' and len(stack) > 1 and stack[-2].tag == 'test')):
+            test['tags'].append(elem.text or '')
+        elif elem.tag == 'status' and parent is not None and parent.tag == 'test':
+            test['status'] = elem.get('status')
+            test['elapsed'] = robot_elapsed(elem)
+            if test['status'] != 'PASS' and elem.text:
+                test['message'] = elem.text[:max_message_length]
+        elif elem.tag == 'status' and parent is not None and parent.tag == 'suite':
+            suite = {'name': suites[-1], 'status': elem.get('status'), 'elapsed': robot_elapsed(elem)}
+            summary['suites'].append(suite)
+            if len(suites) == 1:
+                summary['status'] = suite['status']
+        elif elem.tag == 'test':
+            summary['tests'].append(test)
+            stats = summary['statistics']
+            stats['total'] += 1
+            if test['status'] == 'PASS':
+                stats['passed'] += 1
+            elif test['status'] == 'SKIP':
+                stats['skipped'] += 1
+            else:
+                stats['failed'] += 1
+                if summary['first_failure'] is None:
+                    summary['first_failure'] = {'test': test['name'], 'message': test.get('message', '')}
+            test = None
+        elif elem.tag == 'suite':
+            suites.pop()
+        elif elem.tag == 'msg' and parent is not None and parent.tag == 'errors':
+            summary['errors'] += 1
+
+        # tags and statuses are still needed by the enclosing test or suite, everything else can go
+        if elem.tag not in ('tag', 'tags', 'status') and parent is not None:
+            parent.remove(elem)
+    return summary
@@ -1,6 +1,9 @@
 import getpass
+import glob
+import hashlib
 import json
 import platform
+import queue
 import signal
 import subprocess
 import sys
@@ -9,13 +12,38 @@ import os
 import logging
 import shutil
 import re
+import tempfile
+import threading
 import traceback
-from logging.handlers import RotatingFileHandler
+import zipfile
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-from cloudshell.custom_execution_server.custom_execution_server import CustomExecutionServer, CustomExecutionServerCommandHandler, PassedCommandResult, \
+from cloudshell.custom_execution_server.custom_execution_server import CustomExecutionServerHost, CustomExecutionServerCommandHandler, PassedCommandResult, \
     FailedCommandResult, ErrorCommandResult, StoppedCommandResult
 
+from cloudshell.custom_execution_server.capacity import CapacityController
 from cloudshell.custom_execution_server.daemon import become_daemon_and_wait
+from cloudshell.custom_execution_server.live_output import LiveOutputHub
+from cloudshell.custom_execution_server.local_http import LocalHTTPServer
+from cloudshell.custom_execution_server.metrics import Metrics
+from cloudshell.custom_execution_server.resources import ResourceUsage, RunResources, apply_limits, rusage_to_dict
+from cloudshell.custom_execution_server.robot_output import summarize_robot_output
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from cloudshell.api.cloudshell_api import CloudShellAPISession
+except ImportError:
+    CloudShellAPISession = None
+
+LIVE_LISTENER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'robot_live_listener.py')
+WARM_WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'robot_warm_worker.py')
+ROBOT_EVENTS_FILENAME = 'robot_events.jsonl'
+OUTPUT_SUMMARY_FILENAME = 'summary.json'
+RESOURCE_USAGE_FILENAME = 'resource_usage.json'
 
 
 def string23(b):
@@ -25,6 +53,15 @@ def string23(b):
     return b or ''
 
 
+PASSWORD_IN_URL_RE = re.compile(r':[^@:]*@')
+PASSWORD_IN_VARIABLE_RE = re.compile(r"CLOUDSHELL_PASSWORD:[^']*")
+
+
+def hide_passwords(command):
+    command = PASSWORD_IN_URL_RE.sub(':(password hidden)@', command)
+    return PASSWORD_IN_VARIABLE_RE.sub('CLOUDSHELL_PASSWORD:(password hidden)', command)
+
+
 def input23(msg):
     if sys.version_info.major == 3:
         return input(msg)
@@ -52,19 +89,165 @@ jsonexample = '''Example config.json:
   "cloudshell_execution_server_type" : "Robot",
   "cloudshell_execution_server_capacity" : "5",
 
+  "cloudshell_execution_server_capacity_min" : 0,
+  "cloudshell_execution_server_capacity_max" : 0,
+  // optional: if capacity_max is set, the capacity starts at cloudshell_execution_server_capacity and is lowered
+  // while the host is overloaded (CPU, memory, load average or runs slower than usual) and raised while the host
+  // has room and all slots are in use, within min..max -- also allowed in each of additional_servers
+  "capacity_check_interval": 30,
+  // optional: seconds between samples of the host load; the capacity changes at most once per 10 samples
+
+  "additional_servers": [
+    {
+      "cloudshell_execution_server_name" : "MyCES1Regression",
+      "cloudshell_execution_server_description" : "Robot regression CES in Python",
+      "cloudshell_execution_server_type" : "RobotRegression",
+      "cloudshell_execution_server_capacity" : "3"
+    }
+  ],
+  // optional: more execution servers, e.g. of other server types, hosted by this process with the same settings;
+  // all servers share one CloudShell login and connection pool, and one thread sends their Status heartbeats
+  "max_workers": 0,
+  // optional: maximum number of executions running in all servers of this process together, 0 for no limit
+  // beyond the capacity of each server
+
+  "fair_share_weights": {"nightly": 0.5, "release-team": 2},
+  // optional: executions waiting for a free slot run by priority -- Priority=N in the test arguments or topology
+  // input Priority, higher first, default 0 -- then shared between CloudShell users by these weights (default 1)
+  // and between the reservations of a user, so one user's batch doesn't hold up the others
+
   "log_directory": "/var/log",
   "log_level": "INFO",
   // CRITICAL | ERROR | WARNING | INFO | DEBUG
   "log_filename": "<EXECUTION_SERVER_NAME>.log",
+  "log_max_bytes": 10000000,
+  "log_backup_count": 10,
+  // the log is rotated when it reaches log_max_bytes, keeping log_backup_count old logs
+
+  "execution_log_directory": "/var/log/<EXECUTION_SERVER_NAME>_executions",
+  // optional: log each execution, including robot console output at DEBUG, to <execution id>.log in this directory;
+  // warnings and errors are also written to the main log
+  "execution_log_level": "DEBUG",
+  // optional: level of the execution logs, default log_level
+
+  "metrics_port": 9464,
+  // optional: serve Prometheus metrics on http://<metrics_bind_address>:<metrics_port>/metrics, 0 to disable;
+  // with live_output also serves the list of running executions on /executions and their live output
+  // as Server-Sent Events on /executions/<execution id>
+  "metrics_bind_address": "127.0.0.1",
+
+  "outbox_directory": "/var/spool/robot_ces/<EXECUTION_SERVER_NAME>",
+  // optional: store results on disk and deliver them to CloudShell in the background with retries,
+  // so a slow or unreachable CloudShell does not hold up worker slots and results survive a restart
+  "outbox_uploaders": 2,
+  // number of results delivered in parallel
+  "request_timeout": 120,
+  // seconds without a response from CloudShell after which a request fails and is retried, 0 to wait forever
+  "drain_timeout": 60,
+  // on SIGTERM, stop taking new commands (they stay queued in CloudShell for the restarted server) and wait
+  // this many seconds for running executions to finish; executions still running then are stopped and
+  // reported as errors
 
   "unique_output_directory": "/mnt/share1/robot_output/%R/%N_%V_%T",
   "delete_output_after_run": false,
+  "output_retention_days": 0,
+  // optional: a background janitor deletes output directories older than this many days, 0 to keep them
+  "output_retention_keep_last": 0,
+  // optional: keep only this many newest output directories per test, 0 for no limit
+  "output_retention_max_bytes": 0,
+  // optional: delete the oldest output directories while all together are larger than this, 0 for no limit;
+  // the janitor recognizes output directories by unique_output_directory, which must contain %T, and never
+  // deletes those of running executions -- run only one janitor per output directory tree
+  "output_janitor_interval": 300,
+  // seconds between janitor runs
+  "output_janitor_files_per_second": 1000,
+  // maximum rate of deleting files, so running executions don't wait for the disk; 0 for no limit
   "archive_output_xml_to": "/mnt/share1/robot_logs/%R/%N_%V_%T.xml",
+  "output_summary": true,
+  // write a JSON summary of output.xml (suites, tests, statuses, durations, tags, first failure) to summary.json
+  // in the output directory and the results zip, and next to archive_output_xml_to as <name>.summary.json
   "postprocessing_command": "/mnt/share1/scripts/postprocess.sh /mnt/share1/robot_logs/%R/%N_%V_%T.xml",
-
+  "deferred_steps": ["delete_output"],
+  // optional: steps run in the background after the result was returned to CloudShell instead of before:
+  // "archive_output_xml", "delete_output", "postprocessing"; the others still run first, and a failing
+  // postprocessing_command then fails the execution; deferring archive_output_xml also defers the other two
+  "deferred_workers": 2,
+  // number of executions whose deferred steps run at the same time
+
+  "output_capture_head_bytes": 65536,
+  "output_capture_tail_bytes": 65536,
+  // console output of robot and other commands kept in memory for error messages: this much from the start and from the end
+  "output_spool_filename": "robot_console.txt",
+  // file in the output directory that receives the full robot console output, "" to not keep it
+
+  "archive_compression_level": 6,
+  // 0 (store only) to 9: compression of the results zip sent to CloudShell
+  "archive_store_min_bytes": 50000000,
+  // optional: files at least this large are stored without compression, 0 to compress everything
+  "archive_artifact_patterns": ["*.png", "browser/screenshot/*.png"],
+  // optional: extra files from the output directory to include in the results zip
+  "archive_stream_upload": false,
+  // build the results zip while uploading it instead of writing it to disk first (ignored with delete_output_after_run)
+
+  "live_output": false,
+  // publish robot console output and test progress of running executions, see metrics_port
+  "live_output_buffer_bytes": 1000000,
+  // recent live output kept per execution for clients connecting later; older output is dropped, never waited for
+  "progress_interval": 0,
+  // optional: seconds between test progress messages written to the reservation output in CloudShell, 0 to disable;
+  // requires the cloudshell-automation-api package
+
+  "warm_robot_worker": false,
+  // optional, not on Windows: run robot and rebot in children forked from a worker process that has Robot Framework
+  // and warm_robot_preload already imported, instead of starting the robot command each time; the worker runs
+  // in the Python interpreter of this server, which must have Robot Framework installed
+  "warm_robot_preload": ["SeleniumLibrary", "RequestsLibrary"],
+  // modules the worker imports once at startup
+
+  "parallel_shards": 1,
+  // optional: split a test directory into this many robot processes running in parallel and merge their results;
+  // can also be set per execution with Shards=N in the test arguments
+
+  "run_cores_per_run": 0,
+  "run_core_pool": [2, 3, 4, 5, 6, 7],
+  // optional: pin each robot process (each shard) to this many CPU cores of run_core_pool, by default all cores,
+  // picking the cores used by the fewest running processes
+  "run_max_memory_bytes": 0,
+  "run_max_open_files": 0,
+  "run_max_cpu_seconds": 0,
+  // optional: rlimits for robot and every process it starts, e.g. each browser, 0 for no limit; the memory limit
+  // is on address space, which browsers reserve far more of than they use
+  "run_nice": 0,
+  "run_ionice_class": 0,
+  "run_ionice_level": 0,
+  // optional: lower the CPU and I/O priority of robot runs, e.g. nice 10 and ionice class 2 (best effort) level 7;
+  // the CPU time, peak memory and block I/O of each run are written to resource_usage.json in the output directory
 
   "git_repo_url": "https://<PROMPT_GIT_USERNAME>:<PROMPT_GIT_PASSWORD>@github.com/myuser/myproj",
-  "git_default_checkout_version": "master"
+  "git_default_checkout_version": "master",
+
+  "git_cache_directory": "/var/cache/robot_git",
+  // optional: keep a local mirror of git_repo_url, fetched incrementally, and check out
+  // each execution as a worktree of it instead of running a full git clone
+  "git_cache_min_fetch_interval": 0,
+  // seconds: skip the mirror fetch if the last one finished less than this long ago
+  "git_shared_trees": false,
+  // optional, requires git_cache_directory: resolve TestVersion to a commit id and run all executions at the same
+  // commit in one shared read-only source tree; robot then runs in that tree and writes its output to the output directory
+  "git_shared_trees_max": 10,
+  // number of unused source trees to keep
+  "git_shared_trees_max_bytes": 0,
+  // optional: also delete the least recently used unused trees while all trees together are larger than this
+
+  "venv_cache_directory": "/var/cache/robot_venvs",
+  // optional: if the checked out test repo has one of venv_requirements_files, run robot from a virtualenv with
+  // those requirements installed; virtualenvs are kept here, one per requirements file content, and reused
+  "venv_requirements_files": ["requirements.txt"],
+  // pip requirements files looked for in the root of the test repo, the first one found is used
+  "venv_extra_packages": ["robotframework"],
+  // installed into each virtualenv along with the requirements file
+  "venv_cache_max_bytes": 0
+  // optional: delete the least recently used unused virtualenvs while all of them together are larger than this
 }
 // %R = reservation id
 // %V = version (tag, branch, or commit id)
@@ -146,56 +329,235 @@ for k in list(o.keys()):
 
 server_description = o.get('cloudshell_execution_server_description', '')
 server_capacity = int(o.get('cloudshell_execution_server_capacity', 5))
+additional_servers = o.get('additional_servers', [])
+max_workers = int(o.get('max_workers', 0))
+fair_share_weights = dict((k, float(v)) for k, v in o.get('fair_share_weights', {}).items())
+if any(w <= 0 for w in fair_share_weights.values()):
+    raise Exception('Fix the following in config.json:\nfair_share_weights must be positive: %s' % json.dumps(fair_share_weights))
+capacity_check_interval = float(o.get('capacity_check_interval', 30))
 cloudshell_snq_port = int(o.get('cloudshell_snq_port', 9000))
 cloudshell_port = int(o.get('cloudshell_port', 8029))
 cloudshell_domain = o.get('cloudshell_domain', 'Global')
 log_directory = o.get('log_directory', '/var/log')
 log_level = o.get('log_level', 'INFO')
 log_filename = o.get('log_filename', server_name + '.log')
+log_max_bytes = int(o.get('log_max_bytes', 10000000))
+log_backup_count = int(o.get('log_backup_count', 10))
+execution_log_directory = o.get('execution_log_directory', '')
+execution_log_level = o.get('execution_log_level', '') or log_level
+metrics_port = int(o.get('metrics_port', 0))
+metrics_bind_address = o.get('metrics_bind_address', '127.0.0.1')
+outbox_directory = o.get('outbox_directory', '')
+outbox_uploaders = int(o.get('outbox_uploaders', 2))
+request_timeout = float(o.get('request_timeout', 120))
+drain_timeout = float(o.get('drain_timeout', 60))
 unique_output_directory = o.get('unique_output_directory', '/tmp')
 delete_output = o.get('delete_output_after_run', False)
+output_retention_days = float(o.get('output_retention_days', 0))
+output_retention_keep_last = int(o.get('output_retention_keep_last', 0))
+output_retention_max_bytes = int(o.get('output_retention_max_bytes', 0))
+output_janitor_interval = float(o.get('output_janitor_interval', 300))
+output_janitor_files_per_second = int(o.get('output_janitor_files_per_second', 1000))
 archive_output_xml_to = o.get('archive_output_xml_to', '')
+output_summary = o.get('output_summary', True)
 postprocessing_command = o.get('postprocessing_command', '')
+deferred_steps = o.get('deferred_steps', [])
+if 'archive_output_xml' in deferred_steps:
+    # delete_output would delete output.xml before it was copied, and postprocessing usually reads the copy
+    deferred_steps = ['archive_output_xml', 'delete_output', 'postprocessing']
+deferred_workers = int(o.get('deferred_workers', 2))
 default_checkout_version = o.get('git_default_checkout_version', '')
+output_capture_head_bytes = int(o.get('output_capture_head_bytes', 65536))
+output_capture_tail_bytes = int(o.get('output_capture_tail_bytes', 65536))
+output_spool_filename = o.get('output_spool_filename', 'robot_console.txt')
+parallel_shards = int(o.get('parallel_shards', 1))
+run_cores_per_run = int(o.get('run_cores_per_run', 0))
+run_core_pool = o.get('run_core_pool')
+run_max_memory_bytes = int(o.get('run_max_memory_bytes', 0))
+run_max_open_files = int(o.get('run_max_open_files', 0))
+run_max_cpu_seconds = int(o.get('run_max_cpu_seconds', 0))
+run_nice = int(o.get('run_nice', 0))
+run_ionice_class = int(o.get('run_ionice_class', 0))
+run_ionice_level = int(o.get('run_ionice_level', 0))
+live_output = o.get('live_output', False)
+warm_robot_worker = o.get('warm_robot_worker', False)
+warm_robot_preload = o.get('warm_robot_preload', [])
+live_output_buffer_bytes = int(o.get('live_output_buffer_bytes', 1000000))
+progress_interval = float(o.get('progress_interval', 0))
+archive_compression_level = int(o.get('archive_compression_level', 6))
+archive_store_min_bytes = int(o.get('archive_store_min_bytes', 0))
+archive_artifact_patterns = o.get('archive_artifact_patterns', [])
+archive_stream_upload = o.get('archive_stream_upload', False)
+git_cache_directory = o.get('git_cache_directory', '')
+git_cache_min_fetch_interval = float(o.get('git_cache_min_fetch_interval', 0))
+git_shared_trees = o.get('git_shared_trees', False)
+git_shared_trees_max = int(o.get('git_shared_trees_max', 10))
+git_shared_trees_max_bytes = int(o.get('git_shared_trees_max_bytes', 0))
+venv_cache_directory = o.get('venv_cache_directory', '')
+venv_requirements_files = o.get('venv_requirements_files', ['requirements.txt'])
+venv_extra_packages = o.get('venv_extra_packages', ['robotframework'])
+venv_cache_max_bytes = int(o.get('venv_cache_max_bytes', 0))
+
+
+class OutputCapture():
+    """
+    Collects the output of a process in bounded memory
+
+    Only the first head_bytes and the last tail_bytes are kept in memory.
+    The full output can additionally be spooled to a file.
+    """
+    def __init__(self, head_bytes, tail_bytes, spool_path=None):
+        self._head_bytes = head_bytes
+        self._tail_bytes = tail_bytes
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._omitted = 0
+        self._spool_path = spool_path
+        self._spool = open(spool_path, 'wb') if spool_path else None
+
+    def write(self, chunk):
+        if self._spool:
+            self._spool.write(chunk)
+        n = self._head_bytes - len(self._head)
+        if n > 0:
+            self._head += chunk[:n]
+            chunk = chunk[n:]
+        self._tail += chunk
+        excess = len(self._tail) - self._tail_bytes
+        if excess > 0:
+            del self._tail[:excess]
+            self._omitted += excess
+
+    def close(self):
+        if self._spool:
+            self._spool.close()
+            self._spool = None
+
+    def getvalue(self):
+        """
+        :return: str : the captured output, with a marker where bytes were dropped
+        """
+        if not self._omitted:
+            return string23(bytes(self._head + self._tail))
+        if self._spool_path:
+            where = ', full output in %s' % self._spool_path
+        else:
+            where = ''
+        return '%s\n...(%d bytes omitted%s)...\n%s' % (string23(bytes(self._head)), self._omitted, where, string23(bytes(self._tail)))
 
 
 class ProcessRunner():
-    def __init__(self, logger):
+    READ_CHUNK_SIZE = 65536
+    # seconds a stop() is remembered if forget() is never called, e.g. for an execution that was not started
+    STOP_EXPIRY = 3600
+
+    def __init__(self, logger, head_bytes=65536, tail_bytes=65536, resources=None):
+        """
+        :param resources: RunResources : limits applied to the processes started with limit=True, see execute()
+        """
         self._logger = logger
+        self._head_bytes = head_bytes
+        self._tail_bytes = tail_bytes
+        self._resources = resources
         self._current_processes = {}
         self._stopping_processes = []
+        # identifier -> time of the stop()
+        self._stopped_groups = {}
+        self._lock = threading.Lock()
         self._running_on_windows = platform.system() == 'Windows'
 
-    def execute_throwing(self, command, identifier, env=None, directory=None):
-        o, c = self.execute(command, identifier, env=env, directory=directory)
+    def _in_stopped_group(self, identifier):
+        return any(identifier == g or identifier.startswith(g + '_') for g in self._stopped_groups)
+
+    def execute_throwing(self, command, identifier, env=None, directory=None, logger=None):
+        o, c = self.execute(command, identifier, env=env, directory=directory, logger=logger)
         if c:
-            s = 'Error: %d: %s failed: %s' % (c, command, o)
-            self._logger.error(s)
+            s = 'Error: %d: %s failed: %s' % (c, hide_passwords(command), o)
+            (logger or self._logger).error(s)
             raise Exception(s)
         return o, c
 
-    def execute(self, command, identifier, env=None, directory=None):
+    def execute(self, command, identifier, env=None, directory=None, spool_path=None, logger=None, on_output=None, launch=None,
+                limit=False, usage=None):
+        """
+        Runs command and waits for it to exit
+
+        :param command: str : command line, split on spaces
+        :param identifier: str : id to pass to stop() -- stop() of a prefix of it followed by '_' also stops it
+        :param env: dict
+        :param directory: str : working directory
+        :param spool_path: str : file to write the complete output to -- only the start and end of it are returned
+        :param logger: logging.Logger : logger for the command and its output instead of the one of the ProcessRunner
+        :param on_output: function taking bytes : called with each chunk of output as it is read -- must not block
+        :param launch: function taking (args, env, directory, limits) returning an object like subprocess.Popen whose pid is
+        also its process group, e.g. WarmRobotWorker.launch -- starts the command instead of subprocess.Popen
+        :param limit: bool : apply the resource limits of the ProcessRunner to the command
+        :param usage: ResourceUsage : to add the resource usage of the command and the processes it waited for to
+        :return: (str, int) : output and return code -- (None, -6000) if stopped by stop()
+        """
         env = env or {}
-        if True:
-            pcommand = command
-            pcommand = re.sub(r':[^@:]*@', ':(password hidden)@', pcommand)
-            pcommand = re.sub(r"CLOUDSHELL_PASSWORD:[^']*", 'CLOUDSHELL_PASSWORD:(password hidden)', pcommand)
+        logger = logger or self._logger
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
             penv = dict(env)
             if 'CLOUDSHELL_PASSWORD' in penv:
                 penv['CLOUDSHELL_PASSWORD'] = '(hidden)'
 
-            self._logger.debug('Execution %s: Running %s with env %s' % (identifier, pcommand, penv))
-        if self._running_on_windows:
-            process = subprocess.Popen(command.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False, env=env, cwd=directory)
-        else:
-            process = subprocess.Popen(command.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False, preexec_fn=os.setsid, env=env, cwd=directory)
-        self._current_processes[identifier] = process
-        output = ''
-        for line in iter(process.stdout.readline, b''):
-            line = string23(line)
-            self._logger.debug('Output line: %s' % line)
-            output += line
+            logger.debug('Execution %s: Running %s with env %s' % (identifier, hide_passwords(command), penv))
+        limits = None
+        if limit and self._resources and not self._running_on_windows:
+            limits = self._resources.allocate(identifier)
+        try:
+            return self._execute(command, identifier, env, directory, spool_path, logger, debug, on_output, launch, limits, usage)
+        finally:
+            if limits is not None:
+                self._resources.release(identifier)
+
+    def _execute(self, command, identifier, env, directory, spool_path, logger, debug, on_output, launch, limits, usage):
+        def preexec():
+            os.setsid()
+            if limits:
+                apply_limits(limits)
+
+        with self._lock:
+            if self._in_stopped_group(identifier):
+                return None, -6000
+            if launch is None:
+                if self._running_on_windows:
+                    process = subprocess.Popen(command.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False, env=env, cwd=directory)
+                else:
+                    process = subprocess.Popen(command.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=False, preexec_fn=preexec, env=env, cwd=directory)
+                self._current_processes[identifier] = process
+        if launch is not None:
+            # may have to wait for a worker to start, so not under the lock
+            process = launch(command.split(' '), env, directory, limits)
+            with self._lock:
+                self._current_processes[identifier] = process
+                if self._in_stopped_group(identifier):
+                    self._stopping_processes.append(identifier)
+                    process.kill()
+        capture = OutputCapture(self._head_bytes, self._tail_bytes, spool_path)
+        try:
+            for chunk in iter(lambda: process.stdout.read1(self.READ_CHUNK_SIZE), b''):
+                if debug:
+                    logger.debug('Execution %s: Output: %s' % (identifier, string23(chunk)))
+                if on_output:
+                    on_output(chunk)
+                capture.write(chunk)
+        finally:
+            capture.close()
+        output = capture.getvalue()
+        rusage = None
+        if launch is None and not self._running_on_windows:
+            # reaped here instead of by communicate() to get the resource usage
+            _, status, ru = os.wait4(process.pid, 0)
+            process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            rusage = rusage_to_dict(ru)
         process.communicate()
+        if launch is not None:
+            rusage = process.rusage
+        if usage is not None and rusage:
+            usage.add(rusage)
         self._current_processes.pop(identifier, None)
         if identifier in self._stopping_processes:
             self._stopping_processes.remove(identifier)
@@ -203,25 +565,1258 @@ class ProcessRunner():
         return output, process.returncode
 
     def stop(self, identifier):
+        """
+        Kills the process started with identifier and all processes whose identifier starts with identifier + '_',
+        such as the shards of a parallel run, and prevents new ones from starting until forget() is called or
+        STOP_EXPIRY seconds have passed
+        """
         self._logger.info('Received stop command for %s' % identifier)
-        process = self._current_processes.get(identifier)
+        with self._lock:
+            now = time.time()
+            for g in [g for g, t in self._stopped_groups.items() if now - t > self.STOP_EXPIRY]:
+                del self._stopped_groups[g]
+            self._stopped_groups[identifier] = now
+            processes = [(i, p) for i, p in self._current_processes.items() if i == identifier or i.startswith(identifier + '_')]
+            for i, process in processes:
+                self._stopping_processes.append(i)
+                try:
+                    if self._running_on_windows:
+                        process.kill()
+                    else:
+                        os.killpg(process.pid, signal.SIGTERM)
+                except OSError as e:
+                    self._logger.warning('Failed to stop %s: %s' % (i, str(e)))
+
+    def forget(self, identifier):
+        """
+        Clears a stop() of identifier once nothing started under it is running any more
+        """
+        with self._lock:
+            self._stopped_groups.pop(identifier, None)
+
+
+class WarmProcess():
+    """
+    A robot or rebot run forked by the warm worker, with the parts of the subprocess.Popen interface ProcessRunner uses
+    """
+    def __init__(self, pid, stdout, run):
+        self.pid = pid
+        self.stdout = stdout
+        self.returncode = None
+        # see rusage_to_dict(), once exited
+        self.rusage = None
+        self._run = run
+
+    def communicate(self):
+        self._run['exited'].wait()
+        self.returncode = self._run['returncode']
+        self.rusage = self._run.get('rusage')
+        self.stdout.close()
+        return None, None
+
+    def kill(self):
+        os.killpg(self.pid, signal.SIGKILL)
+
+
+class WarmRobotWorker():
+    """
+    Client of robot_warm_worker.py, a process that keeps Robot Framework and test libraries imported and forks
+    a child for each robot or rebot run, so runs skip interpreter startup and library imports
+
+    The worker is started on first use and restarted if it died. Each run's console output comes back through
+    a named pipe; the forked child leads its own process group, so ProcessRunner.stop() kills exactly that run.
+    """
+    START_TIMEOUT = 120
+    FORK_TIMEOUT = 60
+
+    def __init__(self, logger, preload=None):
+        self._logger = logger
+        self._preload = preload or []
+        self._lock = threading.Lock()
+        self._process = None
+        self._seq = 0
+        # request id -> dict with 'forked' and 'exited' events, 'pid', 'error', 'returncode'
+        self._runs = {}
+        self._fifo_directory = None
+
+    def _start(self):
+        if self._fifo_directory:
+            # left over from a worker that died
+            shutil.rmtree(self._fifo_directory, ignore_errors=True)
+        self._fifo_directory = tempfile.mkdtemp(prefix='robot_warm_worker_')
+        self._process = subprocess.Popen([sys.executable, WARM_WORKER_PATH] + self._preload,
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        ready = threading.Event()
+        th = threading.Thread(target=self._reply_thread, args=(self._process, ready))
+        th.daemon = True
+        th.start()
+        if not ready.wait(self.START_TIMEOUT):
+            self._process.kill()
+            raise Exception('Warm robot worker did not start within %d seconds' % self.START_TIMEOUT)
+        self._logger.info('Started warm robot worker %d' % self._process.pid)
+
+    def _reply_thread(self, process, ready):
+        for line in process.stdout:
+            # a preloaded module may print to stdout before the worker redirects it -- not a reply
+            try:
+                o = json.loads(string23(line))
+            except ValueError:
+                o = None
+            if not isinstance(o, dict):
+                self._logger.warning('Warm robot worker: ignoring output that is not a reply: %r' % line.rstrip())
+                continue
+            if o.get('ready'):
+                for module, error in o['preload_errors'].items():
+                    self._logger.warning('Warm robot worker failed to import %s: %s' % (module, error))
+                ready.set()
+                continue
+            with self._lock:
+                run = self._runs.get(o['id'])
+                if run is None:
+                    continue
+                if 'returncode' in o:
+                    del self._runs[o['id']]
+            if 'pid' in o or 'error' in o:
+                run['pid'] = o.get('pid')
+                run['error'] = o.get('error')
+                run['forked'].set()
+            else:
+                run['returncode'] = o['returncode']
+                run['rusage'] = o.get('rusage')
+                run['exited'].set()
+        process.wait()
+        self._logger.warning('Warm robot worker %d exited with code %s' % (process.pid, process.returncode))
+        with self._lock:
+            if self._process is process:
+                self._process = None
+            runs = list(self._runs.values())
+            self._runs = {}
+        for run in runs:
+            run['error'] = run.get('error') or 'Warm robot worker exited'
+            run['returncode'] = 255
+            run['forked'].set()
+            run['exited'].set()
+
+    def start(self):
+        """
+        Starts the worker unless it is running -- otherwise the first launch() starts it
+        """
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self._start()
+
+    def launch(self, args, env, directory, limits=None):
+        """
+        Forks a robot or rebot run in the worker
+
+        :param args: list of str : command line, starting with robot or rebot
+        :param env: dict : complete environment of the run
+        :param directory: str : working directory, None for the current one of this process
+        :param limits: dict : resource limits for the run, see RunResources.allocate()
+        :return: WarmProcess
+        """
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self._start()
+            self._seq += 1
+            request_id = self._seq
+            run = {'forked': threading.Event(), 'exited': threading.Event(), 'pid': None, 'error': None, 'returncode': None}
+            self._runs[request_id] = run
+            fifo = os.path.join(self._fifo_directory, '%d.fifo' % request_id)
+            os.mkfifo(fifo)
+            # opened without blocking now so the worker can open the writing end right away
+            fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                self._process.stdin.write((json.dumps({
+                    'id': request_id,
+                    'args': args,
+                    'env': env,
+                    'cwd': directory or os.getcwd(),
+                    'output': fifo,
+                    'limits': limits,
+                }) + '\n').encode('utf-8'))
+                self._process.stdin.flush()
+            except Exception:
+                os.close(fd)
+                os.remove(fifo)
+                raise
+        try:
+            if not run['forked'].wait(self.FORK_TIMEOUT):
+                raise Exception('Warm robot worker did not start %s within %d seconds' % (args[0], self.FORK_TIMEOUT))
+            if run['error']:
+                raise Exception('Warm robot worker failed to start %s: %s' % (args[0], run['error']))
+        except Exception:
+            os.close(fd)
+            raise
+        finally:
+            os.remove(fifo)
+        # the child holds the writing end now: reads can block until it exits
+        if fcntl is not None:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        return WarmProcess(run['pid'], os.fdopen(fd, 'rb'), run)
+
+    def stop(self):
+        with self._lock:
+            process = self._process
+            self._process = None
         if process is not None:
-            self._stopping_processes.append(identifier)
-            if self._running_on_windows:
-                process.kill()
+            # the worker stops its runs when its input closes
+            process.stdin.close()
+            process.wait()
+        if self._fifo_directory:
+            shutil.rmtree(self._fifo_directory, ignore_errors=True)
+
+
+class RobotProgress():
+    """
+    Follows the event files written by robot_live_listener.py while robot runs
+
+    A background thread reads new lines from the files every POLL_INTERVAL seconds, counts finished tests
+    and passes each event to on_event. on_progress is called with summary() at most every progress_interval
+    seconds while the progress changes.
+    """
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, paths, logger, on_event=None, on_progress=None, progress_interval=0):
+        self._paths = paths
+        self._logger = logger
+        self._on_event = on_event
+        self._on_progress = on_progress
+        self._progress_interval = progress_interval
+        self._offsets = dict((p, 0) for p in paths)
+        self._partial = dict((p, b'') for p in paths)
+        self._stop = threading.Event()
+        self._thread = None
+        self.passed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.current_test = ''
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops following the files after reading what is left in them
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def summary(self):
+        s = '%d passed, %d failed' % (self.passed, self.failed)
+        if self.skipped:
+            s += ', %d skipped' % self.skipped
+        if self.current_test:
+            s += ', running %s' % self.current_test
+        return s
+
+    def _read(self):
+        for path in self._paths:
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(self._offsets[path])
+                    data = f.read()
+            except IOError:
+                continue
+            if not data:
+                continue
+            self._offsets[path] += len(data)
+            lines = (self._partial[path] + data).split(b'\n')
+            self._partial[path] = lines.pop()
+            for line in lines:
+                try:
+                    o = json.loads(string23(line))
+                except ValueError:
+                    continue
+                if o['event'] == 'start_test':
+                    self.current_test = o['name']
+                elif o['event'] == 'end_test':
+                    self.current_test = ''
+                    if o['status'] == 'PASS':
+                        self.passed += 1
+                    elif o['status'] == 'SKIP':
+                        self.skipped += 1
+                    else:
+                        self.failed += 1
+                if self._on_event:
+                    self._on_event(string23(line))
+
+    def _run(self):
+        last_progress = ''
+        last_progress_time = time.time()
+        while True:
+            stopping = self._stop.wait(self.POLL_INTERVAL)
+            try:
+                self._read()
+                if self._on_progress and time.time() - last_progress_time >= self._progress_interval and self.summary() != last_progress:
+                    last_progress = self.summary()
+                    last_progress_time = time.time()
+                    self._on_progress(last_progress)
+            except Exception as e:
+                self._logger.warning('Reading robot progress failed: %s' % str(e))
+            if stopping:
+                return
+
+
+def robot_suite_name(name):
+    """
+    :param name: str : suite file name without extension, or suite directory name
+    :return: str : the suite name Robot derives from it -- Robot matches suite names ignoring case, spaces and underscores
+    """
+    if '__' in name:
+        name = name.split('__', 1)[1] or name
+    return name
+
+
+def split_robot_suites(directory, shards):
+    """
+    Splits the child suites of a Robot test directory into groups of roughly equal size
+
+    :param directory: str : test directory
+    :param shards: int : maximum number of groups
+    :return: list of list of str : child suite names per group, empty if there are fewer than two child suites
+    """
+    children = []
+    for fn in sorted(os.listdir(directory)):
+        if fn.startswith('_') or fn.startswith('.'):
+            continue
+        path = os.path.join(directory, fn)
+        if os.path.isfile(path) and fn.endswith('.robot'):
+            size = os.path.getsize(path)
+        elif os.path.isdir(path):
+            size = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files if f.endswith('.robot'))
+            if not size:
+                continue
+        else:
+            continue
+        children.append((size, os.path.splitext(fn)[0] if os.path.isfile(path) else fn))
+    if len(children) < 2:
+        return []
+    # largest first into the currently smallest group
+    groups = [[0, []] for _ in range(min(shards, len(children)))]
+    for size, fn in sorted(children, reverse=True):
+        group = min(groups, key=lambda g: g[0])
+        group[0] += size
+        group[1].append(robot_suite_name(fn))
+    return [names for _, names in groups]
+
+
+class GitMirrorCache():
+    """
+    Local bare mirror of the test repo, shared by all executions on this host
+
+    The mirror is cloned once and then updated with an incremental fetch. Each execution gets a
+    detached worktree of the mirror instead of a full clone. Fetches of a mirror are serialized with a
+    thread lock per mirror and, on platforms that support it, a file lock, so several threads or several
+    execution server processes can share one cache directory. Worktrees are added and pruned without
+    the lock: git marks a worktree as locked until it is set up, so a concurrent prune leaves it alone.
+    """
+    # mirror directory -> lock held while fetching it
+    _fetch_locks = {}
+    _fetch_locks_lock = threading.Lock()
+
+    def __init__(self, cache_directory, repo_url, process_runner, logger, min_fetch_interval=0):
+        self._repo_url = repo_url
+        self._process_runner = process_runner
+        self._logger = logger
+        self._min_fetch_interval = min_fetch_interval
+        # hash the URL without credentials so a changed password reuses the same mirror
+        key = hashlib.sha1(re.sub(r'//[^@/]*@', '//', repo_url).encode('utf-8')).hexdigest()[:16]
+        os.makedirs(cache_directory, exist_ok=True)
+        self._mirror_dir = os.path.join(cache_directory, '%s.git' % key)
+        self._lock_filename = os.path.join(cache_directory, '%s.lock' % key)
+        with GitMirrorCache._fetch_locks_lock:
+            self._lock = GitMirrorCache._fetch_locks.setdefault(os.path.abspath(self._mirror_dir), threading.Lock())
+        self._last_fetch_started = 0
+        self._last_fetch_finished = 0
+
+    def _acquire(self):
+        self._lock.acquire()
+        if fcntl is None:
+            return None
+        lockfile = open(self._lock_filename, 'w')
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        return lockfile
+
+    def _release(self, lockfile):
+        if lockfile is not None:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
+        self._lock.release()
+
+    def _update(self, identifier, requested_at):
+        # Another thread started a fetch after we asked for one: its result is at least as fresh as ours would be
+        if self._last_fetch_started >= requested_at:
+            return
+        if self._last_fetch_finished and time.time() - self._last_fetch_finished < self._min_fetch_interval:
+            return
+        self._last_fetch_started = time.time()
+        if not os.path.exists(os.path.join(self._mirror_dir, 'HEAD')):
+            self._logger.info('Creating git mirror %s' % self._mirror_dir)
+            self._process_runner.execute_throwing('git clone --mirror %s %s' % (self._repo_url, self._mirror_dir), identifier + '_gitmirror')
+        else:
+            self._process_runner.execute_throwing('git fetch --prune', identifier + '_gitfetch', directory=self._mirror_dir)
+        self._last_fetch_finished = time.time()
+
+    def checkout(self, version, directory, identifier):
+        """
+        Fetches the mirror and checks out version (branch, tags/TAG or commit id; mirror HEAD if empty) into directory
+
+        :param version: str
+        :param directory: str : must not exist or be empty
+        :param identifier: str : prefix for the ids of the git processes
+        :return: None
+        """
+        requested_at = time.time()
+        lockfile = self._acquire()
+        try:
+            self._update(identifier, requested_at)
+        finally:
+            self._release(lockfile)
+        self._process_runner.execute_throwing('git --git-dir=%s worktree add --detach %s %s' % (self._mirror_dir, directory, version or 'HEAD'), identifier + '_gitworktree')
+
+    def resolve(self, version, identifier):
+        """
+        Fetches the mirror and resolves version (branch, tags/TAG or commit id; mirror HEAD if empty) to a commit id
+
+        :param version: str
+        :param identifier: str : prefix for the ids of the git processes
+        :return: str : full commit id
+        """
+        requested_at = time.time()
+        lockfile = self._acquire()
+        try:
+            self._update(identifier, requested_at)
+        finally:
+            self._release(lockfile)
+        output, _ = self._process_runner.execute_throwing('git --git-dir=%s rev-parse --verify %s^{commit}' % (self._mirror_dir, version or 'HEAD'), identifier + '_gitrevparse')
+        return string23(output).strip()
+
+    def export(self, commit, directory, identifier):
+        """
+        Writes the files of commit into directory without fetching first. Afterwards directory is a plain
+        directory, not a worktree.
+
+        :param commit: str : commit id, see resolve()
+        :param directory: str : must not exist or be empty
+        :param identifier: str : prefix for the ids of the git processes
+        :return: None
+        """
+        self._process_runner.execute_throwing('git --git-dir=%s worktree add --detach %s %s' % (self._mirror_dir, directory, commit), identifier + '_gitworktree')
+        os.remove(os.path.join(directory, '.git'))
+        self._process_runner.execute('git --git-dir=%s worktree prune' % self._mirror_dir, identifier + '_gitprune')
+
+    def release(self, directory, identifier):
+        """
+        Detaches the worktree in directory from the mirror, leaving the checked out files in place,
+        and prunes worktrees whose directories no longer exist
+
+        :param directory: str
+        :param identifier: str
+        :return: None
+        """
+        try:
+            os.remove(os.path.join(directory, '.git'))
+        except OSError:
+            # already deleted along with the directory
+            pass
+        self._process_runner.execute('git --git-dir=%s worktree prune' % self._mirror_dir, identifier + '_gitprune')
+
+
+class SharedDirectoryCache():
+    """
+    Base of the caches of directories shared by executions, one per key, like SharedSourceTrees and VirtualenvCache
+
+    Directories are reference counted while executions use them, see _use() and release(); unused ones are kept
+    for later executions and deleted least recently used first, by modification time, when there are more than
+    max_entries of them or, if max_bytes is set, when all of them together take more than max_bytes. Unused
+    directories are picked holding the lock but deleted after releasing it, so other executions don't wait for
+    the deletion. An execution holds a shared file lock on <key>.lock while it uses a directory, so several
+    execution server processes can share the directory without deleting each other's directories.
+    """
+    # what the directories are, for log messages
+    KIND = 'directory'
+
+    def __init__(self, directory, logger, max_entries=None, max_bytes=0):
+        """
+        :param directory: str : created if missing
+        :param logger: logging.Logger
+        :param max_entries: int : number of directories to keep, None for no limit
+        :param max_bytes: int : disk budget for all directories together, 0 for no limit
+        """
+        self._directory = directory
+        self._logger = logger
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        # notified when directories have been deleted
+        self._lock = threading.Condition()
+        # key -> number of executions using the directory
+        self._refcounts = {}
+        # key -> open lock file holding a shared lock while the directory is in use
+        self._lockfiles = {}
+        # key -> bytes on disk
+        self._sizes = {}
+        # key -> lock held while creating the directory
+        self._create_locks = {}
+        # keys of the directories being deleted
+        self._deleting = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def _size(self, key):
+        """
+        :return: int : bytes on disk, counted once and remembered -- called holding self._lock, like every use of self._sizes
+        """
+        size = self._sizes.get(key)
+        if size is None:
+            size = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(os.path.join(self._directory, key))
+                       for f in files if not os.path.islink(os.path.join(d, f)))
+            self._sizes[key] = size
+        return size
+
+    def _use(self, key):
+        """
+        Counts one more execution using the directory of key -- pass key to release() when done
+
+        :return: threading.Lock : to hold while creating the directory, so only one execution creates it
+        """
+        with self._lock:
+            # created again once the deletion is done
+            while key in self._deleting:
+                self._lock.wait()
+            self._refcounts[key] = self._refcounts.get(key, 0) + 1
+            if key not in self._lockfiles and fcntl is not None:
+                lockfile = open(os.path.join(self._directory, key + '.lock'), 'w')
+                fcntl.flock(lockfile, fcntl.LOCK_SH)
+                self._lockfiles[key] = lockfile
+            return self._create_locks.setdefault(key, threading.Lock())
+
+    def release(self, key):
+        """
+        Marks the directory of key as unused by one execution, then deletes unused directories beyond the limits
+
+        :param key: str : as returned by acquire()
+        :return: None
+        """
+        with self._lock:
+            self._refcounts[key] -= 1
+            if self._refcounts[key] == 0:
+                del self._refcounts[key]
+                self._create_locks.pop(key, None)
+                lockfile = self._lockfiles.pop(key, None)
+                if lockfile is not None:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+                    lockfile.close()
+            victims = self._choose_victims()
+        # deleting takes a while, other executions shouldn't wait for it
+        try:
+            for victim, _ in victims:
+                self._logger.info('Deleting unused %s %s' % (self.KIND, victim))
+                self._delete(os.path.join(self._directory, victim))
+        finally:
+            with self._lock:
+                for victim, lockfile in victims:
+                    if lockfile is not None:
+                        fcntl.flock(lockfile, fcntl.LOCK_UN)
+                        lockfile.close()
+                    self._sizes.pop(victim, None)
+                    self._deleting.discard(victim)
+                self._lock.notify_all()
+
+    def _delete(self, path):
+        shutil.rmtree(path, ignore_errors=True)
+
+    def _choose_victims(self):
+        """
+        Picks unused directories beyond the limits, oldest first, and marks them as being deleted -- called holding self._lock
+
+        :return: list of (str, file) : key and the lock file holding an exclusive lock on the directory, None without fcntl
+        """
+        if self._max_entries is None and not self._max_bytes:
+            return []
+        entries = []
+        for fn in os.listdir(self._directory):
+            p = os.path.join(self._directory, fn)
+            # .tmp: being created
+            if os.path.isdir(p) and not fn.endswith('.tmp') and fn not in self._deleting:
+                entries.append((os.path.getmtime(p), fn))
+        entries.sort()
+        total = sum(self._size(k) for _, k in entries) if self._max_bytes else 0
+        count = len(entries)
+        victims = []
+        for _, key in entries:
+            if (self._max_entries is None or count <= self._max_entries) and (not self._max_bytes or total <= self._max_bytes):
+                break
+            if key in self._refcounts:
+                continue
+            lockfile = None
+            if fcntl is not None:
+                lockfile = open(os.path.join(self._directory, key + '.lock'), 'w')
+                try:
+                    fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    # in use by another process
+                    lockfile.close()
+                    continue
+            self._deleting.add(key)
+            victims.append((key, lockfile))
+            if self._max_bytes:
+                total -= self._size(key)
+            count -= 1
+        return victims
+
+
+class SharedSourceTrees(SharedDirectoryCache):
+    """
+    Read-only source trees of the test repo, one per commit, shared by all executions at that commit
+
+    Each tree is exported from a GitMirrorCache into <directory>/<commit id> the first time an execution
+    needs that commit. Unused trees are deleted when there are more than max_trees of them or, if max_bytes
+    is set, when all trees together take more than max_bytes, see SharedDirectoryCache.
+    """
+    KIND = 'source tree'
+
+    def __init__(self, git_cache, directory, logger, max_trees=10, max_bytes=0):
+        SharedDirectoryCache.__init__(self, directory, logger, max_entries=max_trees, max_bytes=max_bytes)
+        self._git_cache = git_cache
+
+    def acquire(self, version, identifier):
+        """
+        Resolves version to a commit and returns its tree, exporting it first if needed
+
+        :param version: str : branch, tags/TAG or commit id; mirror HEAD if empty
+        :param identifier: str : prefix for the ids of the git processes
+        :return: (str, str) : commit id to pass to release(), and the directory of the tree
+        """
+        commit = self._git_cache.resolve(version, identifier)
+        path = os.path.join(self._directory, commit)
+        export_lock = self._use(commit)
+        try:
+            # the first execution at a commit exports the tree, the others wait for it and reuse it
+            with export_lock:
+                if not os.path.isdir(path):
+                    tmppath = '%s.%s.tmp' % (path, identifier)
+                    self._logger.info('Exporting source tree %s for %s' % (commit, version or 'HEAD'))
+                    self._git_cache.export(commit, tmppath, identifier)
+                    for d, _, files in os.walk(tmppath):
+                        for fn in files:
+                            p = os.path.join(d, fn)
+                            if not os.path.islink(p):
+                                os.chmod(p, os.stat(p).st_mode & ~0o222)
+                    try:
+                        os.rename(tmppath, path)
+                    except OSError:
+                        # exported concurrently by another process
+                        shutil.rmtree(tmppath, ignore_errors=True)
+                else:
+                    self._logger.info('Reusing source tree %s for %s' % (commit, version or 'HEAD'))
+            # the modification time of the tree orders trees for deletion
+            os.utime(path, None)
+        except Exception:
+            self.release(commit)
+            raise
+        return commit, path
+
+    def _delete(self, path):
+        # the files were made read-only
+        for d, _, files in os.walk(path):
+            for fn in files:
+                p = os.path.join(d, fn)
+                if not os.path.islink(p):
+                    os.chmod(p, 0o644)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class VirtualenvCache(SharedDirectoryCache):
+    """
+    Python virtualenvs with the dependencies of the test repo, one per requirements file content, shared by all
+    executions needing the same dependencies
+
+    The requirements file of a checkout is hashed together with the Python version and extra_packages; the first
+    execution with a new hash creates <directory>/<hash> with python -m venv and pip installs into it, and later
+    executions reuse it. Virtualenvs can't be moved after they are created, so they are built in place, holding
+    an exclusive file lock on <hash>.build.lock, and marked complete at the end; a virtualenv that was not
+    completed is rebuilt. Unused virtualenvs are deleted while all of them together take more than max_bytes,
+    see SharedDirectoryCache.
+    """
+    KIND = 'virtualenv'
+    COMPLETE_FILENAME = '.ces_complete'
+
+    def __init__(self, directory, process_runner, logger, extra_packages=None, max_bytes=0):
+        """
+        :param directory: str : created if missing
+        :param process_runner: ProcessRunner
+        :param logger: logging.Logger
+        :param extra_packages: list of str : pip requirement specifiers installed along with the requirements file, e.g. robotframework
+        :param max_bytes: int : disk budget for unused virtualenvs, 0 for no limit
+        """
+        SharedDirectoryCache.__init__(self, os.path.abspath(directory), logger, max_bytes=max_bytes)
+        self._process_runner = process_runner
+        self._extra_packages = extra_packages or []
+        self._bin = 'Scripts' if platform.system() == 'Windows' else 'bin'
+
+    def _key(self, requirements_path):
+        h = hashlib.sha256()
+        h.update(('%s\n%s\n' % (sys.version, ' '.join(self._extra_packages))).encode('utf-8'))
+        with open(requirements_path, 'rb') as f:
+            h.update(f.read())
+        return h.hexdigest()[:16]
+
+    def acquire(self, requirements_path, identifier):
+        """
+        Returns the virtualenv for requirements_path, building it first if needed
+
+        :param requirements_path: str : pip requirements file
+        :param identifier: str : prefix for the ids of the venv and pip processes
+        :return: (str, str) : hash to pass to release(), and the directory of the python, robot and rebot executables
+        """
+        key = self._key(requirements_path)
+        path = os.path.join(self._directory, key)
+        build_lock = self._use(key)
+        try:
+            with build_lock:
+                if os.path.isfile(os.path.join(path, self.COMPLETE_FILENAME)):
+                    self._logger.info('Reusing virtualenv %s for %s' % (key, requirements_path))
+                else:
+                    lockfile = None
+                    if fcntl is not None:
+                        # another process may be building it
+                        lockfile = open(path + '.build.lock', 'w')
+                        fcntl.flock(lockfile, fcntl.LOCK_EX)
+                    try:
+                        if not os.path.isfile(os.path.join(path, self.COMPLETE_FILENAME)):
+                            self._build(key, path, requirements_path, identifier)
+                    finally:
+                        if lockfile is not None:
+                            fcntl.flock(lockfile, fcntl.LOCK_UN)
+                            lockfile.close()
+            # the modification time of the virtualenv orders virtualenvs for deletion
+            os.utime(path, None)
+        except Exception:
+            self.release(key)
+            raise
+        return key, os.path.join(path, self._bin)
+
+    def _build(self, key, path, requirements_path, identifier):
+        if os.path.isdir(path):
+            self._logger.warning('Deleting incomplete virtualenv %s' % key)
+            shutil.rmtree(path, ignore_errors=True)
+        self._logger.info('Building virtualenv %s for %s' % (key, requirements_path))
+        # pip needs proxy settings and the like from the environment of the server
+        env = dict(os.environ)
+        try:
+            self._process_runner.execute_throwing('%s -m venv %s' % (sys.executable, path), identifier + '_venv', env=env)
+            self._process_runner.execute_throwing(' '.join([os.path.join(path, self._bin, 'python'), '-m', 'pip', 'install', '--disable-pip-version-check',
+                                                            '-r', requirements_path] + self._extra_packages), identifier + '_pip', env=env)
+        except Exception:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+        with open(os.path.join(path, self.COMPLETE_FILENAME), 'w') as f:
+            f.write(requirements_path + '\n')
+        # release() may be counting the sizes in another thread
+        with self._lock:
+            self._sizes.pop(key, None)
+
+
+class ArchiveStream():
+    """
+    Read end of the pipe ResultArchiver.open_stream() writes the zip to
+
+    Raises the error of the archiver thread at the end instead of returning a clean EOF, so a truncated zip
+    fails the upload instead of being reported as uploaded.
+    """
+    def __init__(self, reader):
+        self._reader = reader
+        # set by the archiver thread if writing the zip failed
+        self.error = None
+
+    def read(self, size=-1):
+        data = self._reader.read(size)
+        if self.error is not None and (not data or size is None or size < 0):
+            raise self.error
+        return data
+
+    def close(self):
+        self._reader.close()
+
+
+class ResultArchiver():
+    """
+    Builds the results zip in-process, streaming each file into the archive in chunks
+    """
+    ROBOT_OUTPUT_FILES = ['output.xml', 'log.html', 'report.html', OUTPUT_SUMMARY_FILENAME, RESOURCE_USAGE_FILENAME]
+
+    def __init__(self, logger, compression_level=6, store_min_bytes=0, artifact_patterns=None):
+        self._logger = logger
+        self._compression_level = compression_level
+        self._store_min_bytes = store_min_bytes
+        self._artifact_patterns = artifact_patterns or []
+
+    def members(self, outdir):
+        """
+        :param outdir: str
+        :return: list of (path, name in archive) : Robot output files and artifacts found in outdir
+        """
+        rv = [('%s/%s' % (outdir, fn), fn) for fn in self.ROBOT_OUTPUT_FILES if os.path.isfile('%s/%s' % (outdir, fn))]
+        seen = set(path for path, _ in rv)
+        for pattern in self._artifact_patterns:
+            for path in sorted(glob.glob(os.path.join(outdir, pattern))):
+                if os.path.isfile(path) and path not in seen:
+                    seen.add(path)
+                    rv.append((path, os.path.relpath(path, outdir)))
+        return rv
+
+    def write(self, fileobj, members):
+        """
+        Writes a zip of members to fileobj, which does not need to be seekable
+
+        :param fileobj: file-like
+        :param members: list of (path, name in archive)
+        """
+        with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for path, arcname in members:
+                if self._compression_level == 0 or (self._store_min_bytes and os.path.getsize(path) >= self._store_min_bytes):
+                    zf.write(path, arcname, compress_type=zipfile.ZIP_STORED)
+                else:
+                    zf.write(path, arcname, compress_type=zipfile.ZIP_DEFLATED, compresslevel=self._compression_level)
+
+    def write_file(self, zippath, members):
+        with open(zippath, 'wb') as f:
+            self.write(f, members)
+
+    def open_stream(self, members, identifier):
+        """
+        Starts building the zip in a background thread and returns the read end of a pipe it is written to
+
+        Closing the returned file before reaching the end aborts the archiver thread.
+
+        :param members: list of (path, name in archive)
+        :param identifier: str : for log messages
+        :return: file-like
+        """
+        r, w = os.pipe()
+        reader = ArchiveStream(os.fdopen(r, 'rb'))
+        writer = os.fdopen(w, 'wb')
+
+        def archiver_thread():
+            try:
+                self.write(writer, members)
+            except Exception as e:
+                self._logger.warning('Execution %s: Archive stream aborted: %s' % (identifier, str(e)))
+                # set before closing the writer, so the reader sees it at EOF
+                reader.error = e
+            finally:
+                try:
+                    writer.close()
+                except Exception:
+                    pass
+
+        th = threading.Thread(target=archiver_thread)
+        th.daemon = True
+        th.start()
+        return reader
+
+
+class OutputJanitor():
+    """
+    Deletes old output directories of executions in the background, by age, by number per test and by total size
+
+    Output directories are found by matching the directories under the fixed start of the unique_output_directory
+    pattern against the pattern, %N identifying the test. A scan only lists directories down to the depth of the
+    pattern; the size of each output directory is counted once when it is first seen finished and remembered, so
+    only new directories are walked. Directories of running executions, see begin() and end(), are never deleted.
+    Files are deleted at a limited rate so the janitor doesn't starve running executions of disk I/O.
+
+    Run only one janitor per output directory tree: it can't tell which directories other servers are still using.
+    """
+    def __init__(self, pattern, logger, metrics, max_age=0, max_bytes=0, keep_last=0, interval=300, files_per_second=1000):
+        """
+        :param pattern: str : unique_output_directory, with %R, %N, %V and %T
+        :param logger: logging.Logger
+        :param metrics: Metrics
+        :param max_age: float : seconds after which an output directory is deleted, 0 to keep them regardless of age
+        :param max_bytes: int : delete the oldest output directories while all together are larger than this, 0 for no limit
+        :param keep_last: int : keep only this many newest output directories per test, 0 for no limit
+        :param interval: float : seconds between scans
+        :param files_per_second: int : maximum rate of deleting files, 0 for no limit
+        """
+        pattern = os.path.abspath(pattern)
+        self._root = os.path.dirname(pattern[:pattern.index('%')])
+        self._regex = self._pattern_regex(pattern)
+        # the test path and the version can contain slashes, e.g. tags/1.0
+        self._max_depth = pattern[len(self._root):].count(os.sep) + (3 if '%N' in pattern or '%V' in pattern else 0)
+        self._logger = logger
+        self._metrics = metrics
+        self._max_age = max_age
+        self._max_bytes = max_bytes
+        self._keep_last = keep_last
+        self._interval = interval
+        self._files_per_second = files_per_second
+        self._lock = threading.Lock()
+        # path -> [size, mtime, test]
+        self._dirs = {}
+        # path -> number of executions using it
+        self._in_use = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._metrics.define_gauge('ces_output_bytes', 'Size of the output directories counted by the janitor',
+                                   lambda: sum(d[0] or 0 for d in list(self._dirs.values())))
+        self._metrics.define_counter('ces_output_deleted_total', 'Output directories deleted by the janitor by reason')
+
+    @staticmethod
+    def _pattern_regex(pattern):
+        parts = []
+        for p in re.split(r'(%[RNVT])', pattern):
+            if p == '%N':
+                parts.append('(?P=test)' if '(?P<test>' in ''.join(parts) else '(?P<test>.+)')
+            elif p == '%R':
+                parts.append('[^%s]+' % re.escape(os.sep))
+            elif p == '%V':
+                parts.append('.*?')
+            elif p == '%T':
+                parts.append(r'\d{4}-\d\d-\d\d_\d\d\.\d\d\.\d\d')
             else:
-                os.killpg(process.pid, signal.SIGTERM)
+                parts.append(re.escape(p))
+        return re.compile(''.join(parts) + '$')
+
+    def begin(self, outdir):
+        """
+        Protects outdir from deletion while an execution uses it
+        """
+        with self._lock:
+            self._in_use[outdir] = self._in_use.get(outdir, 0) + 1
+
+    def end(self, outdir):
+        """
+        Makes outdir subject to the retention rules again, counting its size on the next scan
+        """
+        with self._lock:
+            self._in_use[outdir] -= 1
+            if self._in_use[outdir] == 0:
+                del self._in_use[outdir]
+            # counted again, the execution may have added files
+            self._dirs.pop(outdir, None)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._janitor_thread)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _janitor_thread(self):
+        self._logger.info('Output janitor watching %s' % self._root)
+        while not self._stop.is_set():
+            try:
+                self._scan()
+                self._collect()
+            except Exception as e:
+                self._logger.error('Output janitor: %s: %s' % (str(e), traceback.format_exc()))
+            self._stop.wait(self._interval)
+
+    def _scan(self):
+        found = {}
+        stack = [(self._root, 0)]
+        while stack:
+            d, depth = stack.pop()
+            try:
+                entries = os.listdir(d)
+            except OSError:
+                continue
+            for fn in entries:
+                p = os.path.join(d, fn)
+                if not os.path.isdir(p) or os.path.islink(p):
+                    continue
+                m = self._regex.match(p)
+                if m:
+                    found[p] = m.groupdict().get('test', '')
+                elif depth + 1 < self._max_depth:
+                    stack.append((p, depth + 1))
+        with self._lock:
+            for p in list(self._dirs.keys()):
+                if p not in found:
+                    # deleted by delete_output_after_run or by hand
+                    del self._dirs[p]
+            new = [p for p in found if p not in self._dirs and p not in self._in_use]
+        for p in new:
+            if self._stop.is_set():
+                return
+            try:
+                mtime = os.path.getmtime(p)
+                size = 0
+                for d, _, files in os.walk(p):
+                    for fn in files:
+                        try:
+                            size += os.lstat(os.path.join(d, fn)).st_size
+                        except OSError:
+                            pass
+            except OSError:
+                continue
+            with self._lock:
+                if p not in self._in_use:
+                    self._dirs[p] = [size, mtime, found[p]]
+
+    def _collect(self):
+        now = time.time()
+        with self._lock:
+            # oldest first
+            dirs = sorted((v[1], p, v[2], v[0]) for p, v in self._dirs.items())
+        # path -> reason, oldest first
+        doomed = {}
+        if self._max_age:
+            for mtime, p, _, _ in dirs:
+                if now - mtime > self._max_age:
+                    doomed[p] = 'age'
+        if self._keep_last:
+            per_test = {}
+            for _, p, test, _ in reversed(dirs):
+                per_test[test] = per_test.get(test, 0) + 1
+                if per_test[test] > self._keep_last:
+                    doomed.setdefault(p, 'keep_last')
+        if self._max_bytes:
+            left = sum(size for _, p, _, size in dirs if p not in doomed)
+            for _, p, _, size in dirs:
+                if left <= self._max_bytes:
+                    break
+                if p not in doomed:
+                    doomed[p] = 'size'
+                    left -= size
+        for _, p, _, size in dirs:
+            if p not in doomed:
+                continue
+            if self._stop.is_set():
+                return
+            with self._lock:
+                if p in self._in_use or p not in self._dirs:
+                    continue
+            self._logger.info('Output janitor: deleting %s (%d bytes, %s)' % (p, size, doomed[p]))
+            self._delete(p)
+            with self._lock:
+                self._dirs.pop(p, None)
+            self._metrics.inc('ces_output_deleted_total', reason=doomed[p])
+
+    def _delete(self, path):
+        n = 0
+        for d, dirs, files in os.walk(path, topdown=False):
+            for fn in files:
+                try:
+                    os.remove(os.path.join(d, fn))
+                except OSError:
+                    pass
+                n += 1
+                if self._files_per_second and n % 100 == 0:
+                    if self._stop.wait(100.0 / self._files_per_second):
+                        return
+            for fn in dirs:
+                p = os.path.join(d, fn)
+                try:
+                    if os.path.islink(p):
+                        os.remove(p)
+                    else:
+                        os.rmdir(p)
+                except OSError:
+                    pass
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+        # parent directories from the pattern, like %R, once they are empty
+        parent = os.path.dirname(path)
+        while parent.startswith(self._root + os.sep):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+
+class DeferredStage():
+    """
+    Runs steps of executions that don't affect their result, like copying or deleting output, in background
+    threads after the result was returned, so they don't delay the result or hold a worker slot
+
+    Each execution submits its deferred steps as one job; the steps of a job run one after the other, in order.
+    Progress is logged and counted in metrics ces_deferred_jobs_pending and ces_deferred_steps_total, and step
+    durations are observed in ces_execution_phase_seconds like the other phases.
+    """
+    def __init__(self, logger, metrics, workers=2):
+        """
+        :param logger: logging.Logger
+        :param metrics: Metrics
+        :param workers: int : maximum number of jobs running at the same time
+        """
+        self._logger = logger
+        self._metrics = metrics
+        self._workers = workers
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        # jobs submitted and not finished
+        self._pending = 0
+        self._metrics.define_gauge('ces_deferred_jobs_pending', 'Executions with deferred steps queued or running', lambda: self._pending)
+        self._metrics.define_counter('ces_deferred_steps_total', 'Deferred steps run by step and outcome')
+
+    def start(self):
+        """
+        Starts the worker threads -- submitted jobs wait until then
+        """
+        for _ in range(self._workers):
+            th = threading.Thread(target=self._worker_thread)
+            th.daemon = True
+            th.start()
+            self._threads.append(th)
+
+    def submit(self, execution_id, steps, done=None):
+        """
+        :param execution_id: str
+        :param steps: list of (str, function with no arguments) : step name and function, raising an exception if the step failed
+        :param done: function with no arguments : called after all the steps ran, whether they failed or not
+        :return: None
+        """
+        with self._lock:
+            self._pending += 1
+        self._logger.info('Execution %s: deferred %s' % (execution_id, ', '.join(name for name, _ in steps)))
+        self._queue.put((execution_id, steps, done))
+
+    def _worker_thread(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            execution_id, steps, done = job
+            t0 = time.time()
+            for name, f in steps:
+                try:
+                    with self._metrics.timer('ces_execution_phase_seconds', phase=name):
+                        f()
+                    self._metrics.inc('ces_deferred_steps_total', step=name, outcome='ok')
+                except Exception as e:
+                    self._metrics.inc('ces_deferred_steps_total', step=name, outcome='failed')
+                    self._logger.error('Execution %s: deferred %s failed: %s' % (execution_id, name, str(e)))
+            if done:
+                try:
+                    done()
+                except Exception as e:
+                    self._logger.error('Execution %s: finishing deferred steps failed: %s' % (execution_id, str(e)))
+            with self._lock:
+                self._pending -= 1
+            self._logger.info('Execution %s: deferred steps finished in %.2fs' % (execution_id, time.time() - t0))
+
+    def stop(self, timeout=60):
+        """
+        Lets the worker threads finish the queued jobs, waiting at most timeout seconds in total
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        deadline = time.time() + timeout
+        for th in self._threads:
+            th.join(max(0, deadline - time.time()))
+        self._threads = []
+        if self._pending:
+            self._logger.warning('Stopped with deferred steps of %d executions not finished' % self._pending)
+
+
+class ForwardingHandler(logging.Handler):
+    """
+    Passes records on to the handlers of another logger
+    """
+    def __init__(self, target, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self._target = target
+
+    def emit(self, record):
+        self._target.handle(record)
+
+
+# not part of another argument like --variable BuildPriority=3
+PRIORITY_RE = r'(?<![\w-])Priority=(-?[0-9]+)'
+SHARDS_RE = r'(?<![\w-])Shards=([0-9]+)'
 
 
 class MyCustomExecutionServerCommandHandler(CustomExecutionServerCommandHandler):
 
-    def __init__(self, logger):
+    def __init__(self, logger, metrics, live_hub=None, warm_worker=None, deferred_stage=None, output_janitor=None):
         CustomExecutionServerCommandHandler.__init__(self)
         self._logger = logger
-        self._process_runner = ProcessRunner(self._logger)
+        self._metrics = metrics
+        self._live_hub = live_hub
+        self._deferred_stage = deferred_stage
+        self._output_janitor = output_janitor
+        # runs robot and rebot in the warm worker instead of as new processes
+        self._launch = warm_worker.launch if warm_worker else None
+        self._progress_interval = progress_interval
+        if progress_interval and CloudShellAPISession is None:
+            self._logger.warning('progress_interval is set but the cloudshell-automation-api package is not installed - not writing progress to reservations')
+            self._progress_interval = 0
+        self._api_session = None
+        self._api_lock = threading.Lock()
+        if run_cores_per_run or run_max_memory_bytes or run_max_open_files or run_max_cpu_seconds or run_nice or run_ionice_class:
+            resources = RunResources(self._logger, cores_per_run=run_cores_per_run, core_pool=run_core_pool,
+                                     max_memory_bytes=run_max_memory_bytes, max_open_files=run_max_open_files,
+                                     max_cpu_seconds=run_max_cpu_seconds, nice=run_nice,
+                                     ionice_class=run_ionice_class, ionice_level=run_ionice_level)
+        else:
+            resources = None
+        self._process_runner = ProcessRunner(self._logger, head_bytes=output_capture_head_bytes, tail_bytes=output_capture_tail_bytes,
+                                             resources=resources)
+        self._metrics.define_histogram('ces_run_cpu_seconds', 'CPU time of robot runs, including the processes they waited for')
+        self._metrics.define_histogram('ces_run_max_rss_bytes', 'Peak resident memory of the largest process of robot runs',
+                                       buckets=[2 ** n * 1048576 for n in range(4, 15)])
+        if git_cache_directory:
+            self._git_cache = GitMirrorCache(git_cache_directory, git_repo_url, self._process_runner, self._logger,
+                                             min_fetch_interval=git_cache_min_fetch_interval)
+        else:
+            self._git_cache = None
+        if self._git_cache and git_shared_trees:
+            self._source_trees = SharedSourceTrees(self._git_cache, os.path.join(git_cache_directory, 'trees'), self._logger,
+                                                   max_trees=git_shared_trees_max, max_bytes=git_shared_trees_max_bytes)
+        else:
+            self._source_trees = None
+        if venv_cache_directory:
+            self._venv_cache = VirtualenvCache(venv_cache_directory, self._process_runner, self._logger,
+                                               extra_packages=venv_extra_packages, max_bytes=venv_cache_max_bytes)
+        else:
+            self._venv_cache = None
+        self._archiver = ResultArchiver(self._logger,
+                                        compression_level=archive_compression_level,
+                                        store_min_bytes=archive_store_min_bytes,
+                                        artifact_patterns=archive_artifact_patterns)
+
+    def get_priority(self, test_path, test_arguments, username, reservation_id, get_reservation_json):
+        if test_arguments:
+            m = re.search(PRIORITY_RE, test_arguments)
+            if m:
+                return int(m.groups()[0])
+        reservation_json = get_reservation_json()
+        if reservation_json and reservation_json != 'None':
+            for v in json.loads(reservation_json)['TopologyInputs']:
+                if v['Name'] == 'Priority' and v['Value'] not in ('', 'None'):
+                    return int(v['Value'])
+        return 0
 
     def execute_command(self, test_path, test_arguments, execution_id, username, reservation_id, reservation_json, logger):
         logger.info('execute %s %s %s %s %s %s\n' % (test_path, test_arguments, execution_id, username, reservation_id, reservation_json))
+        log = self._open_execution_log(execution_id)
+        if self._live_hub:
+            self._live_hub.open(execution_id)
+        worktree = None
+        shared_tree = None
+        venv = None
+        # directory with the robot and rebot of the virtualenv of the execution -- None to run them from PATH
+        venv_bin = None
+        outdir = None
+        # (step name, function) to run after the result was returned
+        deferred = []
+        # directory robot runs in and test_path is relative to -- None for the current directory
+        srcdir = None
         try:
             now = time.strftime("%Y-%m-%d_%H.%M.%S")
             resinfo = json.loads(reservation_json) if reservation_json and reservation_json != 'None' else None
@@ -245,6 +1840,15 @@ class MyCustomExecutionServerCommandHandler(CustomExecutionServerCommandHandler)
             if not git_branch_or_tag_spec:
                 git_branch_or_tag_spec = default_checkout_version
 
+            shards = parallel_shards
+            if test_arguments:
+                m = re.search(SHARDS_RE, test_arguments)
+                if m:
+                    shards = int(m.groups()[0])
+                    test_arguments = re.sub(SHARDS_RE, '', test_arguments).strip()
+                # already used to order the queue, see get_priority()
+                test_arguments = re.sub(PRIORITY_RE, '', test_arguments).strip()
+
             def cdrip(fn):
                 fn = fn.replace('%R', reservation_id)
                 fn = fn.replace('%N', test_path.replace(' ', '_'))
@@ -252,7 +1856,9 @@ class MyCustomExecutionServerCommandHandler(CustomExecutionServerCommandHandler)
                 fn = fn.replace('%V', git_branch_or_tag_spec)
                 return fn
 
-            outdir = cdrip(unique_output_directory)
+            outdir = os.path.abspath(cdrip(unique_output_directory))
+            if self._output_janitor:
+                self._output_janitor.begin(outdir)
             os.makedirs(outdir, exist_ok=True)
 
             # MYBRANCHNAME or tags/MYTAGNAME
@@ -264,20 +1870,39 @@ class MyCustomExecutionServerCommandHandler(CustomExecutionServerCommandHandler)
             #     self._logger.info('TestVersion not specified - taking latest from default branch')
             #
             # self._process_runner.execute_throwing('git clone %s %s %s' % (minusb, git_repo_url, outdir), execution_id+'_git1')
-            self._process_runner.execute_throwing('git clone %s %s' % (git_repo_url, outdir), execution_id+'_git1')
-
-            if git_branch_or_tag_spec:
-                # self._process_runner.execute_throwing('git reset --hard', execution_id+'_git2', env={
-                #     'GIT_DIR': '%s/.git' % outdir
-                # })
-                self._process_runner.execute_throwing('git checkout %s' % git_branch_or_tag_spec, execution_id+'_git3', directory=outdir)
-                # env={
-                #     'GIT_DIR': '%s/.git' % outdir
-                # })
-            else:
-                self._logger.info('TestVersion not specified - taking latest from default branch')
-
-            t = 'robot'
+            with self._metrics.phase(execution_id, 'checkout'):
+                if self._source_trees:
+                    shared_tree, srcdir = self._source_trees.acquire(git_branch_or_tag_spec, execution_id)
+                    log.info('Execution %s: %s is commit %s' % (execution_id, git_branch_or_tag_spec or 'HEAD', shared_tree))
+                elif self._git_cache:
+                    if not git_branch_or_tag_spec:
+                        log.info('TestVersion not specified - taking latest from default branch')
+                    self._git_cache.checkout(git_branch_or_tag_spec, outdir, execution_id)
+                    worktree = outdir
+                else:
+                    self._process_runner.execute_throwing('git clone %s %s' % (git_repo_url, outdir), execution_id+'_git1', logger=log)
+
+                    if git_branch_or_tag_spec:
+                        # self._process_runner.execute_throwing('git reset --hard', execution_id+'_git2', env={
+                        #     'GIT_DIR': '%s/.git' % outdir
+                        # })
+                        self._process_runner.execute_throwing('git checkout %s' % git_branch_or_tag_spec, execution_id+'_git3', directory=outdir, logger=log)
+                        # env={
+                        #     'GIT_DIR': '%s/.git' % outdir
+                        # })
+                    else:
+                        log.info('TestVersion not specified - taking latest from default branch')
+
+            if self._venv_cache:
+                requirements = [p for p in (os.path.join(srcdir or outdir, fn) for fn in venv_requirements_files) if os.path.isfile(p)]
+                if requirements:
+                    with self._metrics.phase(execution_id, 'venv'):
+                        venv, venv_bin = self._venv_cache.acquire(requirements[0], execution_id)
+                    log.info('Execution %s: running robot from virtualenv %s' % (execution_id, venv))
+                else:
+                    log.info('Execution %s: no %s in the test repo - running robot from PATH' % (execution_id, ' or '.join(venv_requirements_files)))
+
+            t = os.path.join(venv_bin, 'robot') if venv_bin else 'robot'
             # t += ' --variable CLOUDSHELL_RESERVATION_ID:%s' % reservation_id
             # t += ' --variable CLOUDSHELL_SERVER_ADDRESS:%s' % cloudshell_server_address
             # t += ' --variable CLOUDSHELL_PORT:%d' % cloudshell_port
@@ -286,61 +1911,293 @@ class MyCustomExecutionServerCommandHandler(CustomExecutionServerCommandHandler)
             # t += ' --variable CLOUDSHELL_DOMAIN:%s' % cloudshell_domain
             if test_arguments and test_arguments != 'None':
                 t += ' ' + test_arguments
-            t += ' -d %s %s' % (outdir, test_path)
 
+            robot_env = {
+                'CLOUDSHELL_RESERVATION_ID': reservation_id or 'None',
+                'CLOUDSHELL_SERVER_ADDRESS': cloudshell_server_address or 'None',
+                'CLOUDSHELL_SERVER_PORT': str(cloudshell_port) or 'None',
+                'CLOUDSHELL_USERNAME': cloudshell_username or 'None',
+                'CLOUDSHELL_PASSWORD': cloudshell_password or 'None',
+                'CLOUDSHELL_DOMAIN': cloudshell_domain or 'None',
+                'CLOUDSHELL_RESERVATION_INFO': reservation_json or 'None',
+            }
+            if venv_bin:
+                # for libraries starting tools installed in the virtualenv
+                robot_env['PATH'] = venv_bin + os.pathsep + os.environ.get('PATH', os.defpath)
+                robot_env['VIRTUAL_ENV'] = os.path.dirname(venv_bin)
+
+            shard_groups = []
+            if shards > 1:
+                if re.search(r'(^| )(--suite|-s) ', test_arguments or ''):
+                    log.info('Not splitting %s into shards: test arguments already select suites' % test_path)
+                elif os.path.isdir(os.path.join(srcdir or '', test_path)):
+                    shard_groups = split_robot_suites(os.path.join(srcdir or '', test_path), shards)
+
+            progress = None
+            on_output = None
+            if self._live_hub:
+                on_output = lambda chunk: self._live_hub.publish(execution_id, 'output', string23(chunk))
+            if self._live_hub or self._progress_interval:
+                if shard_groups:
+                    event_paths = ['%s/shard%d/%s' % (outdir, i + 1, ROBOT_EVENTS_FILENAME) for i in range(len(shard_groups))]
+                else:
+                    event_paths = ['%s/%s' % (outdir, ROBOT_EVENTS_FILENAME)]
+                progress = RobotProgress(event_paths, log,
+                                         on_event=(lambda line: self._live_hub.publish(execution_id, 'robot', line)) if self._live_hub else None,
+                                         on_progress=(lambda s: self._write_reservation_output(reservation_id, 'Execution %s: %s' % (execution_id, s)))
+                                         if self._progress_interval and reservation_id else None,
+                                         progress_interval=self._progress_interval)
+                progress.start()
+
+            usage = ResourceUsage()
             try:
-                output, robotretcode = self._process_runner.execute(t, execution_id, env={
-                    'CLOUDSHELL_RESERVATION_ID': reservation_id or 'None',
-                    'CLOUDSHELL_SERVER_ADDRESS': cloudshell_server_address or 'None',
-                    'CLOUDSHELL_SERVER_PORT': str(cloudshell_port) or 'None',
-                    'CLOUDSHELL_USERNAME': cloudshell_username or 'None',
-                    'CLOUDSHELL_PASSWORD': cloudshell_password or 'None',
-                    'CLOUDSHELL_DOMAIN': cloudshell_domain or 'None',
-                    'CLOUDSHELL_RESERVATION_INFO': reservation_json or 'None',
-                })
+                with self._metrics.phase(execution_id, 'robot'):
+                    if shard_groups:
+                        output, robotretcode = self._run_shards(t, shard_groups, test_path, outdir, execution_id, robot_env, srcdir, log,
+                                                                listen=progress is not None, on_output=on_output, venv_bin=venv_bin, usage=usage)
+                    else:
+                        if progress:
+                            t += ' --listener %s:%s' % (LIVE_LISTENER_PATH, event_paths[0])
+                        t += ' -d %s %s' % (outdir, test_path)
+                        output, robotretcode = self._process_runner.execute(t, execution_id, env=robot_env, directory=srcdir,
+                                                                            spool_path=os.path.join(outdir, output_spool_filename) if output_spool_filename else None, logger=log,
+                                                                            on_output=on_output, launch=None if venv_bin else self._launch,
+                                                                            limit=True, usage=usage)
             except Exception as uue:
                 robotretcode = -5000
                 output = 'Robot crashed: %s: %s' % (str(uue), traceback.format_exc())
+            finally:
+                if progress:
+                    progress.stop()
+
+            resource_usage = usage.to_dict()
+            if resource_usage:
+                log.info('Execution %s: resource usage: %s' % (execution_id, ', '.join('%s %s' % kv for kv in sorted(resource_usage.items()))))
+                self._metrics.observe('ces_run_cpu_seconds', resource_usage['user_cpu_seconds'] + resource_usage['system_cpu_seconds'])
+                self._metrics.observe('ces_run_max_rss_bytes', resource_usage['max_rss_bytes'])
 
             if robotretcode == -6000:
                 return StoppedCommandResult()
 
-            self._logger.debug('Result of %s: %d: %s' % (t, robotretcode, string23(output)))
+            log.debug('Result of %s: %d: %s' % (t, robotretcode, string23(output)))
 
             if 'Data source does not exist' in output:
-                return ErrorCommandResult('Robot failure', 'Test file %s/%s missing (at version %s). Original error: %s' % (outdir, test_path, git_branch_or_tag_spec or '[repo default branch]', output))
-
-            if archive_output_xml_to:
-                s = cdrip(archive_output_xml_to)
-                os.makedirs(os.path.dirname(s), exist_ok=True)
-                self._logger.info('Copying %s/output.xml to %s' % (outdir, s))
-                shutil.copyfile('%s/output.xml' % outdir, s)
+                return ErrorCommandResult('Robot failure', 'Test file %s/%s missing (at version %s). Original error: %s' % (srcdir or outdir, test_path, git_branch_or_tag_spec or '[repo default branch]', output))
 
-            zipname = '%s_%s.zip' % (test_path.replace(' ', '_'), now)
-            try:
-                zipoutput, _ = self._process_runner.execute_throwing('zip -j %s/%s %s/output.xml %s/log.html %s/report.html' % (outdir, zipname, outdir, outdir, outdir), execution_id+'_zip')
-            except:
+            if not os.path.isfile('%s/output.xml' % outdir):
                 return ErrorCommandResult('Robot failure', 'Robot did not complete: %s' % string23(output))
 
-            with open('%s/%s' % (outdir, zipname), 'rb') as f:
-                zipdata = f.read()
+            if resource_usage:
+                # goes into the report zip
+                with open('%s/%s' % (outdir, RESOURCE_USAGE_FILENAME), 'w') as f:
+                    json.dump(resource_usage, f)
+
+            summary = None
+            if output_summary:
+                try:
+                    with self._metrics.phase(execution_id, 'summary'):
+                        summary = summarize_robot_output('%s/output.xml' % outdir)
+                        with open('%s/%s' % (outdir, OUTPUT_SUMMARY_FILENAME), 'w') as f:
+                            json.dump(summary, f)
+                    log.info('Execution %s: %s: %s' % (execution_id, summary['status'], ', '.join('%s %d' % kv for kv in sorted(summary['statistics'].items()))))
+                except Exception as se:
+                    log.warning('Execution %s: Failed to summarize %s/output.xml: %s' % (execution_id, outdir, str(se)))
+
+            if archive_output_xml_to:
+                archive_xml = lambda logger: self._archive_output_xml(outdir, cdrip(archive_output_xml_to), summary is not None, logger)
+                if 'archive_output_xml' in deferred_steps:
+                    deferred.append(('archive_output_xml', archive_xml))
+                else:
+                    with self._metrics.phase(execution_id, 'archive_output_xml'):
+                        archive_xml(log)
 
+            zipname = '%s_%s.zip' % (test_path.replace(' ', '_'), now)
+            zipmembers = self._archiver.members(outdir)
+            # streaming reads outdir during the upload, so it can't be combined with deleting outdir
+            stream_zip = archive_stream_upload and not delete_output
             if delete_output:
-                self._logger.info('Deleting %s' % outdir)
-                shutil.rmtree(outdir)
+                # keep the zip outside outdir so it survives until it has been uploaded
+                zippath = os.path.join(tempfile.gettempdir(), '%s_%s' % (execution_id, zipname))
+            else:
+                zippath = '%s/%s' % (outdir, zipname)
+            if not stream_zip:
+                try:
+                    with self._metrics.phase(execution_id, 'archive'):
+                        self._archiver.write_file(zippath, zipmembers)
+                except Exception as ze:
+                    return ErrorCommandResult('Robot failure', 'Failed to archive Robot output: %s' % str(ze))
 
-            if postprocessing_command:
-                ppout, ppret = self._process_runner.execute(cdrip(postprocessing_command), execution_id + '_postprocess')
+            if delete_output:
+                delete = lambda logger: self._delete_output(outdir, logger)
+                if 'delete_output' in deferred_steps:
+                    deferred.append(('delete_output', delete))
+                else:
+                    with self._metrics.phase(execution_id, 'delete_output'):
+                        delete(log)
+
+            if postprocessing_command and 'postprocessing' in deferred_steps:
+                deferred.append(('postprocessing', lambda logger: self._postprocess(cdrip(postprocessing_command), execution_id, logger)))
+            elif postprocessing_command:
+                with self._metrics.phase(execution_id, 'postprocessing'):
+                    ppout, ppret = self._process_runner.execute(cdrip(postprocessing_command), execution_id + '_postprocess', logger=log)
                 if ppret:
+                    if delete_output:
+                        os.remove(zippath)
                     return ErrorCommandResult('Postprocessing failure', string23(ppout))
 
+            if stream_zip:
+                report = dict(report_data=self._archiver.open_stream(zipmembers, execution_id))
+            else:
+                report = dict(report_data=None, report_path=zippath, delete_report_after_upload=delete_output)
             if robotretcode == 0:
-                return PassedCommandResult(zipname, zipdata, 'application/zip')
+                result = PassedCommandResult(zipname, report_mime_type='application/zip', **report)
             else:
-                return FailedCommandResult(zipname, zipdata, 'application/zip')
+                result = FailedCommandResult(zipname, report_mime_type='application/zip', **report)
+            result.summary = summary
+            result.resource_usage = resource_usage
+            if self._output_janitor and (stream_zip or not delete_output):
+                # the report is read from outdir after this returns, keep outdir until it was uploaded or stored
+                self._output_janitor.begin(outdir)
+                result.on_report_discarded = lambda: self._output_janitor.end(outdir)
+            return result
         except Exception as ue:
-            self._logger.error(str(ue) + ': ' + traceback.format_exc())
+            log.error(str(ue) + ': ' + traceback.format_exc())
             raise ue
+        finally:
+            if worktree:
+                self._git_cache.release(worktree, execution_id)
+            if shared_tree:
+                self._source_trees.release(shared_tree)
+            if venv:
+                self._venv_cache.release(venv)
+            if outdir and self._output_janitor and not deferred:
+                self._output_janitor.end(outdir)
+            self._process_runner.forget(execution_id)
+            if self._live_hub:
+                self._live_hub.close(execution_id)
+            self._close_execution_log(log)
+            if deferred:
+                # last, so a deferred delete_output can't remove outdir while the releases above still use it;
+                # the execution log is closed, deferred steps log to the main log
+                done = None
+                if outdir and self._output_janitor:
+                    # outdir stays protected from the janitor until the deferred steps are done with it
+                    done = lambda: self._output_janitor.end(outdir)
+                self._deferred_stage.submit(execution_id, [(name, lambda f=f: f(self._logger)) for name, f in deferred], done)
+
+    def _archive_output_xml(self, outdir, path, with_summary, log):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        log.info('Copying %s/output.xml to %s' % (outdir, path))
+        shutil.copyfile('%s/output.xml' % outdir, path)
+        if with_summary:
+            shutil.copyfile('%s/%s' % (outdir, OUTPUT_SUMMARY_FILENAME), os.path.splitext(path)[0] + '.summary.json')
+
+    def _delete_output(self, outdir, log):
+        log.info('Deleting %s' % outdir)
+        shutil.rmtree(outdir)
+
+    def _postprocess(self, command, execution_id, log):
+        ppout, ppret = self._process_runner.execute(command, execution_id + '_postprocess', logger=log)
+        if ppret:
+            raise Exception('%s returned %d: %s' % (hide_passwords(command), ppret, string23(ppout)))
+
+    def _write_reservation_output(self, reservation_id, message):
+        try:
+            with self._api_lock:
+                if self._api_session is None:
+                    self._api_session = CloudShellAPISession(host=cloudshell_server_address, username=cloudshell_username, password=cloudshell_password,
+                                                             domain=cloudshell_domain, port=cloudshell_port)
+                session = self._api_session
+            session.WriteMessageToReservationOutput(reservation_id, message)
+        except Exception as e:
+            self._logger.warning('Writing progress to reservation %s failed: %s' % (reservation_id, str(e)))
+            with self._api_lock:
+                # log in again next time
+                self._api_session = None
+
+    def _open_execution_log(self, execution_id):
+        """
+        :param execution_id: str
+        :return: logging.Logger : logger writing to a file of its own in execution_log_directory that also passes
+        warnings and errors on to the main log -- the main logger if execution_log_directory is not set
+        """
+        if not execution_log_directory:
+            return self._logger
+        os.makedirs(execution_log_directory, exist_ok=True)
+        # not registered with logging.getLogger(), so it is garbage collected after the execution
+        log = logging.Logger('%s.%s' % (self._logger.name, execution_id), logging.getLevelName(execution_log_level.upper()))
+        handler = logging.FileHandler(os.path.join(execution_log_directory, '%s.log' % execution_id))
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        log.addHandler(handler)
+        log.addHandler(ForwardingHandler(self._logger, logging.WARNING))
+        self._logger.info('Execution %s: logging to %s' % (execution_id, handler.baseFilename))
+        return log
+
+    def _close_execution_log(self, log):
+        if log is not self._logger:
+            for handler in list(log.handlers):
+                log.removeHandler(handler)
+                handler.close()
+
+    def _run_shards(self, robot_command, shard_groups, test_path, outdir, execution_id, env, directory=None, log=None, listen=False, on_output=None, venv_bin=None,
+                    usage=None):
+        """
+        Runs each group of child suites of test_path in its own robot process in parallel, then merges the results with rebot
+
+        :param robot_command: str : robot command line without output directory and data source
+        :param shard_groups: list of list of str : child suite names per shard, see split_robot_suites()
+        :param directory: str : directory to run robot in
+        :param log: logging.Logger : logger of the execution
+        :param listen: bool : have each shard write its progress to ROBOT_EVENTS_FILENAME in its directory
+        :param on_output: function taking bytes : called with the console output of all shards as it is read
+        :param venv_bin: str : directory of the rebot to merge with, None for rebot from PATH; robot_command already runs the robot in it
+        :param usage: ResourceUsage : to add the resource usage of the shards and the merge to
+        :return: (str, int) : combined console output and return code -- (None, -6000) if stopped
+        """
+        log = log or self._logger
+        top = robot_suite_name(os.path.basename(os.path.normpath(test_path))).replace(' ', '_')
+        results = [None] * len(shard_groups)
+        # the warm worker runs the robot of this server, not the one of a virtualenv
+        launch = None if venv_bin else self._launch
+
+        def shard_thread(i):
+            sharddir = '%s/shard%d' % (outdir, i + 1)
+            c = robot_command + ' --name %s' % top
+            for name in shard_groups[i]:
+                c += ' --suite %s.%s' % (top, name.replace(' ', '_'))
+            if listen:
+                c += ' --listener %s:%s/%s' % (LIVE_LISTENER_PATH, sharddir, ROBOT_EVENTS_FILENAME)
+            c += ' --log NONE --report NONE -d %s %s' % (sharddir, test_path)
+            try:
+                results[i] = self._process_runner.execute(c, '%s_shard%d' % (execution_id, i + 1), env=env, directory=directory,
+                                                          spool_path=os.path.join(sharddir, output_spool_filename) if output_spool_filename else None, logger=log,
+                                                          on_output=on_output, launch=launch, limit=True, usage=usage)
+            except Exception as e:
+                results[i] = ('Shard %d crashed: %s: %s' % (i + 1, str(e), traceback.format_exc()), -5000)
+
+        log.info('Execution %s: running %s in %d shards: %s' % (execution_id, test_path, len(shard_groups), shard_groups))
+        for i in range(len(shard_groups)):
+            os.makedirs('%s/shard%d' % (outdir, i + 1), exist_ok=True)
+        threads = [threading.Thread(target=shard_thread, args=(i,)) for i in range(len(shard_groups))]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+
+        if any(rc == -6000 for _, rc in results):
+            return None, -6000
+        output = '\n'.join('Shard %d: %s' % (i + 1, o) for i, (o, _) in enumerate(results))
+        outputs = ['%s/shard%d/output.xml' % (outdir, i + 1) for i in range(len(shard_groups)) if os.path.isfile('%s/shard%d/output.xml' % (outdir, i + 1))]
+        # 252 is what robot returns for a shard in which the test arguments selected no tests
+        retcodes = [rc for _, rc in results if rc != 252]
+        if not outputs:
+            return output, max(retcodes or [252])
+        rebot = os.path.join(venv_bin, 'rebot') if venv_bin else 'rebot'
+        mergeoutput, mergeretcode = self._process_runner.execute('%s --merge -d %s --output output.xml --log log.html --report report.html %s' % (rebot, outdir, ' '.join(outputs)),
+                                                                 execution_id + '_rebot', logger=log, launch=launch, usage=usage)
+        if mergeretcode == -6000:
+            return None, -6000
+        return output + '\nMerge: ' + mergeoutput, max([mergeretcode] + retcodes)
 
     def stop_command(self, execution_id, logger):
         logger.info('stop %s\n' % execution_id)
@@ -348,42 +2205,110 @@ class MyCustomExecutionServerCommandHandler(CustomExecutionServerCommandHandler)
 
 log_pathname = '%s/%s' % (log_directory, log_filename)
 logger = logging.getLogger(server_name)
-handler = RotatingFileHandler(log_pathname, maxBytes=100000, backupCount=100)
+handler = RotatingFileHandler(log_pathname, maxBytes=log_max_bytes, backupCount=log_backup_count)
 handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
-logger.addHandler(handler)
+# threads only put records on the queue; a single listener thread formats and writes them,
+# so a slow disk or a rollover does not hold up executions
+log_queue = queue.Queue()
+logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, handler, respect_handler_level=True)
+log_listener.start()
 if log_level:
     logger.setLevel(logging.getLevelName(log_level.upper()))
 
 print('\nLogging to %s\n' % log_pathname)
 
-server = CustomExecutionServer(server_name=server_name,
-                               server_description=server_description,
-                               server_type=server_type,
-                               server_capacity=server_capacity,
-
-                               command_handler=MyCustomExecutionServerCommandHandler(logger),
-
-                               logger=logger,
-
-                               cloudshell_host=cloudshell_server_address,
-                               cloudshell_port=cloudshell_snq_port,
-                               cloudshell_username=cloudshell_username,
-                               cloudshell_password=cloudshell_password,
-                               cloudshell_domain=cloudshell_domain,
-
-                               auto_register=True,
-                               auto_start=False)
+metrics = Metrics()
+live_hub = LiveOutputHub(max_bytes=live_output_buffer_bytes) if live_output else None
+output_janitor = None
+if output_retention_days or output_retention_keep_last or output_retention_max_bytes:
+    if '%T' in unique_output_directory:
+        output_janitor = OutputJanitor(unique_output_directory, logger, metrics,
+                                       max_age=output_retention_days * 86400,
+                                       max_bytes=output_retention_max_bytes,
+                                       keep_last=output_retention_keep_last,
+                                       interval=output_janitor_interval,
+                                       files_per_second=output_janitor_files_per_second)
+    else:
+        logger.warning('unique_output_directory does not contain %T - output retention disabled')
+deferred_stage = DeferredStage(logger, metrics, workers=deferred_workers) if deferred_steps else None
+warm_worker = None
+if warm_robot_worker:
+    if hasattr(os, 'fork'):
+        warm_worker = WarmRobotWorker(logger, warm_robot_preload)
+    else:
+        logger.warning('warm_robot_worker is not supported on this platform - starting robot for each execution')
+
+server_host = CustomExecutionServerHost(logger,
+                                        cloudshell_host=cloudshell_server_address,
+                                        cloudshell_port=cloudshell_snq_port,
+                                        cloudshell_username=cloudshell_username,
+                                        cloudshell_password=cloudshell_password,
+                                        cloudshell_domain=cloudshell_domain,
+                                        max_workers=max_workers,
+                                        request_timeout=request_timeout or None,
+                                        metrics=metrics)
+
+# one handler for all servers, so they share the git cache, virtualenvs and the other resources of the host
+command_handler = MyCustomExecutionServerCommandHandler(logger, metrics, live_hub, warm_worker, deferred_stage, output_janitor)
+
+
+def make_capacity_controller(so):
+    capacity_max = int(so.get('cloudshell_execution_server_capacity_max', 0))
+    if not capacity_max:
+        return None
+    return CapacityController(int(so.get('cloudshell_execution_server_capacity_min', 1)) or 1, capacity_max, logger,
+                              interval=capacity_check_interval,
+                              cooldown=10 * capacity_check_interval)
+
+
+server_host.add_server(server_name, server_description, server_type, server_capacity, command_handler,
+                       outbox_directory=outbox_directory or None,
+                       outbox_uploaders=outbox_uploaders,
+                       capacity_controller=make_capacity_controller(o),
+                       fair_share_weights=fair_share_weights)
+for s in additional_servers:
+    server_host.add_server(s['cloudshell_execution_server_name'],
+                           s.get('cloudshell_execution_server_description', ''),
+                           s['cloudshell_execution_server_type'],
+                           int(s.get('cloudshell_execution_server_capacity', 5)),
+                           command_handler,
+                           # each server needs an outbox of its own
+                           outbox_directory=os.path.join(outbox_directory, s['cloudshell_execution_server_name']) if outbox_directory else None,
+                           outbox_uploaders=outbox_uploaders,
+                           capacity_controller=make_capacity_controller(s),
+                           fair_share_weights=fair_share_weights)
+
+local_http_server = None
 
 
 def daemon_start():
-    server.start()
+    global local_http_server
+    # threads don't survive the fork into the daemon
+    log_listener.start()
+    if warm_worker:
+        try:
+            warm_worker.start()
+        except Exception as e:
+            logger.error('Failed to start the warm robot worker, retrying on the first execution: %s' % str(e))
+    if deferred_stage:
+        deferred_stage.start()
+    if output_janitor:
+        output_janitor.start()
+    server_host.start()
+    if metrics_port:
+        local_http_server = LocalHTTPServer(metrics_port, logger, bind_address=metrics_bind_address)
+        local_http_server.add_text_route('/metrics', metrics.render)
+        if live_hub:
+            live_hub.add_routes(local_http_server)
+        local_http_server.start()
     s = '\n\n%s execution server %s started\nTo stop %s:\nkill %d\n\nIt is safe to close this terminal.\n' % (server_type, server_name, server_name, os.getpid())
     logger.info(s)
     print (s)
 
 
 def daemon_stop():
-    msgstopping = "Stopping execution server %s, please wait up to 2 minutes..." % server_name
+    msgstopping = "Stopping execution server %s, please wait up to %d seconds..." % (server_name, drain_timeout + 30)
     msgstopped = "Execution server %s finished shutting down" % server_name
     logger.info(msgstopping)
     print (msgstopping)
@@ -391,12 +2316,24 @@ def daemon_stop():
         subprocess.call(['wall', msgstopping])
     except:
         pass
-    server.stop()
+    server_host.drain(drain_timeout)
+    if local_http_server:
+        local_http_server.stop()
+    server_host.stop()
+    if deferred_stage:
+        deferred_stage.stop()
+    if output_janitor:
+        output_janitor.stop()
+    if warm_worker:
+        warm_worker.stop()
     logger.info(msgstopped)
+    log_listener.stop()
     print (msgstopped)
     try:
         subprocess.call(['wall', msgstopped])
     except:
         pass
 
+# write out what was logged so far before forking, the listener is restarted in the daemon
+log_listener.stop()
 become_daemon_and_wait(daemon_start, daemon_stop)
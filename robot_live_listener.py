@@ -0,0 +1,36 @@
+import json
+import time
+
+
+class robot_live_listener:
+    """
+    Robot Framework listener that writes test progress as JSON lines to a file while robot runs
+
+    The execution server tails the file to publish live progress. Usage:
+        robot --listener /path/to/robot_live_listener.py:/path/to/robot_events.jsonl ...
+    """
+    ROBOT_LISTENER_API_VERSION = 2
+
+    def __init__(self, filename):
+        self._file = open(filename, 'a')
+
+    def _write(self, o):
+        o['time'] = time.time()
+        self._file.write(json.dumps(o) + '\n')
+        self._file.flush()
+
+    def start_suite(self, name, attrs):
+        self._write({'event': 'start_suite', 'name': attrs['longname'], 'tests': attrs['totaltests']})
+
+    def end_suite(self, name, attrs):
+        self._write({'event': 'end_suite', 'name': attrs['longname'], 'status': attrs['status'], 'statistics': attrs['statistics']})
+
+    def start_test(self, name, attrs):
+        self._write({'event': 'start_test', 'name': attrs['longname']})
+
+    def end_test(self, name, attrs):
+        self._write({'event': 'end_test', 'name': attrs['longname'], 'status': attrs['status'], 'message': attrs['message'],
+                     'elapsed': attrs['elapsedtime']})
+
+    def close(self):
+        self._file.close()
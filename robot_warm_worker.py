@@ -0,0 +1,146 @@
+import importlib
+import json
+import os
+import signal
+import sys
+import threading
+import traceback
+
+from cloudshell.custom_execution_server.resources import apply_limits, rusage_to_dict
+
+usage = '''Keeps Robot Framework and test libraries imported and runs robot or rebot in a forked child per request
+
+Started and driven by robot_custom_execution_server.py when warm_robot_worker is enabled:
+    python robot_warm_worker.py [module to preload]...
+
+Requests are read from stdin, one JSON object per line:
+    {"id": 1, "args": ["robot", "-d", "/out", "suite.robot"], "env": {...}, "cwd": "/src", "output": "/tmp/x.fifo", "limits": {...}}
+The child runs with the console output going to the named pipe "output", in its own session so the
+whole run can be killed with killpg(pid), and with the optional resource limits of RunResources.allocate().
+Replies are written to stdout, one JSON object per line:
+    {"ready": true, "preload_errors": {...}}           once after startup
+    {"id": 1, "pid": 1234}                              after forking, or {"id": 1, "error": "..."}
+    {"id": 1, "returncode": 0, "rusage": {...}}         when the child exited, negative signal number if killed
+'''
+
+
+class WarmWorker:
+    def __init__(self):
+        self._reply_lock = threading.Lock()
+        self._cond = threading.Condition()
+        # pid -> request id
+        self._children = {}
+
+    def reply(self, o):
+        with self._reply_lock:
+            sys.stdout.write(json.dumps(o) + '\n')
+            sys.stdout.flush()
+
+    def preload(self, modules):
+        errors = {}
+        for m in ['robot', 'robot.running', 'robot.libraries.BuiltIn'] + modules:
+            try:
+                importlib.import_module(m)
+            except Exception as e:
+                errors[m] = '%s: %s' % (e.__class__.__name__, str(e))
+        return errors
+
+    def _reap_thread(self):
+        while True:
+            with self._cond:
+                while not self._children:
+                    self._cond.wait()
+            try:
+                pid, status, ru = os.wait4(-1, 0)
+            except ChildProcessError:
+                continue
+            with self._cond:
+                request_id = self._children.pop(pid, None)
+            if request_id is None:
+                continue
+            if os.WIFSIGNALED(status):
+                returncode = -os.WTERMSIG(status)
+            else:
+                returncode = os.WEXITSTATUS(status)
+            self.reply({'id': request_id, 'returncode': returncode, 'rusage': rusage_to_dict(ru)})
+
+    def _run_child(self, request, fd):
+        try:
+            os.setsid()
+            os.dup2(fd, 1)
+            os.dup2(fd, 2)
+            os.close(fd)
+            devnull = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(devnull, 0)
+            os.close(devnull)
+            # robot writes its console output to sys.__stdout__
+            sys.stdout = sys.__stdout__ = os.fdopen(1, 'w', 1)
+            sys.stderr = sys.__stderr__ = os.fdopen(2, 'w', 1)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if request.get('limits'):
+                apply_limits(request['limits'])
+            os.environ.clear()
+            os.environ.update(request.get('env') or {})
+            if request.get('cwd'):
+                os.chdir(request['cwd'])
+            from robot import run_cli, rebot_cli
+            args = request['args']
+            if os.path.basename(args[0]) == 'rebot':
+                rc = rebot_cli(args[1:], exit=False)
+            else:
+                rc = run_cli(args[1:], exit=False)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(rc)
+        except BaseException:
+            try:
+                traceback.print_exc()
+                sys.stderr.flush()
+            finally:
+                os._exit(255)
+
+    def handle(self, request):
+        try:
+            # the execution server opened the reading end before sending the request, so this doesn't block
+            fd = os.open(request['output'], os.O_WRONLY)
+        except OSError as e:
+            self.reply({'id': request['id'], 'error': str(e)})
+            return
+        try:
+            with self._cond:
+                pid = os.fork()
+                if pid == 0:
+                    self._run_child(request, fd)
+                self._children[pid] = request['id']
+                # replied before releasing the lock, so the reaper can't report the exit of a quick child first
+                self.reply({'id': request['id'], 'pid': pid})
+                self._cond.notify()
+        except OSError as e:
+            self.reply({'id': request['id'], 'error': str(e)})
+        finally:
+            os.close(fd)
+
+    def run(self, modules):
+        errors = self.preload(modules)
+        th = threading.Thread(target=self._reap_thread)
+        th.daemon = True
+        th.start()
+        self.reply({'ready': True, 'preload_errors': errors})
+        for line in sys.stdin:
+            if line.strip():
+                self.handle(json.loads(line))
+        # the execution server went away: don't leave runs behind
+        with self._cond:
+            pids = list(self._children.keys())
+        for pid in pids:
+            try:
+                os.killpg(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ('-h', '--help'):
+        print(usage)
+        sys.exit(0)
+    WarmWorker().run(sys.argv[1:])
@@ -0,0 +1,97 @@
+import unittest
+
+from cloudshell.custom_execution_server.custom_execution_server import FairShareQueue
+
+
+def drain(q):
+    items = []
+    while len(q):
+        items.append(q.pop())
+    return items
+
+
+class FairShareQueueTest(unittest.TestCase):
+    def test_fifo_without_priorities_or_users(self):
+        q = FairShareQueue()
+        for i in range(10):
+            q.push(i)
+        self.assertEqual(drain(q), list(range(10)))
+
+    def test_empty(self):
+        q = FairShareQueue()
+        self.assertEqual(len(q), 0)
+        with self.assertRaises(IndexError):
+            q.pop()
+
+    def test_higher_priority_first(self):
+        q = FairShareQueue()
+        q.push('low', priority=-1)
+        q.push('normal')
+        q.push('high', priority=5)
+        q.push('normal2')
+        q.push('high2', priority=5)
+        self.assertEqual(drain(q), ['high', 'high2', 'normal', 'normal2', 'low'])
+
+    def test_priority_pushed_later_overtakes(self):
+        q = FairShareQueue()
+        q.push('a1', user='a')
+        q.push('a2', user='a')
+        self.assertEqual(q.pop(), 'a1')
+        q.push('b1', priority=1, user='b')
+        self.assertEqual(drain(q), ['b1', 'a2'])
+
+    def test_users_take_turns(self):
+        q = FairShareQueue()
+        for i in range(4):
+            q.push('a%d' % i, user='a')
+        for i in range(2):
+            q.push('b%d' % i, user='b')
+        self.assertEqual(drain(q), ['a0', 'b0', 'a1', 'b1', 'a2', 'a3'])
+
+    def test_fifo_within_a_user(self):
+        q = FairShareQueue()
+        for i in range(5):
+            q.push(('a', i), user='a')
+            q.push(('b', i), user='b')
+        items = drain(q)
+        for user in 'ab':
+            self.assertEqual([i for u, i in items if u == user], list(range(5)))
+
+    def test_weights(self):
+        q = FairShareQueue(weights={'heavy': 2, 'light': 0.5})
+        for i in range(12):
+            q.push('heavy', user='heavy')
+            q.push('normal', user='normal')
+            q.push('light', user='light')
+        first = drain(q)[:14]
+        # 2 : 1 : 0.5 while all of them have items waiting
+        self.assertEqual(first.count('heavy'), 8)
+        self.assertEqual(first.count('normal'), 4)
+        self.assertEqual(first.count('light'), 2)
+
+    def test_groups_of_a_user_take_turns(self):
+        q = FairShareQueue()
+        for i in range(3):
+            q.push('r1-%d' % i, user='a', group='r1')
+        q.push('r2-0', user='a', group='r2')
+        self.assertEqual(drain(q), ['r1-0', 'r2-0', 'r1-1', 'r1-2'])
+
+    def test_weights_must_be_positive(self):
+        for weights in ({'a': 0}, {'a': -1}):
+            with self.assertRaises(ValueError):
+                FairShareQueue(weights)
+        with self.assertRaises(ValueError):
+            FairShareQueue(default_weight=0)
+
+    def test_clear(self):
+        q = FairShareQueue()
+        q.push('a', priority=1, user='x')
+        q.push('b')
+        q.clear()
+        self.assertEqual(len(q), 0)
+        q.push('c')
+        self.assertEqual(drain(q), ['c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
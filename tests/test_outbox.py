@@ -0,0 +1,133 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from cloudshell.custom_execution_server.custom_execution_server import ErrorCommandResult, FailedCommandResult, \
+    PassedCommandResult
+from cloudshell.custom_execution_server.outbox import Outbox
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outbox_directory = os.path.join(self.directory, 'outbox')
+        self.reports_directory = os.path.join(self.outbox_directory, 'reports')
+        self.logger = logging.getLogger('test')
+        self.outbox = Outbox(self.outbox_directory, self.logger, base_backoff=1, max_backoff=8)
+
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def reopen(self):
+        self.outbox.close()
+        self.outbox = Outbox(self.outbox_directory, self.logger, base_backoff=1, max_backoff=8)
+
+    def test_take_in_order(self):
+        self.outbox.add('e1', PassedCommandResult('r1.txt', b'report 1'))
+        self.outbox.add('e2', ErrorCommandResult('Robot failure', 'boom'))
+        entry = self.outbox.take(1)
+        self.assertEqual((entry.execution_id, entry.result, entry.report_filename), ('e1', 'Passed', 'r1.txt'))
+        with open(entry.report_path, 'rb') as f:
+            self.assertEqual(f.read(), b'report 1')
+        entry2 = self.outbox.take(1)
+        self.assertEqual((entry2.execution_id, entry2.error_name, entry2.report_path), ('e2', 'Robot failure', ''))
+        # both in flight
+        self.assertIsNone(self.outbox.take(0.05))
+
+    def test_complete_deletes_the_owned_report(self):
+        self.outbox.add('e1', PassedCommandResult('r1.txt', b'report 1'))
+        entry = self.outbox.take(1)
+        self.assertTrue(entry.owns_report)
+        self.outbox.complete(entry)
+        self.assertFalse(os.path.exists(entry.report_path))
+        self.assertEqual(self.outbox.size(), 0)
+        self.assertEqual(os.listdir(self.reports_directory), [])
+
+    def test_report_file_moved_or_referenced(self):
+        moved = os.path.join(self.directory, 'moved.zip')
+        kept = os.path.join(self.directory, 'kept.zip')
+        for path in (moved, kept):
+            with open(path, 'wb') as f:
+                f.write(b'zip')
+        self.outbox.add('e1', PassedCommandResult('moved.zip', None, report_path=moved, delete_report_after_upload=True))
+        self.outbox.add('e2', FailedCommandResult('kept.zip', None, report_path=kept))
+        self.assertFalse(os.path.exists(moved))
+        entry1 = self.outbox.take(1)
+        entry2 = self.outbox.take(1)
+        self.assertTrue(entry1.owns_report)
+        self.assertEqual(os.path.dirname(entry1.report_path), self.reports_directory)
+        self.assertFalse(entry2.owns_report)
+        self.assertEqual(entry2.report_path, kept)
+        self.outbox.complete(entry2)
+        self.assertTrue(os.path.exists(kept))
+
+    def test_restart_replays_what_was_not_delivered(self):
+        self.outbox.add('e1', PassedCommandResult('r1.txt', b'report 1'))
+        self.outbox.add('e2', PassedCommandResult('r2.txt', b'report 2'))
+        self.outbox.add('e3', ErrorCommandResult('Robot failure', 'boom'))
+        e1 = self.outbox.take(1)
+        e2 = self.outbox.take(1)
+        self.outbox.complete(e1)
+        self.outbox.mark_finished(e2)
+        self.reopen()
+        self.assertEqual(self.outbox.pending_execution_ids(), ['e2', 'e3'])
+        e2 = self.outbox.take(1)
+        self.assertEqual(e2.execution_id, 'e2')
+        # only the report upload is left
+        self.assertTrue(e2.finished)
+        with open(e2.report_path, 'rb') as f:
+            self.assertEqual(f.read(), b'report 2')
+        e3 = self.outbox.take(1)
+        self.assertFalse(e3.finished)
+        self.assertEqual(os.listdir(self.reports_directory), [os.path.basename(e2.report_path)])
+
+    def test_journal_compacted_on_open(self):
+        for i in range(20):
+            self.outbox.add('e%d' % i, ErrorCommandResult('Robot failure', 'boom'))
+        for _ in range(19):
+            self.outbox.complete(self.outbox.take(1))
+        self.reopen()
+        with open(os.path.join(self.outbox_directory, Outbox.JOURNAL_FILENAME)) as f:
+            self.assertEqual(len(f.readlines()), 1)
+        self.assertEqual(self.outbox.pending_execution_ids(), ['e19'])
+
+    def test_torn_last_record_is_ignored(self):
+        self.outbox.add('e1', ErrorCommandResult('Robot failure', 'boom'))
+        self.outbox.close()
+        with open(os.path.join(self.outbox_directory, Outbox.JOURNAL_FILENAME), 'a') as f:
+            f.write('{"op": "add", "seq": 2, "id": "e2", "res')
+        self.outbox = Outbox(self.outbox_directory, self.logger)
+        self.assertEqual(self.outbox.pending_execution_ids(), ['e1'])
+
+    def test_orphaned_reports_deleted_on_open(self):
+        self.outbox.add('e1', PassedCommandResult('r1.txt', b'report 1'))
+        # written by add() just before a crash, never journaled
+        orphan = os.path.join(self.reports_directory, '99.report')
+        with open(orphan, 'wb') as f:
+            f.write(b'orphan')
+        self.reopen()
+        self.assertFalse(os.path.exists(orphan))
+        self.assertEqual(len(os.listdir(self.reports_directory)), 1)
+
+    def test_retry_later_backoff(self):
+        self.outbox.add('e1', ErrorCommandResult('Robot failure', 'boom'))
+        entry = self.outbox.take(1)
+        for attempt, full in ((1, 1), (2, 2), (3, 4), (4, 8), (5, 8), (10, 8)):
+            entry.attempts = attempt - 1
+            delay = self.outbox.retry_later(entry)
+            self.assertGreaterEqual(delay, full * 0.5)
+            self.assertLessEqual(delay, full)
+            self.assertGreater(entry.next_attempt, time.time())
+            self.assertFalse(entry.in_flight)
+        # not due yet
+        self.assertIsNone(self.outbox.take(0.05))
+        entry.next_attempt = time.time()
+        self.assertIs(self.outbox.take(1), entry)
+
+
+if __name__ == '__main__':
+    unittest.main()
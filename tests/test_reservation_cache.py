@@ -0,0 +1,90 @@
+import threading
+import time
+import unittest
+
+from cloudshell.custom_execution_server.custom_execution_server import ReservationCache
+
+
+class ReservationCacheTest(unittest.TestCase):
+    def test_concurrent_gets_share_one_fetch(self):
+        cache = ReservationCache(ttl=30)
+        calls = []
+        release = threading.Event()
+
+        def loader(reservation_id):
+            calls.append(reservation_id)
+            release.wait(5)
+            return '{"id": "%s"}' % reservation_id
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('r1', loader))) for _ in range(8)]
+        for th in threads:
+            th.start()
+        # let all of them reach the cache before the fetch returns
+        time.sleep(0.1)
+        release.set()
+        for th in threads:
+            th.join()
+        self.assertEqual(calls, ['r1'])
+        self.assertEqual(results, ['{"id": "r1"}'] * 8)
+        self.assertEqual(cache.get('r1', loader), '{"id": "r1"}')
+        self.assertEqual(calls, ['r1'])
+
+    def test_failed_fetch_is_shared_and_not_cached(self):
+        cache = ReservationCache(ttl=30)
+        calls = []
+        release = threading.Event()
+
+        def failing_loader(reservation_id):
+            calls.append(reservation_id)
+            release.wait(5)
+            raise IOError('CloudShell is down')
+
+        errors = []
+
+        def get():
+            try:
+                cache.get('r1', failing_loader)
+            except IOError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=get) for _ in range(4)]
+        for th in threads:
+            th.start()
+        time.sleep(0.1)
+        release.set()
+        for th in threads:
+            th.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(cache.get('r1', lambda r: 'ok'), 'ok')
+
+    def test_expiry(self):
+        cache = ReservationCache(ttl=0.1)
+        calls = []
+
+        def loader(reservation_id):
+            calls.append(reservation_id)
+            return 'v%d' % len(calls)
+
+        self.assertEqual(cache.get('r1', loader), 'v1')
+        self.assertEqual(cache.get('r1', loader), 'v1')
+        self.assertEqual(cache.peek('r1'), 'v1')
+        time.sleep(0.15)
+        self.assertIsNone(cache.peek('r1'))
+        self.assertEqual(cache.get('r1', loader), 'v2')
+        self.assertEqual(calls, ['r1', 'r1'])
+
+    def test_least_recently_used_evicted(self):
+        cache = ReservationCache(ttl=30, max_size=2)
+        cache.get('r1', lambda r: r)
+        cache.get('r2', lambda r: r)
+        # r1 used more recently than r2
+        cache.get('r1', lambda r: self.fail('r1 should be cached'))
+        cache.get('r3', lambda r: r)
+        self.assertEqual(cache.peek('r1'), 'r1')
+        self.assertIsNone(cache.peek('r2'))
+        self.assertEqual(cache.peek('r3'), 'r3')
+
+
+if __name__ == '__main__':
+    unittest.main()
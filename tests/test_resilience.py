@@ -0,0 +1,187 @@
+import logging
+import time
+import unittest
+
+from cloudshell.custom_execution_server.custom_execution_server import CircuitBreaker, CircuitOpenError, CloudShellAPI, \
+    CloudShellAPIError, RequestNotSentError, RetryPolicy
+from cloudshell.custom_execution_server.mock_cloudshell import MockCloudShell
+
+
+class RetryPolicyTest(unittest.TestCase):
+    def test_delay_doubles_with_jitter(self):
+        policy = RetryPolicy(attempts=5, base_delay=1, max_delay=100)
+        for attempt, full in ((1, 1), (2, 2), (3, 4), (4, 8)):
+            for _ in range(50):
+                delay = policy.delay(attempt)
+                self.assertGreaterEqual(delay, full * 0.5)
+                self.assertLessEqual(delay, full)
+
+    def test_delay_capped(self):
+        policy = RetryPolicy(base_delay=1, max_delay=3)
+        for _ in range(50):
+            self.assertLessEqual(policy.delay(10), 3)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_failures_in_a_row(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        for _ in range(2):
+            self.assertFalse(breaker.before_request())
+            breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError) as cm:
+            breaker.before_request()
+        self.assertGreater(cm.exception.retry_after, 0)
+
+    def test_success_resets_failure_count(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        for _ in range(10):
+            breaker.record_failure()
+            breaker.record_failure()
+            breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05, max_reset_timeout=1)
+        breaker.record_failure()
+        time.sleep(0.06)
+        self.assertTrue(breaker.before_request())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # only one probe at a time
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_request()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        time.sleep(0.11)
+        self.assertTrue(breaker.before_request())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertFalse(breaker.before_request())
+
+
+class CloudShellAPIResilienceTest(unittest.TestCase):
+    def setUp(self):
+        self.mock = MockCloudShell(poll_hold=0.1)
+        self.mock.start()
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.2, max_reset_timeout=0.5)
+        self.api = CloudShellAPI('127.0.0.1', self.mock.port(), 'admin', 'admin', 'Global', logging.getLogger('test'),
+                                 retry_policies={'/API/Execution/Status': RetryPolicy(attempts=1),
+                                                 '/API/Execution/FinishedExecution': RetryPolicy(attempts=4, base_delay=0.05)},
+                                 circuit_breaker=self.breaker)
+        self.api.login()
+
+    def tearDown(self):
+        self.api.close()
+        self.mock.stop()
+
+    def _status(self):
+        return self.api.request('post', '/API/Execution/Status', data='{"Name": "x", "ExecutionIds": []}')
+
+    def test_isolated_failures_dont_open_the_circuit(self):
+        for _ in range(5):
+            self.mock.unavailable = True
+            with self.assertRaises(CloudShellAPIError):
+                self._status()
+            self.mock.unavailable = False
+            for _ in range(3):
+                self._status()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_open_circuit_is_waited_out_while_attempts_remain(self):
+        self.mock.unavailable = True
+        for _ in range(3):
+            with self.assertRaises(CloudShellAPIError):
+                self._status()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.mock.unavailable = False
+        code, _ = self.api.request('put', '/API/Execution/FinishedExecution',
+                                   data='{"Name": "x", "ExecutionId": "e1", "Result": "Passed"}')
+        self.assertEqual(code, 200)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_login_probe_closes_the_circuit(self):
+        self.mock.unavailable = True
+        for _ in range(3):
+            with self.assertRaises(CloudShellAPIError):
+                self._status()
+        self.mock.unavailable = False
+        time.sleep(0.25)
+        self.api.login()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_probe_rejected_with_4xx_closes_the_circuit(self):
+        self.mock.unavailable = True
+        for _ in range(3):
+            with self.assertRaises(CloudShellAPIError):
+                self._status()
+        self.mock.unavailable = False
+        send = self.api._send
+
+        def reject_login(method, path, *args):
+            if path == '/API/Auth/login':
+                raise CloudShellAPIError(401, 'Invalid credentials')
+            return send(method, path, *args)
+        self.api._send = reject_login
+        time.sleep(0.25)
+        with self.assertRaises(CloudShellAPIError):
+            self._status()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_no_resend_after_a_server_error(self):
+        self.api._retry_policies['/API/Execution/ExecutionReport'] = RetryPolicy(attempts=3, base_delay=0.01, resend=False)
+        self.mock.unavailable = True
+        with self.assertRaises(CloudShellAPIError):
+            self.api.request('post', '/API/Execution/ExecutionReport/x/e1/r.txt', data=b'report',
+                             headers={'Content-Type': 'application/octet-stream'})
+        self.assertEqual(sum(n for k, n in self.mock.request_counts().items() if 'ExecutionReport' in k), 1)
+
+    def test_retried_without_resend_when_not_sent(self):
+        port = self.mock.port()
+        self.mock.stop()
+        api = CloudShellAPI('127.0.0.1', port, 'admin', 'admin', 'Global', logging.getLogger('test'),
+                            retry_policies={'/API/Execution/ExecutionReport': RetryPolicy(attempts=3, base_delay=0.01, resend=False)},
+                            circuit_breaker=CircuitBreaker(failure_threshold=10))
+        sends = []
+        send = api._send
+
+        def count_send(*args):
+            sends.append(args)
+            return send(*args)
+        api._send = count_send
+        with self.assertRaises(RequestNotSentError):
+            api.request('post', '/API/Execution/ExecutionReport/x/e1/r.txt', data=b'report')
+        self.assertEqual(len(sends), 3)
+        self.mock.start()
+
+    def test_failed_probe_counts_as_an_attempt(self):
+        self.mock.unavailable = True
+        for _ in range(3):
+            with self.assertRaises(CloudShellAPIError):
+                self._status()
+        time.sleep(0.25)
+        send = self.api._send
+        probes = []
+
+        def fail_first_probe(method, path, *args):
+            if path == '/API/Auth/login' and not probes:
+                probes.append(path)
+                raise CloudShellAPIError(503, 'Service unavailable')
+            return send(method, path, *args)
+        self.api._send = fail_first_probe
+        self.mock.unavailable = False
+        code, _ = self.api.request('put', '/API/Execution/FinishedExecution',
+                                   data='{"Name": "x", "ExecutionId": "e1", "Result": "Passed"}')
+        self.assertEqual(code, 200)
+        self.assertEqual(probes, ['/API/Auth/login'])
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_relogin_after_token_expired(self):
+        self.mock.expire_token()
+        code, _ = self._status()
+        self.assertEqual(code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
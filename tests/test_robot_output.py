@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from cloudshell.custom_execution_server.robot_output import summarize_robot_output
+
+OUTPUT_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<robot generator="Robot 6.1.1 (Python 3.11.4 on linux)" generated="20240102 10:00:00.000">
+<suite id="s1" name="Top">
+<suite id="s1-s1" name="Login">
+<test id="s1-s1-t1" name="Valid Login">
+<kw name="Open Browser"><status status="PASS" starttime="20240102 10:00:00.000" endtime="20240102 10:00:01.000"/></kw>
+<tag>smoke</tag>
+<tag>login</tag>
+<status status="PASS" starttime="20240102 10:00:00.000" endtime="20240102 10:00:01.500"/>
+</test>
+<test id="s1-s1-t2" name="Invalid Login">
+<tags><tag>login</tag></tags>
+<status status="FAIL" starttime="20240102 10:00:01.500" endtime="20240102 10:00:03.750">Expected error page</status>
+</test>
+<status status="FAIL" starttime="20240102 10:00:00.000" endtime="20240102 10:00:04.000"/>
+</suite>
+<suite id="s1-s2" name="Search">
+<test id="s1-s2-t1" name="Not Ready">
+<status status="SKIP" starttime="20240102 10:00:04.000" endtime="20240102 10:00:04.000">Skipped with --skip</status>
+</test>
+<test id="s1-s2-t2" name="Timeout">
+<status status="FAIL" starttime="20240102 10:00:04.000" endtime="20240102 10:00:05.000">Test timeout 1 second exceeded.</status>
+</test>
+<status status="FAIL" starttime="20240102 10:00:04.000" endtime="20240102 10:00:05.250"/>
+</suite>
+<status status="FAIL" starttime="20240102 10:00:00.000" endtime="20240102 10:00:05.500"/>
+</suite>
+<errors>
+<msg timestamp="20240102 10:00:00.000" level="WARN">Keyword 'Old' is deprecated.</msg>
+</errors>
+</robot>
+'''
+
+ROBOT7_OUTPUT_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<robot generator="Robot 7.0 (Python 3.11.4 on linux)" generated="2024-01-02T10:00:00.000000" schemaversion="5">
+<suite id="s1" name="Top">
+<test id="s1-t1" name="Quick">
+<status status="PASS" start="2024-01-02T10:00:00.000000" elapsed="0.250"/>
+</test>
+<status status="PASS" start="2024-01-02T10:00:00.000000" elapsed="0.300"/>
+</suite>
+<errors>
+</errors>
+</robot>
+'''
+
+
+class SummarizeRobotOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def summarize(self, xml, **kwargs):
+        path = os.path.join(self.directory, 'output.xml')
+        with open(path, 'w') as f:
+            f.write(xml)
+        return summarize_robot_output(path, **kwargs)
+
+    def test_statistics_and_first_failure(self):
+        summary = self.summarize(OUTPUT_XML)
+        self.assertEqual(summary['status'], 'FAIL')
+        self.assertEqual(summary['statistics'], {'total': 4, 'passed': 1, 'failed': 2, 'skipped': 1})
+        self.assertEqual(summary['first_failure'], {'test': 'Top.Login.Invalid Login',
+                                                    'message': 'Expected error page'})
+        self.assertEqual(summary['errors'], 1)
+        self.assertEqual(summary['generator'], 'Robot 6.1.1 (Python 3.11.4 on linux)')
+
+    def test_suites_and_tests(self):
+        summary = self.summarize(OUTPUT_XML)
+        self.assertEqual([(s['name'], s['status'], s['elapsed']) for s in summary['suites']], [
+            ('Top.Login', 'FAIL', 4.0),
+            ('Top.Search', 'FAIL', 1.25),
+            ('Top', 'FAIL', 5.5),
+        ])
+        tests = summary['tests']
+        self.assertEqual([(t['name'], t['status'], t['elapsed']) for t in tests], [
+            ('Top.Login.Valid Login', 'PASS', 1.5),
+            ('Top.Login.Invalid Login', 'FAIL', 2.25),
+            ('Top.Search.Not Ready', 'SKIP', 0.0),
+            ('Top.Search.Timeout', 'FAIL', 1.0),
+        ])
+        self.assertEqual(tests[0]['tags'], ['smoke', 'login'])
+        self.assertEqual(tests[1]['tags'], ['login'])
+        self.assertNotIn('message', tests[0])
+        self.assertEqual(tests[2]['message'], 'Skipped with --skip')
+
+    def test_message_cut(self):
+        summary = self.summarize(OUTPUT_XML, max_message_length=8)
+        self.assertEqual(summary['first_failure']['message'], 'Expected')
+
+    def test_robot7_elapsed(self):
+        summary = self.summarize(ROBOT7_OUTPUT_XML)
+        self.assertEqual(summary['status'], 'PASS')
+        self.assertEqual(summary['statistics'], {'total': 1, 'passed': 1, 'failed': 0, 'skipped': 0})
+        self.assertIsNone(summary['first_failure'])
+        self.assertEqual(summary['suites'], [{'name': 'Top', 'status': 'PASS', 'elapsed': 0.3}])
+        self.assertEqual(summary['tests'][0]['elapsed'], 0.25)
+        self.assertEqual(summary['errors'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()